@@ -13,7 +13,7 @@ import tarfile
 
 # DIRAC imports
 import DIRAC
-from DIRAC.DataManagementSystem.Client.DataManager import DataManager
+from CTADIRAC.DataManagementSystem.Client.DataManager import DataManager
 #from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
 from CTADIRAC.Core.Utilities.tool_box import get_os_and_cpu_info
 
@@ -48,9 +48,9 @@ class SoftwareManager(object):
             package_dir = os.path.join(self.LFN_ROOT, 'centos7',
                                        compiler, category, package, version)
             DIRAC.gLogger.notice('Looking for tarball in %s'%package_dir)
-            results = self.dm.getFilesFromDirectory(package_dir)
+            # stop the catalog walk as soon as the first file is found
             try:
-                first_file_path = results['Value'][0]
+                first_file_path = next(self.dm.walkFilesFromDirectory(package_dir))
                 if first_file_path[-7:] == '.tar.gz':
                     results = self.dm.getActiveReplicas(first_file_path)
                     if results['OK']:
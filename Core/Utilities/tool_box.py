@@ -6,6 +6,8 @@
 import os
 import re
 import copy
+import json
+import hashlib
 import datetime
 
 import DIRAC
@@ -79,6 +81,75 @@ def run_number_from_filename(filename, package):
         run_number = int(filename.split('run')[1].split('___cta')[0])
     return run_number
 
+def metadata_fields_fingerprint(meta_data_field):
+    """ Compute a fingerprint of a meta data fields definition,
+    independent of the order of the fields
+
+    Keyword arguments:
+    meta_data_field -- dict of field name: field type
+
+    return:
+        fingerprint : str - hex digest of the definition
+    """
+    return hashlib.sha1(json.dumps(meta_data_field, sort_keys=True)).hexdigest()
+
+def register_metadata_fields(meta_data_field):
+    """ Register in the DFC the meta data fields of a transformation, meant to
+    be called once at transformation creation so that the jobs only have
+    to check the fingerprint of their fields definition
+
+    Keyword arguments:
+    meta_data_field -- dict of field name: field type
+
+    return:
+        S_OK(fingerprint) or S_ERROR
+    """
+    fc = FileCatalogClient()
+    result = fc.getMetadataFields()
+    if not result['OK']:
+        return result
+    existing_fields = result['Value'].get('DirectoryMetaFields', result['Value'])
+    for key, value in meta_data_field.items():
+        if key in existing_fields:
+            continue
+        result = fc.addMetadataField(key, value)
+        if not result['OK']:
+            return result
+        DIRAC.gLogger.notice('Added meta data field %s: %s' % (key, value))
+    return DIRAC.S_OK(metadata_fields_fingerprint(meta_data_field))
+
+def add_managedata_manifest_step(job, manifest, md_json, md_field_json, base_path,
+                                 package, program_category, catalogs,
+                                 log_file='DataManagement_Log.txt', fingerprint=None):
+    """ Add to a job one data management step that uploads and registers
+    the files of all the manifest entries in a single process,
+    see cta-prod-managedata-manifest.py
+
+    Keyword arguments:
+    job -- the Job to add the step to
+    manifest -- list of dict with keys pattern, output_type and file_metadata
+    md_json -- directory meta data as a json string
+    md_field_json -- meta data fields definition as a json string
+    base_path -- base path of the production in the catalog
+    package -- software package name, used to get the run numbers
+    program_category -- program category, e.g. tel_sim
+    catalogs -- list of catalogs as a json string
+    log_file -- log file of the step
+    fingerprint -- fingerprint of the meta data fields registered with
+                   the transformation, see register_metadata_fields
+
+    return:
+        the step as returned by Job.setExecutable
+    """
+    scripts = '../CTADIRAC/Core/scripts/'
+    arguments = "'%s' '%s' %s %s %s '%s' '%s'" % \
+                (md_json, md_field_json, base_path, package,
+                 program_category, catalogs, json.dumps(manifest))
+    if fingerprint:
+        arguments += ' %s' % fingerprint
+    return job.setExecutable(scripts + 'cta-prod-managedata-manifest.py',
+                             arguments=arguments, logFile=log_file)
+
 def check_dataset_query(dataset_name):
     """ print dfind command for a given dataset
     """
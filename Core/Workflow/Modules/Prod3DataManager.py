@@ -4,7 +4,9 @@
 __RCSID__ = "$Id$"
 
 # generic imports
-import os, glob, json, tarfile, re, collections
+import os, glob, json, tarfile, re, collections, subprocess, threading, time
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
 
 # DIRAC imports
 import DIRAC
@@ -12,21 +14,44 @@ from DIRAC.Resources.Catalog.FileCatalog import FileCatalog
 from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
 from DIRAC.DataManagementSystem.Client.DataManager import DataManager
 from DIRAC.Core.Utilities import List
+from DIRAC.Core.Utilities.Adler import fileAdler
+from DIRAC.Core.Utilities.File import makeGuid, getSize
+from DIRAC.Core.Utilities.ReturnValues import returnSingleResult
+from DIRAC.Resources.Storage.StorageElement import StorageElement
 from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
 from DIRAC.Core.Utilities.SiteSEMapping import getSEsForSite
 from DIRAC.Interfaces.API.Dirac import Dirac
+from CTADIRAC.Core.Utilities.tool_box import run_number_from_filename, metadata_fields_fingerprint
+from CTADIRAC.DataManagementSystem.Utilities.SETransferStats import SETransferStats
+
+# Metadata fields, directories and directory metadata already created in
+# the catalog by this process, see Prod3DataManager.createMDStructure
+_mdStructureCache = { 'Fields' : {}, 'Directories' : {} }
+
+# Patterns of the file metadata taken from the file names
+_SUBARRAY_RE = re.compile( r'subarray-\d+' )
+_NOSCT_RE = re.compile( 'nosct' )
+_SCT_RE = re.compile( 'sct' )
+
+# Default compression level of the log tarballs per codec
+_TAR_DEFAULT_LEVELS = { 'gzip' : 6, 'zstd' : 3 }
 
 class Prod3DataManager(object) :
   """ Manage data and meta-data
   """
 
-  def __init__(self,catalogs=['DIRACFileCatalog']):
+  def __init__(self,catalogs=['DIRACFileCatalog'], mdCacheFile=None):
     """ Constructor
 
+        mdCacheFile is an optional json file where the directories and metadata
+        created by createMDStructure are kept, so that the next steps of the
+        same job do not have to create them again
     """
     self.setupCatalogClient( catalogs )
     self.printCatalogConfig( catalogs )
     self.setupDataManagerClient( catalogs )
+    self.setupMDCache( mdCacheFile )
+    self.setupUploadStats()
 
   def setupCatalogClient( self, catalogs ):
     """ Init FileCatalog client
@@ -48,6 +73,75 @@ class Prod3DataManager(object) :
     """
     self.dm = DataManager( catalogs )
 
+  def setupMDCache( self, mdCacheFile = None ):
+    """ Init the cache of the metadata structure, shared by all the instances
+        of the process and loaded from mdCacheFile if given
+    """
+    self.mdCacheFile = mdCacheFile
+    self.mdCache = _mdStructureCache
+    if mdCacheFile and os.path.exists( mdCacheFile ):
+      try:
+        with open( mdCacheFile ) as cacheFile:
+          diskCache = json.load( cacheFile )
+        self.mdCache['Fields'].update( diskCache.get( 'Fields', {} ) )
+        for dirPath, dirMD in diskCache.get( 'Directories', {} ).items():
+          self.mdCache['Directories'].setdefault( dirPath, {} ).update( dirMD )
+      except ( IOError, ValueError ) as e:
+        DIRAC.gLogger.warn( 'Could not read metadata structure cache %s: %s' % ( mdCacheFile, e ) )
+
+  def _saveMDCache( self ):
+    """ write the cache of the metadata structure to mdCacheFile, if any
+    """
+    if not self.mdCacheFile:
+      return
+    tmpFile = '%s.%d.tmp' % ( self.mdCacheFile, os.getpid() )
+    try:
+      with open( tmpFile, 'w' ) as cacheFile:
+        json.dump( self.mdCache, cacheFile )
+      os.rename( tmpFile, self.mdCacheFile )
+    except ( IOError, OSError ) as e:
+      DIRAC.gLogger.warn( 'Could not write metadata structure cache %s: %s' % ( self.mdCacheFile, e ) )
+
+  def setupUploadStats( self ):
+    """ Init the rolling upload statistics per SE, shared by the jobs of the node
+        through a local json file, used to demote the failing SEs
+    """
+    opsHelper = Operations()
+    statsFile = os.path.expanduser( opsHelper.getValue( 'ProductionOutputs/SEStatsFile',
+                                                        '~/.dirac_upload_se_stats.json' ) )
+    self.uploadStats = SETransferStats( statsFile )
+    self.maxSEFailureRate = opsHelper.getValue( 'ProductionOutputs/MaxSEFailureRate', 0.5 )
+    self.seDemotionTime = opsHelper.getValue( 'ProductionOutputs/SEDemotionTime', 600 )
+    # Uploads of this process per SE: [files, failures, bytes, seconds]
+    self.uploadReport = {}
+    self._uploadLock = threading.Lock()
+
+  def _recordUpload( self, SE, ok, size, elapsed ):
+    """ record the outcome of an upload in the rolling statistics and the report
+    """
+    self.uploadStats.addTransfer( SE, ok, size, elapsed )
+    with self._uploadLock:
+      seReport = self.uploadReport.setdefault( SE, [0, 0, 0, 0.] )
+      if ok:
+        seReport[0] += 1
+        seReport[2] += size
+        seReport[3] += elapsed
+      else:
+        seReport[1] += 1
+
+  def printUploadReport( self ):
+    """ log the upload throughput per SE since the last report and save the rolling statistics,
+        to be called once at the end of a batch of uploads
+    """
+    with self._uploadLock:
+      uploadReport = self.uploadReport
+      self.uploadReport = {}
+    for SE, ( files, failures, size, elapsed ) in sorted( uploadReport.items() ):
+      rate = size / elapsed / 1024. / 1024. if elapsed else 0.
+      DIRAC.gLogger.notice( 'Upload to %s: %d files, %d failures, %.1f MB in %.1f s, %.2f MB/s' %
+                            ( SE, files, failures, size / 1024. / 1024., elapsed, rate ) )
+    self.uploadStats.save()
+
   def _getSEList( self, SEType = 'ProductionOutputs', DataType = 'SimtelProd' ):
     """ get from CS the list of available SE for data upload
     """
@@ -71,6 +165,8 @@ class Prod3DataManager(object) :
         SEList.remove( localSE )
 
     SEList = retainedlocalSEList + SEList
+    # # Try the SEs which failed recently only as a last resort
+    SEList = self.uploadStats.demoteSEs( SEList, self.maxSEFailureRate, self.seDemotionTime )
     if len( SEList ) == 0:
       return DIRAC.S_ERROR( 'Error in building SEList' )
 
@@ -105,106 +201,224 @@ class Prod3DataManager(object) :
       path = '%.1f' % path
     return str( path )
 
-  def createTarLogFiles ( self, inputpath, tarname ):
+  def getFileList( self, path, output_pattern, file_metadata, package, output_type ):
+    """ build the list of ( lfn, localfile, filemetadata ) tuples of the local
+        files matching output_pattern, to be given to putAndRegisterMany
+        The run number is taken from the file name and sets the run path
+    """
+    file_list = []
+    for localfile in glob.glob( output_pattern ):
+      file_name = os.path.basename( localfile )
+      # Check run number, assign one as file metadata if needed
+      fmd_dict = json.loads( file_metadata )
+      try:
+        run_number = run_number_from_filename( file_name, package )
+      except:
+        run_number = -9999
+        DIRAC.gLogger.notice( 'Could not get a correct run number, assigning -9999' )
+      fmd_dict['runNumber'] = '%08d' % int( run_number )
+      # get the output file path
+      run_path = self._getRunPath( fmd_dict )
+      lfn = os.path.join( path, output_type, run_path, file_name )
+      file_list.append( ( lfn, localfile, json.dumps( fmd_dict ) ) )
+    return file_list
+
+  def _getCompressorCommand( self, codec, level, nbThreads ):
+    """ get the command line of the external compressor to pipe the tar stream to,
+        None if there is none for this codec
+    """
+    if codec == 'zstd':
+      exe = find_executable( 'zstd' )
+      if exe:
+        # -T0 uses as many threads as cores
+        return [exe, '-q', '-%d' % level, '-T%d' % nbThreads]
+    elif codec == 'gzip':
+      # pigz is a multi-threaded gzip, using all cores by default
+      exe = find_executable( 'pigz' )
+      if exe:
+        cmd = [exe, '-q', '-%d' % level]
+        if nbThreads:
+          cmd += ['-p', str( nbThreads )]
+        return cmd
+    return None
+
+  def createTarLogFiles ( self, inputpath, tarname, codec = 'gzip', level = None, nbThreads = 0 ):
     """ create tar of log and histogram files
+
+        codec is gzip or zstd, level the compression level (default 6 for gzip
+        and 3 for zstd) and nbThreads the number of compression threads,
+        0 for all cores. The tar stream is piped to zstd or pigz, writing
+        directly tarname, and falls back to the python gzip if pigz is missing.
     """
-    tarmode = 'w:gz'
-    tar = tarfile.open( tarname, tarmode )
+    if codec not in _TAR_DEFAULT_LEVELS:
+      return DIRAC.S_ERROR( 'Unknown compression codec: %s' % codec )
+    if level is None:
+      level = _TAR_DEFAULT_LEVELS[codec]
 
+    fileList = []
     for subdir in ['Log/*', 'Histograms/*']:
       logdir = os.path.join( inputpath, subdir )
+      localfiles = glob.glob( logdir )
+      if not localfiles:
+        return DIRAC.S_ERROR( 'Empty directory: %s' % logdir )
+      fileList += localfiles
+
+    cmd = self._getCompressorCommand( codec, level, nbThreads )
+    if cmd is None:
+      if codec != 'gzip':
+        return DIRAC.S_ERROR( 'No %s compressor available' % codec )
+      tar = tarfile.open( tarname, 'w:gz', compresslevel = level )
+      for localfile in fileList:
+        tar.add( localfile, arcname = localfile.split( '/' )[-1] )
+      tar.close()
+      return DIRAC.S_OK()
 
-      res = self._checkemptydir( logdir )
-      if not res['OK']:
-        return res
+    with open( tarname, 'wb' ) as tarFile:
+      proc = subprocess.Popen( cmd, stdin = subprocess.PIPE, stdout = tarFile )
+      try:
+        tar = tarfile.open( fileobj = proc.stdin, mode = 'w|' )
+        for localfile in fileList:
+          tar.add( localfile, arcname = localfile.split( '/' )[-1] )
+        tar.close()
+      finally:
+        proc.stdin.close()
+        returnCode = proc.wait()
+    if returnCode:
+      return DIRAC.S_ERROR( '%s failed with exit code %d' % ( cmd[0], returnCode ) )
 
-      for localfile in glob.glob( logdir ):
-        tar.add( localfile, arcname = localfile.split( '/' )[-1] )
+    return DIRAC.S_OK()
 
-    tar.close()
+  def _checkMetadataFields( self, mdfield, fingerprint = None ):
+    """ make sure the metadata fields exist in the DFC
 
+        If fingerprint is the one of mdfield, the fields have been registered
+        at the transformation creation, see tool_box.register_metadata_fields,
+        and nothing is done. Otherwise the existing fields are read at once
+        and only the missing ones are added.
+    """
+    missingFields = dict( ( key, value ) for key, value in mdfield.items()
+                          if self.mdCache['Fields'].get( key ) != value )
+    if not missingFields:
+      return DIRAC.S_OK()
+    if fingerprint:
+      if fingerprint == metadata_fields_fingerprint( mdfield ):
+        self.mdCache['Fields'].update( missingFields )
+        return DIRAC.S_OK()
+      DIRAC.gLogger.warn( 'Metadata fields do not match the transformation fingerprint %s' % fingerprint )
+
+    res = self.fcc.getMetadataFields()
+    if not res['OK']:
+      return res
+    existingFields = res['Value'].get( 'DirectoryMetaFields', res['Value'] )
+    for key, value in missingFields.items():
+      if key not in existingFields:
+        res = self.fc.addMetadataField( key, value )
+        if not res['OK']:
+          return res
+      self.mdCache['Fields'][key] = value
     return DIRAC.S_OK()
 
-  def createMDStructure( self, metadata, metadatafield, basepath, program_category ):
+  def createMDStructure( self, metadata, metadatafield, basepath, program_category, fingerprint = None ):
     """ create meta data structure
+
+        Directories, directory metadata and metadata fields already known,
+        from a previous call in this process or in the same job via the
+        mdCacheFile, are skipped. The missing directories are created with
+        a single call and the missing metadata set with a single bulk call.
+        fingerprint is the optional fingerprint of the metadata fields
+        registered at the transformation creation.
     """
     # ## Add metadata fields to the DFC
     mdfield = json.loads( metadatafield )
-    for key, value in mdfield.items():
-      res = self.fc.addMetadataField( key, value )
-      if not res['OK']:
-        return res
+    res = self._checkMetadataFields( mdfield, fingerprint )
+    if not res['OK']:
+      return res
 
-    # ## Create the directory structure
+    # ## Build the directory structure and the metadata of each directory
     md = json.loads( metadata , object_pairs_hook = collections.OrderedDict )
 
+    # Directory metadata to set, as a list of ( path, metadata ) in creation order
+    # with a flag telling whether existing metadata must be kept
+    dirMetadata = []
     path = basepath
     process_program = program_category + '_prog'
     for key, value in collections.OrderedDict( ( k, md[k] ) for k in ( 'site', 'particle', process_program ) if k in md ).items():
       path = os.path.join( path, self._formatPath( value ) )
-      res = self.fc.createDirectory( path )
-      if not res['OK']:
-        return res
-
       # Set directory metadata for each subdir: 'site', 'particle', 'process_program'
-      res = self.fcc.setMetadata( path, {key:value} )
-      if not res['OK']:
-        return res
+      dirMetadata.append( ( path, {key:value}, False ) )
 
     # Create the TransformationID subdir and set MD
     # ## Get the TransformationID
+    TransformationID = '0000'
     if os.environ.has_key( 'JOBID' ):
       jobID = os.environ['JOBID']
       dirac = Dirac()
       res = dirac.getJobJDL( jobID )
-      TransformationID = '0000'
-      if res['Value'].has_key( 'TransformationID' ):
+      if res['OK'] and res['Value'].has_key( 'TransformationID' ):
         TransformationID = res['Value']['TransformationID']
 
     path = os.path.join( path, TransformationID )
-    res = self.fc.createDirectory( path )
-    if not res['OK']:
-      return res
-
     process_program_version = process_program + '_version'
-    res = self.fcc.setMetadata( path, dict( ( k, md[k] ) for k in ( 'phiP', 'thetaP', 'array_layout', process_program_version ) if k in md ) )
-    if not res['OK']:
-      return res
+    dirMetadata.append( ( path, dict( ( k, md[k] ) for k in ( 'phiP', 'thetaP', 'array_layout', process_program_version ) if k in md ), False ) )
 
-    # Create the Data and Log subdirs and set MD
+    # The Data and Log subdirs and their MD, set only if not already defined
     Transformation_path = path
-    for subdir in ['Data', 'Log']:
-      path = os.path.join( Transformation_path, subdir )
-      res = self.fc.createDirectory( path )
-      if not res['OK']:
-        return res
-
-    # Set metadata if not already defined
-      res = self.fcc.getDirectoryUserMetadata( path )
+    dataMD = {'outputType':'Data'}
+    if 'data_level' in md and 'configuration_id' in md:
+      # MD for the Data directory - data_level and configuration_id
+      dataMD.update( {'data_level': md['data_level'], 'configuration_id': md['configuration_id']} )
+    dirMetadata.append( ( os.path.join( Transformation_path, 'Data' ), dataMD, True ) )
+    dirMetadata.append( ( os.path.join( Transformation_path, 'Log' ), {'outputType':'Log'}, True ) )
+
+    # ## Create the missing directories at once
+    cachedDirs = self.mdCache['Directories']
+    newDirs = [dirPath for dirPath, _dirMD, _keep in dirMetadata if dirPath not in cachedDirs]
+    if newDirs:
+      res = self.fc.createDirectory( newDirs )
       if not res['OK']:
         return res
-      if 'outputType' not in res['Value']:
-        res = self.fcc.setMetadata( path, {'outputType':subdir} )
+      if res['Value']['Failed']:
+        dirPath, error = res['Value']['Failed'].items()[0]
+        return DIRAC.S_ERROR( 'Failed to create directory %s: %s' % ( dirPath, error ) )
+
+    # ## Set the missing metadata at once
+    pathMetadata = {}
+    for dirPath, dirMD, keep in dirMetadata:
+      knownMD = cachedDirs.get( dirPath, {} )
+      missingMD = dict( ( k, v ) for k, v in dirMD.items() if knownMD.get( k ) != v )
+      if missingMD and keep:
+        # Only query the directories which are not cached yet
+        res = self.fcc.getDirectoryUserMetadata( dirPath )
         if not res['OK']:
           return res
+        knownMD = dict( knownMD )
+        knownMD.update( dict( ( k, res['Value'][k] ) for k in dirMD if k in res['Value'] ) )
+        cachedDirs[dirPath] = knownMD
+        missingMD = dict( ( k, v ) for k, v in dirMD.items() if k not in knownMD )
+      if missingMD:
+        pathMetadata[dirPath] = missingMD
+      else:
+        cachedDirs.setdefault( dirPath, knownMD )
 
-    # MD for the Data directory - data_level and configuration_id
-    path = os.path.join(Transformation_path, 'Data')
-    # Set metadata if not already defined
-    res = self.fcc.getDirectoryUserMetadata( path )
-    if not res['OK']:
-      return res
-    if 'data_level' and 'configuration_id' not in res['Value']:
-      res = self.fcc.setMetadata(path, {'data_level': md['data_level'],
-                                        'configuration_id': md['configuration_id']
-                                        })
+    if pathMetadata:
+      res = self.fcc.setMetadataBulk( pathMetadata )
       if not res['OK']:
         return res
-
+      failed = res['Value'].get( 'Failed', {} )
+      if failed:
+        dirPath, error = failed.items()[0]
+        return DIRAC.S_ERROR( 'Failed to set metadata for %s: %s' % ( dirPath, error ) )
+      for dirPath, missingMD in pathMetadata.items():
+        cachedDirs.setdefault( dirPath, {} ).update( missingMD )
+
+    self._saveMDCache()
     return DIRAC.S_OK( Transformation_path )
 
   def putAndRegister( self, lfn, localfile, filemetadata, DataType = 'SimtelProd' ):
     """ put and register one file and set metadata
+
+        The uploads are recorded in the upload statistics, printUploadReport
+        is to be called once all the files are put and registered
     """
     # ## Get the list of Production SE
     res = self._getSEList( 'ProductionOutputs', DataType )
@@ -226,34 +440,221 @@ class Prod3DataManager(object) :
       DIRAC.gLogger.error( 'Failed to upload file to any Production SE: %s' % ProductionSEList )
       # ## Upload file to a Failover SE
       res = self._putAndRegisterToSEList( lfn, localfile, FailoverSEList )
-      if not res['OK']:
-        return DIRAC.S_ERROR( 'Failed to upload file to any Failover SE: %s' % FailoverSEList )
+    if not res['OK']:
+      return DIRAC.S_ERROR( 'Failed to upload file to any Failover SE: %s' % FailoverSEList )
 
     # ## Set file metadata: jobID, subarray, sct
-    if res['OK']:
-      fmd = json.loads( filemetadata )
-      if os.environ.has_key( 'JOBID' ):
-        fmd.update( {'jobID':os.environ['JOBID']} )
-      filename = os.path.basename( localfile )
-      # set subarray and sct md from filename
-      p = re.compile( 'subarray-\d+' )
-      if p.search( filename ) != None:
-        subarray = p.search( filename ).group()
-        fmd.update( {'subarray':subarray} )
-      sct = 'False'
-      p = re.compile( 'nosct' )
-      psct = re.compile( 'sct' )
-      if p.search( filename ) == None and psct.search( filename ) != None:
-        sct = 'True'
-      # ## Set sct flag only for production data
-      res = self.fcc.getFileUserMetadata( lfn )
-      if DataType == 'SimtelProd' and res['Value']['outputType'] == 'Data':
+    fmd = self._getFileMetadata( lfn, localfile, filemetadata, DataType )
+    res = self.fc.setMetadata( lfn, fmd )
+    if not res['OK']:
+      return res
+
+    return DIRAC.S_OK()
+
+  def _getOutputType( self, lfn ):
+    """ get the outputType metadata of the directory of a file
+
+        The outputType is set on the Data and Log directories by createMDStructure,
+        so it is taken from the metadata structure cache when available, and
+        otherwise read once per run directory.
+    """
+    runDir = os.path.dirname( lfn )
+    cachedDirs = self.mdCache['Directories']
+    for dirPath in ( runDir, os.path.dirname( runDir ) ):
+      if 'outputType' in cachedDirs.get( dirPath, {} ):
+        return DIRAC.S_OK( cachedDirs[dirPath]['outputType'] )
+    res = self.fcc.getDirectoryUserMetadata( runDir )
+    if not res['OK']:
+      return res
+    outputType = res['Value'].get( 'outputType' )
+    cachedDirs.setdefault( runDir, {} )['outputType'] = outputType
+    return DIRAC.S_OK( outputType )
+
+  def _getFileMetadata( self, lfn, localfile, filemetadata, DataType = 'SimtelProd' ):
+    """ build the metadata of a registered file: jobID, subarray, sct
+    """
+    fmd = json.loads( filemetadata )
+    if os.environ.has_key( 'JOBID' ):
+      fmd.update( {'jobID':os.environ['JOBID']} )
+    filename = os.path.basename( localfile )
+    # set subarray and sct md from filename
+    match = _SUBARRAY_RE.search( filename )
+    if match != None:
+      fmd.update( {'subarray':match.group()} )
+    # ## Set sct flag only for production data
+    if DataType == 'SimtelProd':
+      res = self._getOutputType( lfn )
+      if res['OK'] and res['Value'] == 'Data':
+        sct = 'False'
+        if _NOSCT_RE.search( filename ) == None and _SCT_RE.search( filename ) != None:
+          sct = 'True'
         fmd.update( {'sct':sct} )
-      res = self.fc.setMetadata( lfn, fmd )
+    return fmd
+
+  def putAndRegisterMany( self, fileList, DataType = 'SimtelProd', nbThreads = 4 ):
+    """ put and register a list of files and set their metadata
+
+        The Production and Failover SE lists are resolved once, the files
+        already in the catalog are skipped as by putAndRegister, the others are
+        uploaded concurrently by nbThreads threads, registered in the catalog
+        in a single call and their metadata are set in a single bulk call.
+
+        fileList is a list of ( lfn, localfile, filemetadata ) tuples,
+        with filemetadata the json string given to putAndRegister
+
+        The upload report is printed and the statistics saved once, at the end of the batch
+    """
+    try:
+      return self.__putAndRegisterMany( fileList, DataType, nbThreads )
+    finally:
+      self.printUploadReport()
+
+  def __putAndRegisterMany( self, fileList, DataType, nbThreads ):
+    """ put and register a list of files, see putAndRegisterMany
+    """
+    if not fileList:
+      return DIRAC.S_OK( [] )
+
+    # ## Get the list of Production SE
+    res = self._getSEList( 'ProductionOutputs', DataType )
+    if res['OK']:
+      ProductionSEList = res['Value']
+    else:
+      return res
+
+    # ## Get the list of Failover SE
+    res = self._getSEList( 'ProductionOutputsFailover', DataType )
+    if res['OK']:
+      FailoverSEList = res['Value']
+    else:
+      return res
+    SEList = ProductionSEList + [SE for SE in FailoverSEList if SE not in ProductionSEList]
+
+    failed = []
+    pool = ThreadPool( max( 1, min( nbThreads, len( fileList ) ) ) )
+    try:
+      # ## Get the size, GUID and checksum of the files concurrently
+      fileInfos = pool.map( lambda fileTuple: self._getFileInfo( fileTuple[1] ), fileList )
+      toUpload = []
+      for ( lfn, localfile, _filemetadata ), res in zip( fileList, fileInfos ):
+        if not res['OK']:
+          DIRAC.gLogger.error( res['Message'], lfn )
+          failed.append( lfn )
+        else:
+          toUpload.append( ( lfn, localfile, res['Value'] ) )
+
+      # ## Check that neither the LFNs nor the GUIDs are in the catalog, as DataManager.putAndRegister
+      if toUpload:
+        res = self.fc.exists( dict( ( lfn, fileInfo[1] ) for lfn, _localfile, fileInfo in toUpload ) )
+        if not res['OK']:
+          return res
+        existing = res['Value']['Successful']
+        for lfn, _localfile, _fileInfo in toUpload:
+          if lfn not in existing:
+            error = 'Failed to determine existence of destination LFN'
+          elif existing[lfn] == lfn:
+            error = 'The supplied LFN already exists in the File Catalog'
+          elif existing[lfn]:
+            error = 'This file GUID already exists for another file %s' % existing[lfn]
+          else:
+            continue
+          DIRAC.gLogger.error( error, lfn )
+          failed.append( lfn )
+        toUpload = [fileTuple for fileTuple in toUpload if fileTuple[0] not in failed]
+
+      # ## Upload the files concurrently
+      results = pool.map( lambda fileTuple: self._putToSEList( fileTuple[0], fileTuple[1], SEList, fileTuple[2] ),
+                          toUpload )
+    finally:
+      pool.terminate()
+
+    fileTuples = []
+    for ( lfn, localfile, _fileInfo ), res in zip( toUpload, results ):
+      if not res['OK']:
+        DIRAC.gLogger.error( 'Failed to upload file to any SE: %s' % SEList, lfn )
+        failed.append( lfn )
+      else:
+        fileTuples.append( res['Value'] )
+
+    # ## Register all uploaded files at once
+    if fileTuples:
+      DIRAC.gLogger.notice( 'Registering %d files' % len( fileTuples ) )
+      res = self.dm.registerFile( fileTuples )
+      registered = res['Value']['Successful'] if res['OK'] else {}
+      unregistered = [fileTuple for fileTuple in fileTuples if fileTuple[0] not in registered]
+      if unregistered:
+        # ## A replica registered in spite of the failure is not removed
+        res = self.fc.getReplicas( [fileTuple[0] for fileTuple in unregistered] )
+        if not res['OK']:
+          DIRAC.gLogger.error( 'Failed to get the replicas of the unregistered files, keeping them', res['Message'] )
+        replicas = res['Value']['Successful'] if res['OK'] else None
+      localFiles = dict( ( lfn, localfile ) for lfn, localfile, _filemetadata in fileList )
+      for lfn, _url, _size, SE, _guid, _checksum in unregistered:
+        if replicas is None or SE in replicas.get( lfn, {} ):
+          DIRAC.gLogger.error( 'Failed to register %s, replica at %s kept' % ( lfn, SE ) )
+          failed.append( lfn )
+          continue
+        # ## Remove the file uploaded above and fall back to the file by file put and register
+        DIRAC.gLogger.error( 'Failed to register %s, trying again file by file' % lfn )
+        res = returnSingleResult( StorageElement( SE ).removeFile( lfn ) )
+        if not res['OK']:
+          DIRAC.gLogger.error( 'Failed to remove %s from %s' % ( lfn, SE ), res['Message'] )
+        res = self._putAndRegisterToSEList( lfn, localFiles[lfn], SEList )
+        if not res['OK']:
+          failed.append( lfn )
+
+    # ## Set the metadata of all registered files at once
+    lfnMetadata = {}
+    for lfn, localfile, filemetadata in fileList:
+      if lfn not in failed:
+        lfnMetadata[lfn] = self._getFileMetadata( lfn, localfile, filemetadata, DataType )
+    if lfnMetadata:
+      res = self.fcc.setMetadataBulk( lfnMetadata )
       if not res['OK']:
         return res
+      for lfn, error in res['Value'].get( 'Failed', {} ).items():
+        DIRAC.gLogger.error( 'Failed to set metadata for %s: %s' % ( lfn, error ) )
+        failed.append( lfn )
 
-      return DIRAC.S_OK()
+    if failed:
+      return DIRAC.S_ERROR( 'Failed to put and register %d files: %s' % ( len( failed ), ', '.join( failed ) ) )
+    return DIRAC.S_OK( [lfn for lfn, _localfile, _filemetadata in fileList] )
+
+  def _getFileInfo( self, localfile ):
+    """ return the ( size, guid, checksum ) of a local file
+    """
+    size = getSize( localfile )
+    if size <= 0:
+      return DIRAC.S_ERROR( 'Local file %s is empty or missing' % localfile )
+    guid = makeGuid( localfile )
+    checksum = fileAdler( localfile )
+    if not checksum:
+      return DIRAC.S_ERROR( 'Unable to calculate checksum of %s' % localfile )
+    return DIRAC.S_OK( ( size, guid, checksum ) )
+
+  def _putToSEList( self, lfn, localfile, SEList, fileInfo ):
+    """ put one file to one SE in the SEList, without registering it
+        fileInfo is the ( size, guid, checksum ) given by _getFileInfo
+        return the file tuple to be given to DataManager.registerFile
+    """
+    size, guid, checksum = fileInfo
+
+    # ## Try to upload file to a SE in the list
+    for SE in SEList:
+      DIRAC.gLogger.notice( 'Try to upload local file: %s \nwith LFN: %s \nto %s' % ( localfile, lfn, SE ) )
+      se = StorageElement( SE )
+      startTime = time.time()
+      res = returnSingleResult( se.putFile( {lfn:localfile} ) )
+      self._recordUpload( SE, res['OK'], size, time.time() - startTime )
+      if res['OK']:
+        res = returnSingleResult( se.getURL( lfn, protocol = self.dm.registrationProtocol ) )
+        if res['OK']:
+          return DIRAC.S_OK( ( lfn, res['Value'], size, se.getStorageElementName()['Value'], guid, checksum ) )
+      DIRAC.gLogger.error( 'Failed to put %s \nto %s \nwith message: %s' % ( lfn, SE, res['Message'] ) )
+      res = returnSingleResult( se.removeFile( lfn ) )
+      if not res['OK']:
+        DIRAC.gLogger.error( 'Failed to remove %s from %s' % ( lfn, SE ), res['Message'] )
+    return DIRAC.S_ERROR( 'Failed to upload %s to any SE' % lfn )
 
   def _putAndRegisterToSEList( self, lfn, localfile, SEList ):
     """ put and register one file to one SE in the SEList
@@ -262,8 +663,11 @@ class Prod3DataManager(object) :
     for SE in SEList:
       msg = 'Try to upload local file: %s \nwith LFN: %s \nto %s' % ( localfile, lfn, SE )
       DIRAC.gLogger.notice( msg )
+      startTime = time.time()
       res = self.dm.putAndRegister( lfn, localfile, SE )
       DIRAC.gLogger.notice(res)
+      self._recordUpload( SE, res['OK'] and lfn not in res['Value']['Failed'],
+                          getSize( localfile ), time.time() - startTime )
       # ##  check if failed
       if not res['OK']:
         DIRAC.gLogger.error( 'Failed to putAndRegister %s \nto %s \nwith message: %s' % ( lfn, SE, res['Message'] ) )
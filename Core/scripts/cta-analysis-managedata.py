@@ -73,15 +73,19 @@ def putAndRegisterPROD3( args ):
     if not res['OK']:
       return res
 
-    for localfile in glob.glob( outputpattern ):
-      filename = os.path.basename( localfile )
-      run_number = getRunNumber( filename, package )
-      runpath = prod3dm._getRunPath( run_number )
-      #lfn = os.path.join( path, 'Data', runpath, filename )
-      lfn = os.path.join( path, outputType, runpath, filename )
-      res = prod3dm.putAndRegister( lfn, localfile, filemetadata, package )
-      if not res['OK']:
-        return res
+    try:
+      for localfile in glob.glob( outputpattern ):
+        filename = os.path.basename( localfile )
+        run_number = getRunNumber( filename, package )
+        runpath = prod3dm._getRunPath( run_number )
+        #lfn = os.path.join( path, 'Data', runpath, filename )
+        lfn = os.path.join( path, outputType, runpath, filename )
+        res = prod3dm.putAndRegister( lfn, localfile, filemetadata, package )
+        if not res['OK']:
+          return res
+    finally:
+      # # Report the uploads once for all the files
+      prod3dm.printUploadReport()
 
     return DIRAC.S_OK()
 
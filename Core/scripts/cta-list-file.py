@@ -42,10 +42,10 @@ import DIRAC
 from DIRAC                                                   import gLogger
 from DIRAC.ConfigurationSystem.Client.Helpers.Registry       import getVOForGroup
 from DIRAC.Core.Security.ProxyInfo                           import getProxyInfo
-from DIRAC.Resources.Catalog.FileCatalog import FileCatalog
+from CTADIRAC.DataManagementSystem.Client.DataManager import DataManager
 from datetime import datetime, timedelta
 import fnmatch
-fc = FileCatalog()
+dm = DataManager()
 
 def isOlderThan( cTimeStruct, days ):
   timeDelta = timedelta( days = days )
@@ -83,38 +83,29 @@ if not baseDir:
 baseDir = baseDir.rstrip( '/' )
 
 gLogger.info( 'Will search for files in %s' % baseDir )
-activeDirs = [baseDir]
 
-allFiles = []
+# The directories are listed in parallel by the catalog walk of the DataManager,
+# and the matched files are written out as they are found, so that the memory
+# footprint does not grow with the number of files
+lfnFileName = '%s.lfns' % baseDir.replace( '/%s' % vo, '%s' % vo ).replace( '/', '-' )
+lfnFile = open( lfnFileName, 'w' )
+nFiles = 0
 allDirs = []
 emptyDirs = []
-while len( activeDirs ) > 0:
-  currentDir = activeDirs[0]
-  res = fc.listDirectory( currentDir, verbose )
-  activeDirs.remove( currentDir )
-  if not res['OK']:
-    gLogger.error( "Error retrieving directory contents", "%s %s" % ( currentDir, res['Message'] ) )
-  elif res['Value']['Failed'].has_key( currentDir ):
-    gLogger.error( "Error retrieving directory contents", "%s %s" % ( currentDir, res['Value']['Failed'][currentDir] ) )
-  else:
-    dirContents = res['Value']['Successful'][currentDir]
-    subdirs = dirContents['SubDirs']
-    empty = True
-    for subdir, metadata in subdirs.items():
-      if ( not verbose ) or isOlderThan( metadata['CreationDate'], totalDays ):
-        activeDirs.append( subdir )
-        allDirs.append( subdir )
-      empty = False
-    for filename, fileInfo in dirContents['Files'].items():
-      metadata = fileInfo['MetaData']
-      if ( not verbose ) or isOlderThan( metadata['CreationDate'], totalDays ):
-        if fnmatch.fnmatch( filename, wildcard ):
-          allFiles.append( filename )
-      empty = False
-    files = dirContents['Files'].keys()
-    gLogger.notice( "%s: %d files, %d sub-directories" % ( currentDir, len( files ), len( subdirs ) ) )
-    if empty:
-      emptyDirs.append( currentDir )
+for currentDir, dirContents in dm.walkCatalogDirectories( [baseDir], verbose = verbose, days = totalDays ):
+  subdirs = dirContents['SubDirs']
+  for subdir, metadata in subdirs.items():
+    if ( not verbose ) or isOlderThan( metadata['CreationDate'], totalDays ):
+      allDirs.append( subdir )
+  for filename, fileInfo in dirContents['Files'].items():
+    metadata = fileInfo['MetaData']
+    if ( not verbose ) or isOlderThan( metadata['CreationDate'], totalDays ):
+      if fnmatch.fnmatch( filename, wildcard ):
+        lfnFile.write( filename + '\n' )
+        nFiles += 1
+  gLogger.notice( "%s: %d files, %d sub-directories" % ( currentDir, len( dirContents['Files'] ), len( subdirs ) ) )
+  if not subdirs and not dirContents['Files']:
+    emptyDirs.append( currentDir )
 
 outputFileName = '%s.dirs' % baseDir.replace( '/%s' % vo, '%s' % vo ).replace( '/', '_' )
 outputFile = open( outputFileName, 'w' )
@@ -123,12 +114,8 @@ for dir in sorted(allDirs, reverse=True):
 outputFile.close()
 gLogger.notice( '%d dirs have been put in %s' % ( len( allDirs ), outputFileName ) )
 
-outputFileName = '%s.lfns' % baseDir.replace( '/%s' % vo, '%s' % vo ).replace( '/', '-' )
-outputFile = open( outputFileName, 'w' )
-for lfn in sorted(allFiles):
-  outputFile.write( lfn + '\n' )
-outputFile.close()
-gLogger.notice( '%d matched files have been put in %s' % ( len( allFiles ), outputFileName ) )
+lfnFile.close()
+gLogger.notice( '%d matched files have been put in %s' % ( nFiles, lfnFileName ) )
 
 if emptyDirsFlag:
   outputFileName = '%s.emptydirs' % baseDir.replace( '/%s' % vo, '%s' % vo ).replace( '/', '-' )
@@ -22,6 +22,8 @@ Script.registerSwitch( "", "energyInfo=", "-2.0_3.0-3.30E3/-2.0_3.0-330E3/-2.0_4
 #Script.registerSwitch( "", "runNumSeries=", "runNumSeries" )
 Script.registerSwitch( "", "offset=", "0" )
 Script.registerSwitch( "", "prodName=", "prodName" )
+Script.registerSwitch( "", "local-index=", "query the local metadata index in this file, e.g. ~/.dfc_index.sqlite" )
+Script.registerSwitch( "", "refresh-index", "refresh the local metadata index before querying it" )
 
 Script.setUsageMessage( '\n'.join( [ __doc__.split( '\n' )[1],
                                      'Usage:',
@@ -44,6 +46,8 @@ phiP = None
 energyInfo = None
 #runNumSeries = None
 offset = None
+indexFile = None
+refreshIndex = False
 metaDict = {}
 
 exitCode = 0
@@ -94,18 +98,20 @@ for switch in Script.getUnprocessedSwitches():
   elif switch[0].lower() == "simtelarrayconfig":
     simtelArrayConfig = switch[1]
     metaDict['simtelArrayConfig'] = simtelArrayConfig
+  elif switch[0].lower() == "local-index":
+    indexFile = switch[1]
+  elif switch[0].lower() == "refresh-index":
+    refreshIndex = True
 
 if metaDict == {}:
   Script.showHelp()
 
-from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
-
-fc = FileCatalogClient()
+from CTADIRAC.DataManagementSystem.Utilities.LocalMetadataIndex import findFilesByMetadata
 
 #print "Metadata query conditions are:"
 #print metaDict
 
-result = fc.findFilesByMetadata(metaDict,path='/',timeout=300)
+result = findFilesByMetadata(metaDict,path='/',indexFile=indexFile,refresh=refreshIndex,timeout=300)
 
 if not result['OK']:
   print 'ERROR %s' % result['Message']
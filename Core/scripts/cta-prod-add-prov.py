@@ -49,7 +49,17 @@ def get_activityDescription_key(cta_activity):
         activityDescription_key = res['Value']['internal_key']
     return activityDescription_key
 
-def add_activity(cta_activity, activityDescription_key, agent_key=None):
+def add_row(graph, row_type, row):
+    """ Append a row to the provenance graph of an activity
+
+    return:
+        the temporary id of the row, to be used as *_key in the next rows
+    """
+    tmp_id = '%s_%d' % (row_type, len(graph))
+    graph.append({'type': row_type, 'tmp_id': tmp_id, 'row': row})
+    return tmp_id
+
+def add_activity(graph, cta_activity, activityDescription_key, agent_key=None):
     current_activity = Activity()
     current_activity.id = cta_activity['activity_uuid']
     current_activity.name = cta_activity['activity_name']
@@ -58,14 +68,8 @@ def add_activity(cta_activity, activityDescription_key, agent_key=None):
     current_activity.comment = ''
     current_activity.activityDescription_key = activityDescription_key
 
-    # Add the activity in yhe database
-    res = provClient.addActivity(current_activity)
-    if not res['OK']:
-        DIRAC.gLogger.error(res['Message'])
-        DIRAC.exit(-1)
-
-    # get the activity internal key
-    activity_key = res["Value"]["internal_key"]
+    # Add the activity in the graph
+    activity_key = add_row(graph, 'Activity', current_activity)
 
     # Association with the agent if specified
     if agent_key:
@@ -73,10 +77,7 @@ def add_activity(cta_activity, activityDescription_key, agent_key=None):
         wAW.agent_key = agent_key
         wAW.activity_key = activity_key
         # wAW.role = ?
-        res = provClient.addWasAssociatedWith(wAW)
-        if not res['OK']:
-            DIRAC.gLogger.error(res['Message'])
-            DIRAC.exit(-1)
+        add_row(graph, 'WasAssociatedWith', wAW)
 
     return activity_key
 
@@ -96,7 +97,7 @@ def get_generationDescription(cta_activity, role):
     else:
         return res
 
-def add_dataset(cta_data, dirac_data, fc, entityDescription_key, agent_key):
+def add_dataset(graph, cta_data, dirac_data, fc, entityDescription_key, agent_key):
 
     local_file = os.path.basename(cta_data['url'])
     for lfn in dirac_data:
@@ -115,25 +116,12 @@ def add_dataset(cta_data, dirac_data, fc, entityDescription_key, agent_key):
                 DIRAC.exit(-1)
             location = res['Value']['Successful'][lfn].keys()
 
-            # Define the DatasetEntity
+            # Define the DatasetEntity, the existing entity of the file
+            # is reused by the service if there is one
             current_file = DatasetEntity(id=filename_uuid, classType='dataset', \
                                          name=lfn, location=location, generatedAtTime=creation_date, \
                                          entityDescription_key=entityDescription_key)
-
-            # Check if the file already exists
-            res = provClient.getDatasetEntity(filename_uuid)
-            if not res['OK']:
-                DIRAC.gLogger.error(res['Message'])
-                DIRAC.exit(-1)
-
-            if res['Value']:
-                entity_key = res['Value']
-            else:
-                res = provClient.addDatasetEntity(current_file)
-                if not res['OK']:
-                    DIRAC.gLogger.error(res['Message'])
-                    DIRAC.exit(-1)
-                entity_key = res['Value']['internal_key']
+            entity_key = add_row(graph, 'DatasetEntity', current_file)
 
             # Association with the agent if specified
             if agent_key:
@@ -141,10 +129,7 @@ def add_dataset(cta_data, dirac_data, fc, entityDescription_key, agent_key):
                 wAT = WasAttributedTo()
                 wAT.agent_key = agent_key
                 wAT.entity_key = entity_key
-                res = provClient.addWasAttributedTo(wAT)
-                if not res['OK']:
-                    DIRAC.gLogger.error(res['Message'])
-                    DIRAC.exit(-1)
+                add_row(graph, 'WasAttributedTo', wAT)
 
             return entity_key
 
@@ -196,14 +181,17 @@ def addProvenance(test_VM=None):
     # For each activity
     for cta_activity in provList:
 
+        # The rows of the activity are sent in a single call
+        graph = []
+
         # get Agent key
         agent_key = get_agent_key(cta_activity)
 
         # get activity description key
         activityDescription_key = get_activityDescription_key(cta_activity)
 
-        # Add the activity in the database and the wasAssociatedWith
-        activity_key = add_activity(cta_activity, activityDescription_key, agent_key)
+        # Add the activity and the wasAssociatedWith
+        activity_key = add_activity(graph, cta_activity, activityDescription_key, agent_key)
 
         # For each input file
         for cta_input in cta_activity['input']:
@@ -214,16 +202,13 @@ def addProvenance(test_VM=None):
             entityDescription_key = dict_usageDescription['entityDescription_key']
 
             # Add the dataset
-            entity_key = add_dataset(cta_input, inputData, fc, entityDescription_key, agent_key)
+            entity_key = add_dataset(graph, cta_input, inputData, fc, entityDescription_key, agent_key)
 
             # Add the Used relationship
             #  time = ?
             used = Used(role=cta_input['role'], activity_key=activity_key, \
                          entity_key=entity_key, usageDescription_key=usageDescription_key)
-            res = provClient.addUsed(used)
-            if not res['OK']:
-                DIRAC.gLogger.error(res['Message'])
-                DIRAC.exit(-1)
+            add_row(graph, 'Used', used)
 
         # For each output file
         for cta_output in cta_activity['output']:
@@ -234,16 +219,12 @@ def addProvenance(test_VM=None):
             entityDescription_key = dict_generationDescription['entityDescription_key']
 
             # Add the dataset
-            entity_key = add_dataset(cta_output, outputData, fc, entityDescription_key, agent_key)
+            entity_key = add_dataset(graph, cta_output, outputData, fc, entityDescription_key, agent_key)
 
             # Add the wasGeneratedBy relationship
             wGB1 = WasGeneratedBy(role=cta_output['role'], activity_key=activity_key, \
                                           entity_key=entity_key, generationDescription_key=generationDescription_key)
-
-            res = provClient.addWasGeneratedBy(wGB1)
-            if not res['OK']:
-                DIRAC.gLogger.error(res['Message'])
-                DIRAC.exit(-1)
+            add_row(graph, 'WasGeneratedBy', wGB1)
 
         # Set the status as an output ValueEntity
         if cta_activity['status']:
@@ -260,21 +241,20 @@ def addProvenance(test_VM=None):
                 current_output_value.value = cta_activity['status']
                 # current_output_value.generatedAtTime =
                 current_output_value.entityDescription_key = entityDescription_key
-
-                res = provClient.addValueEntity(current_output_value)
-                if not res['OK']:
-                    DIRAC.gLogger.error(res['Message'])
-                    DIRAC.exit(-1)
-                entity_key = res['Value']['internal_key']
+                entity_key = add_row(graph, 'ValueEntity', current_output_value)
 
                 # Add the wasGeneratedBy relationship
                 wGB1 = WasGeneratedBy(role='status', activity_key=activity_key, \
                               entity_key=entity_key, generationDescription_key=generationDescription_key)
+                add_row(graph, 'WasGeneratedBy', wGB1)
 
-        res = provClient.addWasGeneratedBy(wGB1)
+        # Insert the whole graph of the activity in one transaction
+        res = provClient.addProvenanceGraph(graph)
         if not res['OK']:
             DIRAC.gLogger.error(res['Message'])
             DIRAC.exit(-1)
+        DIRAC.gLogger.notice('Added %d provenance rows for activity %s' %
+                             (len(graph), cta_activity['activity_uuid']))
         '''
         # For each config parameter
         for cta_config_key, cta_config_value in cta_activity['config']['MuonDisplayerTool'].iteritems():
@@ -300,7 +280,6 @@ def addProvenance(test_VM=None):
 ###############################################################################
 if __name__ == '__main__':
     args = Script.getPositionalArgs()
-exit()
     try:
         provClient = ProvClient()
         res = addProvenance( args )
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+""" Data management script for production, driven by a manifest
+    create DFC MetaData structure put and register files in DFC
+    for several output patterns in a single process, see cta-prod-managedata.py
+
+    The manifest is a JSON list, given as a string or as a file name, of:
+    {"pattern": <local files pattern>, "output_type": <Data, Log, Histograms...>,
+     "file_metadata": <file meta data dictionary>}
+"""
+
+__RCSID__ = "$Id$"
+
+# generic imports
+import os
+import json
+
+# DIRAC imports
+import DIRAC
+from DIRAC.Core.Base import Script
+Script.parseCommandLine()
+
+# Specific DIRAC imports
+from CTADIRAC.Core.Workflow.Modules.Prod3DataManager import Prod3DataManager
+
+# Metadata structure cache, shared by the data management steps of a job
+MD_CACHE_FILE = 'MDStructureCache.json'
+
+
+def load_manifest(manifest):
+    """ load the manifest from a JSON string or a JSON file
+    """
+    if os.path.isfile(manifest):
+        with open(manifest) as manifest_file:
+            return json.load(manifest_file)
+    return json.loads(manifest)
+
+
+def put_and_register_manifest(args):
+    """ put and register all production files of a manifest
+
+    Keyword arguments:
+    args -- a list of arguments in order []
+    """
+    metadata = args[0]
+    metadata_fields = args[1]
+    base_path = args[2]
+    package = args[3]
+    program_category = args[4]
+    catalogs = args[5]
+    manifest = load_manifest(args[6])
+    # optional fingerprint of the meta data fields registered with the transformation
+    fingerprint = args[7] if len(args) > 7 else None
+
+    # Load catalogs
+    catalogs_json = json.loads(catalogs)
+
+    # Create MD structure, once for all the manifest entries
+    prod3dm = Prod3DataManager(catalogs_json, mdCacheFile=MD_CACHE_FILE)
+    result = prod3dm.createMDStructure(metadata, metadata_fields, base_path, program_category,
+                                      fingerprint)
+    if result['OK']:
+        path = result['Value']
+    else:
+        return result
+
+    # Build the list of files of all the manifest entries
+    file_list = []
+    for entry in manifest:
+        output_pattern = entry['pattern']
+        # Check the content of the output directory
+        result = prod3dm._checkemptydir(output_pattern)
+        if not result['OK']:
+            return result
+        file_metadata = json.dumps(entry.get('file_metadata', {}))
+        file_list += prod3dm.getFileList(path, output_pattern, file_metadata,
+                                         package, entry['output_type'])
+    DIRAC.gLogger.notice('%d files to upload for %d patterns' % (len(file_list), len(manifest)))
+
+    # Upload and register all the files at once
+    result = prod3dm.putAndRegisterMany(file_list, package)
+    if not result['OK']:
+        return result
+
+    # Dump the list of output LFNs
+    file = open("output_lfns.txt", 'w')
+    for lfn in result['Value']:
+        file.write(lfn)
+        file.write('\n')
+    file.close()
+
+    return DIRAC.S_OK()
+
+####################################################
+if __name__ == '__main__':
+    args = Script.getPositionalArgs()
+    if len(args) not in [7, 8]:
+        Script.showHelp()
+    try:
+        result = put_and_register_manifest(args)
+        if not result['OK']:
+            DIRAC.gLogger.error(result['Message'])
+            DIRAC.exit(-1)
+        else:
+            DIRAC.gLogger.notice('Done')
+    except Exception:
+        DIRAC.gLogger.exception()
+        DIRAC.exit(-1)
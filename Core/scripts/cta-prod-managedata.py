@@ -9,8 +9,6 @@
 __RCSID__ = "$Id$"
 
 # generic imports
-import os
-import glob
 import json
 
 # DIRAC imports
@@ -19,9 +17,11 @@ from DIRAC.Core.Base import Script
 Script.parseCommandLine()
 
 # Specific DIRAC imports
-from CTADIRAC.Core.Utilities.tool_box import run_number_from_filename
 from CTADIRAC.Core.Workflow.Modules.Prod3DataManager import Prod3DataManager
 
+# Metadata structure cache, shared by the data management steps of a job
+MD_CACHE_FILE = 'MDStructureCache.json'
+
 
 def put_and_register(args):
     """ simple wrapper to put and register all production files
@@ -38,13 +38,16 @@ def put_and_register(args):
     program_category = args[6]
     catalogs = args[7]
     output_type = args[8]
+    # optional fingerprint of the meta data fields registered with the transformation
+    fingerprint = args[9] if len(args) > 9 else None
 
     # Load catalogs
     catalogs_json = json.loads(catalogs)
 
     # Create MD structure
-    prod3dm = Prod3DataManager(catalogs_json)
-    result = prod3dm.createMDStructure(metadata, metadata_fields, base_path, program_category)
+    prod3dm = Prod3DataManager(catalogs_json, mdCacheFile=MD_CACHE_FILE)
+    result = prod3dm.createMDStructure(metadata, metadata_fields, base_path, program_category,
+                                      fingerprint)
     if result['OK']:
         path = result['Value']
     else:
@@ -55,32 +58,21 @@ def put_and_register(args):
     if not result['OK']:
         return result
 
+    # Build the list of files to upload and register
+    file_list = prod3dm.getFileList(path, output_pattern, file_metadata, package, output_type)
+
+    # Upload and register all the files at once
+    result = prod3dm.putAndRegisterMany(file_list, package)
+    if not result['OK']:
+        return result
+
     # Dump the list of output LFNs
     file = open("output_lfns.txt",'w')
-
-    # Loop over each file and upload and register
-    for localfile in glob.glob(output_pattern):
-        file_name = os.path.basename(localfile)
-        # Check run number, assign one as file metadata if needed
-        fmd_dict = json.loads(file_metadata)
-        try:
-            run_number = run_number_from_filename(file_name, package)
-        except:
-            run_number = -9999
-            DIRAC.gLogger.notice('Could not get a correct run number, assigning -9999')
-        fmd_dict['runNumber'] = '%08d' % int(run_number)
-        # get the output file path
-        run_path = prod3dm._getRunPath(fmd_dict)
-        lfn = os.path.join(path, output_type, run_path, file_name)
-        fmd_json = json.dumps(fmd_dict)
-        result = prod3dm.putAndRegister(lfn, localfile, fmd_json, package)
-        if not result['OK']:
-            return result
+    for lfn in result['Value']:
         file.write(lfn)
         file.write('\n')
-
     file.close()
-        
+
     return DIRAC.S_OK()
 
 ####################################################
@@ -21,6 +21,8 @@ Script.registerSwitch( "", "energyInfo=", "-2.0_3.0-330E3/-2.0_4.0-600E3" )
 #Script.registerSwitch( "", "runNumSeries=", "runNumSeries" )
 Script.registerSwitch( "", "offset=", "0" )
 Script.registerSwitch( "", "prodName=", "prodName" )
+Script.registerSwitch( "", "local-index=", "query the local metadata index in this file, e.g. ~/.dfc_index.sqlite" )
+Script.registerSwitch( "", "refresh-index", "refresh the local metadata index before querying it" )
 
 Script.setUsageMessage( '\n'.join( [ __doc__.split( '\n' )[1],
                                      'Usage:',
@@ -42,6 +44,8 @@ phiP = None
 energyInfo = None
 #runNumSeries = None
 offset = None
+indexFile = None
+refreshIndex = False
 metaDict = {}
 
 exitCode = 0
@@ -89,21 +93,23 @@ for switch in Script.getUnprocessedSwitches():
   elif switch[0].lower() == "simtelarrayconfig":
     simtelArrayConfig = switch[1]
     metaDict['simtelArrayConfig'] = simtelArrayConfig
+  elif switch[0].lower() == "local-index":
+    indexFile = switch[1]
+  elif switch[0].lower() == "refresh-index":
+    refreshIndex = True
 
 if metaDict == {}:
   Script.showHelp()
 
 from DIRAC.Resources.Catalog.FileCatalog import FileCatalog
-from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
+from CTADIRAC.DataManagementSystem.Utilities.LocalMetadataIndex import findFilesByMetadata
 
 fcD = FileCatalog('DIRACFileCatalog')
 
-fc = FileCatalogClient()
-
 #print "Metadata query conditions are:"
 #print metaDict
 
-result = fc.findFilesByMetadata(metaDict,path='/',rpc='',url='',timeout=300)
+result = findFilesByMetadata(metaDict,path='/',indexFile=indexFile,refresh=refreshIndex,timeout=300)
 
 if not result['OK']:
   print 'ERROR %s' % result['Message']
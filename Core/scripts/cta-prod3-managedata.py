@@ -15,6 +15,7 @@ from DIRAC.Core.Base import Script
 Script.parseCommandLine()
 
 # Specific DIRAC imports
+from DIRAC.ConfigurationSystem.Client.Helpers.Operations import Operations
 from CTADIRAC.Core.Workflow.Modules.Prod3DataManager import Prod3DataManager
 
 ####################################################
@@ -57,21 +58,29 @@ def putAndRegisterPROD3(args):
     # runpath = prod3dm._getRunPath( fmdjson )
     runpath = prod3dm._getRunPath( fmd )
 
+    fileList = []
     for localfile in glob.glob( datadir ):
       filename = os.path.basename( localfile )
       lfn = os.path.join( path, 'Data', runpath, filename )
-      res = prod3dm.putAndRegister( lfn, localfile, fmdjson )
-      if not res['OK']:
-        return res
+      fileList.append( ( lfn, localfile, fmdjson ) )
+    # ## Upload and register all data files, and set their metadata at once
+    res = prod3dm.putAndRegisterMany( fileList )
+    if not res['OK']:
+      return res
 
     # ## Upload log files
-    tarname = filename.split( '___cta-prod3' )[0] + '.tar.gz'
-    res = prod3dm.createTarLogFiles( inputpath, tarname )
+    # ## Compression of the log tarball, gzip by default
+    codec = Operations().getValue( 'ProductionOutputs/LogTarCodec', 'gzip' )
+    level = Operations().getValue( 'ProductionOutputs/LogTarLevel', 0 ) or None
+    extension = { 'zstd' : '.tar.zst' }.get( codec, '.tar.gz' )
+    tarname = filename.split( '___cta-prod3' )[0] + extension
+    res = prod3dm.createTarLogFiles( inputpath, tarname, codec, level )
     if not res['OK']:
       return DIRAC.S_ERROR( 'prod3dm.createTarLogFiles failed' )
     lfn = os.path.join( path, 'Log', runpath, tarname )
     # res = prod3dm.putAndRegister( lfn, tarname, filemetadata )
     res = prod3dm.putAndRegister( lfn, tarname, fmdjson )
+    prod3dm.printUploadReport()
     if not res['OK']:
       return res
 
@@ -28,11 +28,13 @@ Script.registerSwitch( "", "thetaP=", "e.g. 20" )
 Script.registerSwitch( "", "phiP=", "e.g. 0,180" )
 Script.registerSwitch( "", "sct=", "e.g. True,False" )
 Script.registerSwitch( "", "outputType=", "e.g. Data,Log" )
+Script.registerSwitch( "", "local-index=", "query the local metadata index in this file, e.g. ~/.dfc_index.sqlite" )
+Script.registerSwitch( "", "refresh-index", "refresh the local metadata index before querying it" )
 
 
 Script.parseCommandLine( ignoreErrors = True )
 
-from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
+from CTADIRAC.DataManagementSystem.Utilities.LocalMetadataIndex import findFilesByMetadata
 
 if len( Script.getUnprocessedSwitches() ) == 0:
   Script.showHelp()
@@ -40,6 +42,8 @@ if len( Script.getUnprocessedSwitches() ) == 0:
 # ## Set default for MCCampaign
 metaDict = {}
 metaDict['MCCampaign'] = 'PROD3'
+indexFile = None
+refreshIndex = False
 
 for switch in Script.getUnprocessedSwitches():
   if switch[0].lower() == "site":
@@ -72,10 +76,13 @@ for switch in Script.getUnprocessedSwitches():
     metaDict['sct'] = switch[1]
   elif switch[0].lower() == "outputtype":
     metaDict['outputType'] = switch[1]
+  elif switch[0].lower() == "local-index":
+    indexFile = switch[1]
+  elif switch[0].lower() == "refresh-index":
+    refreshIndex = True
 
-fc = FileCatalogClient()
-
-res = fc.findFilesByMetadata( metaDict, path = '/', timeout = 300 )
+res = findFilesByMetadata( metaDict, path = '/', indexFile = indexFile,
+                           refresh = refreshIndex, timeout = 300 )
 
 if not res['OK']:
   DIRAC.gLogger.error ( res['Message'] )
@@ -10,17 +10,21 @@ This module consists of DataManager and related classes.
 """
 
 # # imports
+from collections import deque
 from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
 import fnmatch
 import os
+import threading
 import time
 import errno
+import zlib
 
 # # from DIRAC
 import DIRAC
 from DIRAC import S_OK, S_ERROR, gLogger, gConfig
 from DIRAC.Core.Utilities import DErrno
-from DIRAC.Core.Utilities.Adler import fileAdler, compareAdler
+from DIRAC.Core.Utilities.Adler import fileAdler, compareAdler, intAdlerToHex
 from DIRAC.Core.Utilities.File import makeGuid, getSize
 from DIRAC.Core.Utilities.List import randomize, breakListIntoChunks
 from DIRAC.Core.Utilities.ReturnValues import returnSingleResult
@@ -33,9 +37,16 @@ from DIRAC.Resources.Catalog.FileCatalog import FileCatalog
 from DIRAC.Resources.Storage.StorageElement import StorageElement
 from DIRAC.ResourceStatusSystem.Client.ResourceStatus import ResourceStatus
 
+# # from CTADIRAC
+from CTADIRAC.DataManagementSystem.Utilities.SETransferStats import SETransferStats
+
 # # RSCID
 __RCSID__ = "e88824a (2017-01-27 10:42:21 +0100) Philippe Charpentier <Philippe.Charpentier@cern.ch>"
 
+# Per process cache of the SEs at a site and in its country,
+# { site name : ( time, ( site SEs, country SEs ) ) }
+_siteSEsCache = {}
+
 def _isOlderThan( stringTime, days ):
   timeDelta = timedelta( days = days )
   maxCTime = datetime.utcnow() - timeDelta
@@ -46,6 +57,62 @@ def _isOlderThan( stringTime, days ):
     return True
   return False
 
+class _DownloadAdler( threading.Thread ):
+  """ Compute the Adler32 checksum of a file while it is being downloaded, by following
+      the data appended to it, which are still in the page cache, instead of reading
+      the whole file again once the download is over
+  """
+
+  def __init__( self, fileName, blockSize = 16 * 1024 * 1024, pollTime = 0.1 ):
+    threading.Thread.__init__( self )
+    self.daemon = True
+    self.fileName = fileName
+    self.blockSize = blockSize
+    self.pollTime = pollTime
+    self.__done = threading.Event()
+    self.__adler = 1
+    self.__size = 0
+    self.__inode = None
+    self.start()
+
+  def run( self ):
+    try:
+      while not os.path.exists( self.fileName ):
+        if self.__done.is_set():
+          return
+        self.__done.wait( self.pollTime )
+      with open( self.fileName, 'rb' ) as localFile:
+        self.__inode = os.fstat( localFile.fileno() ).st_ino
+        while True:
+          # The download is over once the end of the file is reached after it is done
+          done = self.__done.is_set()
+          data = localFile.read( self.blockSize )
+          if data:
+            self.__adler = zlib.adler32( data, self.__adler )
+            self.__size += len( data )
+          elif done:
+            return
+          else:
+            self.__done.wait( self.pollTime )
+    except ( IOError, OSError ):
+      self.__inode = None
+
+  def getChecksum( self ):
+    """ stop following the file once the download is over
+
+    :return: the checksum, None if the file could not be followed,
+             e.g. it was written under another name and renamed
+    """
+    self.__done.set()
+    self.join()
+    try:
+      fileStat = os.stat( self.fileName )
+    except OSError:
+      return None
+    if self.__inode != fileStat.st_ino or self.__size != fileStat.st_size:
+      return None
+    return intAdlerToHex( self.__adler & 0xffffffff )
+
 def _initialiseAccountingObject( operation, se, files ):
   """ create accouting record """
   accountingDict = {}
@@ -102,6 +169,36 @@ class DataManager( object ):
     self.dmsHelper = DMSHelpers( vo = vo )
     self.registrationProtocol = self.dmsHelper.getRegistrationProtocols()
     self.thirdPartyProtocols = self.dmsHelper.getThirdPartyProtocols()
+    # Parameters of the parallel catalog walker
+    self.catalogListingThreads = Operations( self.vo ).getValue( 'DataManagement/CatalogListingThreads', 4 )
+    self.listDirectoryChunkSize = Operations( self.vo ).getValue( 'DataManagement/ListDirectoryChunkSize', 100 )
+    # Number of folders, and of SEs per folder, cleaned concurrently
+    self.cleaningThreads = Operations( self.vo ).getValue( 'DataManagement/CleaningThreads', 4 )
+    # Number of concurrent downloads in getFile, overall and per source SE
+    self.getFileThreads = Operations( self.vo ).getValue( 'DataManagement/GetFileThreads', 4 )
+    self.getFileThreadsPerSE = Operations( self.vo ).getValue( 'DataManagement/GetFileThreadsPerSE', 2 )
+    self.__seSemaphores = {}
+    self.__seSemaphoresLock = threading.Lock()
+    # Order the replicas by observed transfer rate rather than randomly
+    self.rankSEProximity = Operations( self.vo ).getValue( 'DataManagement/SEProximityRanking', False )
+    statsFile = None
+    if self.rankSEProximity:
+      statsFile = os.path.expanduser( Operations( self.vo ).getValue( 'DataManagement/SEStatsFile',
+                                                                      '~/.dirac_se_stats.json' ) )
+    self.seTransferStats = SETransferStats( statsFile )
+    # Per thread pool of StorageElement objects, which are not thread safe,
+    # released with their thread, and cache of the SE status and flags
+    self.seCacheTTL = Operations( self.vo ).getValue( 'DataManagement/SECacheTTL', 300 )
+    self.__seObjects = threading.local()
+    self.__seStatusCache = {}
+    self.__seFlagsCache = {}
+    self.__seCacheLock = threading.Lock()
+    self.seCacheCounters = { 'Hits' : 0, 'Misses' : 0 }
+    # Number of concurrent transfers in replicateAndRegisterMany, overall and per ( source, destination ) pair
+    self.replicationThreads = Operations( self.vo ).getValue( 'DataManagement/ReplicationThreads', 4 )
+    self.replicationThreadsPerPair = Operations( self.vo ).getValue( 'DataManagement/ReplicationThreadsPerPair', 2 )
+    # Number of concurrent getURL calls in getReplicas
+    self.getURLThreads = Operations( self.vo ).getValue( 'DataManagement/GetURLThreads', 4 )
 
   def setAccountingClient( self, client ):
     """ Set Accounting Client instance
@@ -133,28 +230,55 @@ class DataManager( object ):
   # These are the bulk removal methods
   #
 
-  def cleanLogicalDirectory( self, lfnDir ):
+  def cleanLogicalDirectory( self, lfnDir, skipEmptySEs = False ):
     """ Clean the logical directory from the catalog and storage
+
+    Several folders are cleaned concurrently, and for each folder the storage
+    directories are removed concurrently at all the SEs of SE_Cleaning_List.
+    The Successful dictionary gives for each folder the per SE cleaning statistics.
+
+    :param self: self reference
+    :param mixed lfnDir: directory name or list of directory names
+    :param bool skipEmptySEs: only clean the storage at the SEs where the catalog had replicas
     """
     log = self.log.getSubLogger( 'cleanLogicalDirectory' )
     if isinstance( lfnDir, basestring ):
       lfnDir = [ lfnDir ]
     retDict = { "Successful" : {}, "Failed" : {} }
-    for folder in lfnDir:
-      res = self.__cleanDirectory( folder )
+    if not lfnDir:
+      return S_OK( retDict )
+    pool = ThreadPool( max( 1, min( self.cleaningThreads, len( lfnDir ) ) ) )
+    try:
+      results = pool.map( lambda folder: ( folder, self.__cleanDirectory( folder, skipEmptySEs = skipEmptySEs ) ),
+                          lfnDir )
+    finally:
+      pool.terminate()
+
+    seReport = {}
+    for folder, res in results:
       if not res['OK']:
         log.debug( "Failed to clean directory.", "%s %s" % ( folder, res['Message'] ) )
         retDict["Failed"][folder] = res['Message']
       else:
         log.debug( "Successfully removed directory.", folder )
         retDict["Successful"][folder] = res['Value']
+        for storageElement, seStats in res['Value'].iteritems():
+          seTotal = seReport.setdefault( storageElement, { 'FilesRemoved' : 0, 'Time' : 0. } )
+          seTotal['FilesRemoved'] += seStats['FilesRemoved']
+          seTotal['Time'] += seStats['Time']
+    for storageElement in sorted( seReport ):
+      seTotal = seReport[storageElement]
+      log.info( "Storage cleaning throughput",
+                "%s: %d files in %.1f s (%.1f files/s)" % ( storageElement, seTotal['FilesRemoved'], seTotal['Time'],
+                                                            seTotal['FilesRemoved'] / max( seTotal['Time'], 1e-3 ) ) )
     return S_OK( retDict )
 
-  def __cleanDirectory( self, folder ):
+  def __cleanDirectory( self, folder, skipEmptySEs = False ):
     """ delete all files from directory :folder: in FileCatalog and StorageElement
 
     :param self: self reference
     :param str folder: directory name
+    :param bool skipEmptySEs: only clean the storage at the SEs where the catalog had replicas
     """
     log = self.log.getSubLogger( '__cleanDirectory' )
     res = self.__hasAccess( 'removeDirectory', folder )
@@ -164,31 +288,48 @@ class DataManager( object ):
       errStr = "Write access not permitted for this credential."
       log.debug( errStr, folder )
       return S_ERROR( errStr )
-    res = self.__getCatalogDirectoryContents( [ folder ] )
-    if not res['OK']:
-      return res
-    res = self.removeFile( res['Value'] )
-    if not res['OK']:
-      return res
-    for lfn, reason in res['Value']['Failed'].iteritems():
-      log.error( "Failed to remove file found in the catalog", "%s %s" % ( lfn, reason ) )
+    # Remove the files while the catalog walk is still going on
+    # The replica information is only needed to know which SEs are used
+    usedSEs = set()
+    for fileChunk in self.iterFilesFromDirectory( folder, verbose = skipEmptySEs ):
+      if skipEmptySEs:
+        for _lfn, metadata in fileChunk:
+          usedSEs.update( metadata.get( 'Replicas', {} ) )
+      res = self.removeFile( [ lfn for lfn, _metadata in fileChunk ] )
+      if not res['OK']:
+        return res
+      for lfn, reason in res['Value']['Failed'].iteritems():
+        log.error( "Failed to remove file found in the catalog", "%s %s" % ( lfn, reason ) )
     res = returnSingleResult( self.removeFile( [ '%s/dirac_directory' % folder ] ) )
     if not res['OK']:
       if not "No such file" in res['Message']:
         log.warn( 'Failed to delete dirac_directory placeholder file' )
 
     storageElements = gConfig.getValue( 'Resources/StorageElementGroups/SE_Cleaning_List', [] )
+    if skipEmptySEs:
+      skippedSEs = [ se for se in storageElements if se not in usedSEs ]
+      if skippedSEs:
+        log.debug( "No replica in the catalog, skip storage cleaning at", ', '.join( sorted( skippedSEs ) ) )
+      storageElements = [ se for se in storageElements if se in usedSEs ]
+    seStats = {}
     failed = False
-    for storageElement in sorted( storageElements ):
-      res = self.__removeStorageDirectory( folder, storageElement )
-      if not res['OK']:
-        failed = True
+    if storageElements:
+      pool = ThreadPool( max( 1, min( self.cleaningThreads, len( storageElements ) ) ) )
+      try:
+        results = pool.map( lambda se: ( se, self.__removeStorageDirectory( folder, se ) ), sorted( storageElements ) )
+      finally:
+        pool.terminate()
+      for storageElement, res in results:
+        if not res['OK']:
+          failed = True
+        else:
+          seStats[storageElement] = res['Value']
     if failed:
       return S_ERROR( "Failed to clean storage directory at all SEs" )
     res = returnSingleResult( self.fc.removeDirectory( folder, recursive = True ) )
     if not res['OK']:
       return res
-    return S_OK()
+    return S_OK( seStats )
 
   def __removeStorageDirectory( self, directory, storageElement ):
     """ delete SE directory
@@ -196,8 +337,9 @@ class DataManager( object ):
     :param self: self reference
     :param str directory: folder to be removed
     :param str storageElement: DIRAC SE name
+    :return: S_OK( { 'FilesRemoved' : int, 'Time' : float } )
     """
-
+    startTime = time.time()
     se = StorageElement( storageElement, vo = self.vo )
     res = returnSingleResult( se.exists( directory ) )
 
@@ -209,17 +351,70 @@ class DataManager( object ):
     exists = res['Value']
     if not exists:
       log.debug( "The directory %s does not exist at %s " % ( directory, storageElement ) )
-      return S_OK()
+      return S_OK( { 'FilesRemoved' : 0, 'Time' : time.time() - startTime } )
 
     res = returnSingleResult( se.removeDirectory( directory, recursive = True ) )
     if not res['OK']:
       log.debug( "Failed to remove storage directory", res['Message'] )
       return res
 
-    log.debug( "Successfully removed %d files from %s at %s" % ( res['Value']['FilesRemoved'],
+    filesRemoved = res['Value']['FilesRemoved']
+    log.debug( "Successfully removed %d files from %s at %s" % ( filesRemoved,
                                                                  directory,
                                                                  storageElement ) )
-    return S_OK()
+    return S_OK( { 'FilesRemoved' : filesRemoved, 'Time' : time.time() - startTime } )
+
+  def __listDirectoryChunk( self, dirChunk, verbose ):
+    """ list a chunk of directories with a single bulk catalog call
+
+    :param self: self reference
+    :param list dirChunk: directory names
+    :param bool verbose: get the file metadata as well
+    """
+    return dirChunk, self.fc.listDirectory( dirChunk, verbose = verbose )
+
+  def walkCatalogDirectories( self, directories, verbose = False, days = 0 ):
+    """ generator walking the catalog breadth first, one level of the tree at a time
+
+    Each level is listed with bulk listDirectory calls of listDirectoryChunkSize
+    directories, spread over catalogListingThreads threads. The ( directory, contents )
+    pairs are yielded as soon as their chunk is listed, so the caller can start
+    working before the walk is over. It is used by iterFilesFromDirectory and
+    walkFilesFromDirectory, and by the callers that also need the directories.
+
+    :param self: self reference
+    :param list directories: folder names
+    :param bool verbose: get the file metadata as well
+    :param int days: only descend into sub-directories older than :days: days
+    """
+    log = self.log.getSubLogger( 'walkCatalogDirectories' )
+    frontier = deque( directories )
+    pool = ThreadPool( max( 1, self.catalogListingThreads ) )
+    try:
+      while frontier:
+        level = list( frontier )
+        frontier.clear()
+        log.debug( "Listing %d directories" % len( level ) )
+        dirChunks = breakListIntoChunks( level, self.listDirectoryChunkSize )
+        for dirChunk, res in pool.imap_unordered( lambda chunk: self.__listDirectoryChunk( chunk, verbose ),
+                                                  dirChunks ):
+          if not res['OK']:
+            for currentDir in dirChunk:
+              log.debug( "Error retrieving directory contents", "%s %s" % ( currentDir, res['Message'] ) )
+            continue
+          for currentDir, reason in res['Value']['Failed'].iteritems():
+            log.debug( "Error retrieving directory contents", "%s %s" % ( currentDir, reason ) )
+          for currentDir, dirContents in res['Value']['Successful'].iteritems():
+            subdirs = dirContents['SubDirs']
+            log.debug( "%s: %d files, %d sub-directories" % ( currentDir, len( dirContents['Files'] ), len( subdirs ) ) )
+            for subdir in subdirs:
+              if ( not days ) or _isOlderThan( subdirs[subdir]['CreationDate'], days ):
+                if subdir[0] != '/':
+                  subdir = currentDir + '/' + subdir
+                frontier.append( subdir )
+            yield currentDir, dirContents
+    finally:
+      pool.terminate()
 
   def __getCatalogDirectoryContents( self, directories ):
     """ ls recursively all files in directories
@@ -229,43 +424,76 @@ class DataManager( object ):
     """
     log = self.log.getSubLogger( '__getCatalogDirectoryContents' )
     log.debug( 'Obtaining the catalog contents for %d directories:' % len( directories ) )
-    activeDirs = directories
     allFiles = {}
-    while len( activeDirs ) > 0:
-      currentDir = activeDirs[0]
-      res = returnSingleResult( self.fc.listDirectory( currentDir, verbose = True ) )
-      activeDirs.remove( currentDir )
-
-      if not res['OK']:
-        log.debug( "Problem getting the %s directory content" % currentDir, res['Message'] )
-      else:
-        dirContents = res['Value']
-        activeDirs.extend( dirContents['SubDirs'] )
-        allFiles.update( dirContents['Files'] )
+    for fileChunk in self.iterFilesFromDirectory( directories ):
+      allFiles.update( fileChunk )
 
     log.debug( "Found %d files" % len( allFiles ) )
     return S_OK( allFiles )
 
+  def iterFilesFromDirectory( self, directory, chunkSize = 1000, verbose = True ):
+    """ generator over all files in :directory: and its sub-directories
 
-  def getReplicasFromDirectory( self, directory ):
-    """ get all replicas from a given directory
+    Yields lists of at most :chunkSize: ( lfn, metadata ) tuples, with metadata
+    as returned by listDirectory, so that only one chunk is held in memory
 
     :param self: self reference
     :param mixed directory: list of directories or one directory
+    :param int chunkSize: maximum number of files per yielded chunk
+    :param bool verbose: get the full file metadata, including the replicas
     """
     if isinstance( directory, basestring ):
       directories = [directory]
     else:
       directories = directory
-    res = self.__getCatalogDirectoryContents( directories )
-    if not res['OK']:
-      return res
-    allReplicas = dict( ( lfn, metadata['Replicas'] ) for lfn, metadata in res['Value'].iteritems() )
+    fileChunk = []
+    for _currentDir, dirContents in self.walkCatalogDirectories( directories, verbose = verbose ):
+      for lfn, metadata in dirContents['Files'].iteritems():
+        fileChunk.append( ( lfn, metadata ) )
+        if len( fileChunk ) >= chunkSize:
+          yield fileChunk
+          fileChunk = []
+    if fileChunk:
+      yield fileChunk
+
+  def iterReplicasFromDirectory( self, directory, chunkSize = 1000 ):
+    """ generator over all replicas in :directory: and its sub-directories
+
+    Yields lists of at most :chunkSize: ( lfn, replicas ) tuples, see iterFilesFromDirectory
+
+    :param self: self reference
+    :param mixed directory: list of directories or one directory
+    :param int chunkSize: maximum number of files per yielded chunk
+    """
+    for fileChunk in self.iterFilesFromDirectory( directory, chunkSize = chunkSize ):
+      yield [ ( lfn, metadata['Replicas'] ) for lfn, metadata in fileChunk ]
+
+  def getReplicasFromDirectory( self, directory ):
+    """ get all replicas from a given directory
+
+    :param self: self reference
+    :param mixed directory: list of directories or one directory
+    """
+    allReplicas = {}
+    for replicaChunk in self.iterReplicasFromDirectory( directory ):
+      allReplicas.update( replicaChunk )
     return S_OK( allReplicas )
 
   def getFilesFromDirectory( self, directory, days = 0, wildcard = '*' ):
     """ get all files from :directory: older than :days: days matching to :wildcard:
 
+    :param self: self reference
+    :param mixed directory: list of directories or directory name
+    :param int days: ctime days
+    :param str wildcard: pattern to match
+    """
+    return S_OK( list( self.walkFilesFromDirectory( directory, days = days, wildcard = wildcard ) ) )
+
+  def walkFilesFromDirectory( self, directory, days = 0, wildcard = '*' ):
+    """ generator over all files from :directory: older than :days: days matching to :wildcard:
+
+    LFNs are yielded while the catalog is being walked, see getFilesFromDirectory
+
     :param self: self reference
     :param mixed directory: list of directories or directory name
     :param int days: ctime days
@@ -275,47 +503,34 @@ class DataManager( object ):
       directories = [directory]
     else:
       directories = directory
-    log = self.log.getSubLogger( 'getFilesFromDirectory' )
+    log = self.log.getSubLogger( 'walkFilesFromDirectory' )
     log.debug( "Obtaining the files older than %d days in %d directories:" % ( days, len( directories ) ) )
     for folder in directories:
       log.debug( folder )
-    activeDirs = directories
-    allFiles = []
-    while len( activeDirs ) > 0:
-      currentDir = activeDirs[0]
-      # We only need the metadata (verbose) if a limit date is given
-      res = returnSingleResult( self.fc.listDirectory( currentDir, verbose = ( days != 0 ) ) )
-      activeDirs.remove( currentDir )
-      if not res['OK']:
-        log.debug( "Error retrieving directory contents", "%s %s" % ( currentDir, res['Message'] ) )
-      else:
-        dirContents = res['Value']
-        subdirs = dirContents['SubDirs']
-        files = dirContents['Files']
-        log.debug( "%s: %d files, %d sub-directories" % ( currentDir, len( files ), len( subdirs ) ) )
-        for subdir in subdirs:
-          if ( not days ) or _isOlderThan( subdirs[subdir]['CreationDate'], days ):
-            if subdir[0] != '/':
-              subdir = currentDir + '/' + subdir
-            activeDirs.append( subdir )
-        for fileName in files:
-          fileInfo = files[fileName]
-          fileInfo = fileInfo.get( 'Metadata', fileInfo )
-          if ( not days ) or not fileInfo.get( 'CreationDate' ) or _isOlderThan( fileInfo['CreationDate'], days ):
-            if wildcard == '*' or fnmatch.fnmatch( fileName, wildcard ):
-              fileName = fileInfo.get( 'LFN', fileName )
-              allFiles.append( fileName )
-    return S_OK( allFiles )
+    # We only need the metadata (verbose) if a limit date is given
+    for _currentDir, dirContents in self.walkCatalogDirectories( directories, verbose = ( days != 0 ), days = days ):
+      files = dirContents['Files']
+      for fileName in files:
+        fileInfo = files[fileName]
+        fileInfo = fileInfo.get( 'Metadata', fileInfo )
+        if ( not days ) or not fileInfo.get( 'CreationDate' ) or _isOlderThan( fileInfo['CreationDate'], days ):
+          if wildcard == '*' or fnmatch.fnmatch( fileName, wildcard ):
+            yield fileInfo.get( 'LFN', fileName )
 
   ##########################################################################
   #
   # These are the data transfer methods
   #
 
-  def getFile( self, lfn, destinationDir = '', sourceSE = None ):
+  def getFile( self, lfn, destinationDir = '', sourceSE = None, nbThreads = None ):
     """ Get a local copy of a LFN from Storage Elements.
 
         'lfn' is the logical file name for the desired file
+
+        Several files are downloaded concurrently by :nbThreads: threads
+        (default DataManagement/GetFileThreads), with at most
+        DataManagement/GetFileThreadsPerSE downloads from the same SE.
+        For each file the SEs are tried in the _getSEProximity order.
     """
     log = self.log.getSubLogger( 'getFile' )
     if isinstance( lfn, list ):
@@ -338,15 +553,44 @@ class DataManager( object ):
     failed.update( res['Value']['Failed'] )
     fileMetadata = res['Value']['Successful']
     successful = {}
-    for lfn in fileMetadata:
-      res = self.__getFile( lfn, lfnReplicas[lfn], fileMetadata[lfn], destinationDir, sourceSE = sourceSE )
+
+    if nbThreads is None:
+      nbThreads = self.getFileThreads
+    nbThreads = max( 1, min( nbThreads, len( fileMetadata ) ) )
+    getOneFile = lambda lfn: ( lfn, self.__getFile( lfn, lfnReplicas[lfn], fileMetadata[lfn],
+                                                    destinationDir, sourceSE = sourceSE ) )
+    if nbThreads == 1:
+      results = [ getOneFile( lfn ) for lfn in fileMetadata ]
+    else:
+      log.debug( "Downloading %d files with %d threads" % ( len( fileMetadata ), nbThreads ) )
+      pool = ThreadPool( nbThreads )
+      try:
+        results = pool.map( getOneFile, list( fileMetadata ) )
+      finally:
+        pool.terminate()
+    for lfn, res in results:
       if not res['OK']:
         failed[lfn] = res['Message']
       else:
         successful[lfn] = res['Value']
+    if self.rankSEProximity:
+      self.seTransferStats.save()
 
     return S_OK( { 'Successful': successful, 'Failed' : failed } )
 
+  def __getSESemaphore( self, seName, limit = None ):
+    """ get the semaphore limiting the number of concurrent transfers with an SE, or a pair of SEs
+
+    :param self: self reference
+    :param mixed seName: DIRAC SE name or tuple of SE names
+    :param int limit: number of concurrent transfers, default getFileThreadsPerSE
+    """
+    with self.__seSemaphoresLock:
+      if seName not in self.__seSemaphores:
+        limit = self.getFileThreadsPerSE if limit is None else limit
+        self.__seSemaphores[seName] = threading.BoundedSemaphore( max( 1, limit ) )
+      return self.__seSemaphores[seName]
+
   def __getFile( self, lfn, replicas, metadata, destinationDir, sourceSE = None ):
 
     log = self.log.getSubLogger( '__getFile' )
@@ -364,17 +608,30 @@ class DataManager( object ):
       else:
         sortedSEs = [sourceSE]
 
+    localFile = os.path.realpath( os.path.join( destinationDir, os.path.basename( lfn ) ) )
     for storageElementName in sortedSEs:
-      se = StorageElement( storageElementName, vo = self.vo )
+      se = self.__getStorageElement( storageElementName )
 
-      res = returnSingleResult( se.getFile( lfn, localPath = os.path.realpath( destinationDir ) ) )
+      with self.__getSESemaphore( storageElementName ):
+        # The checksum is computed during the download, unless the file is already there
+        downloadAdler = None
+        if metadata['Checksum'] and not os.path.exists( localFile ):
+          downloadAdler = _DownloadAdler( localFile )
+        startTime = time.time()
+        res = returnSingleResult( se.getFile( lfn, localPath = os.path.realpath( destinationDir ) ) )
+        transferTime = time.time() - startTime
+        localAdler = downloadAdler.getChecksum() if downloadAdler else None
 
       if not res['OK']:
         errTuple = ( "Error getting file from storage:", "%s from %s, %s" % ( lfn, storageElementName, res['Message'] ) )
         errToReturn = res
+        self.seTransferStats.addTransfer( storageElementName, False )
       else:
-        localFile = os.path.realpath( os.path.join( destinationDir, os.path.basename( lfn ) ) )
-        localAdler = fileAdler( localFile )
+        # The local file is only read back if the size is right, there is a catalog checksum,
+        # and the checksum computed during the download is missing or does not match
+        if metadata['Size'] == res['Value'] and metadata['Checksum'] and \
+           ( localAdler is None or not compareAdler( metadata['Checksum'], localAdler ) ):
+          localAdler = fileAdler( localFile )
 
         if metadata['Size'] != res['Value']:
           errTuple = ( "Mismatch of sizes:", "downloaded = %d, catalog = %d" % ( res['Value'], metadata['Size'] ) )
@@ -385,7 +642,9 @@ class DataManager( object ):
           errTuple = ( "Mismatch of checksums:", "downloaded = %s, catalog = %s" % ( localAdler, metadata['Checksum'] ) )
           errToReturn = S_ERROR( DErrno.EBADCKS, errTuple[1] )
         else:
+          self.seTransferStats.addTransfer( storageElementName, True, size = res['Value'], elapsed = transferTime )
           return S_OK( localFile )
+        self.seTransferStats.addTransfer( storageElementName, False )
       # If we are here, there was an error, log it debug level
       log.debug( errTuple[0], errTuple[1] )
 
@@ -396,18 +655,44 @@ class DataManager( object ):
     return errToReturn
 
 
+  def __getSiteSEs( self, siteName ):
+    """ get the SEs at a site and in its country, cached per process for seCacheTTL,
+        the failed lookups are not cached """
+    cached = _siteSEsCache.get( siteName )
+    if cached and time.time() - cached[0] < self.seCacheTTL:
+      return cached[1]
+    res = self.dmsHelper.getSEsAtSite( siteName )
+    if not res['OK']:
+      self.log.warn( 'Failed to get the SEs at site', '%s: %s' % ( siteName, res['Message'] ) )
+      return [], []
+    siteSEs = list( res['Value'] )
+    countryCode = str( siteName ).split( '.' )[-1]
+    res = self.dmsHelper.getSEsAtCountry( countryCode )
+    if not res['OK']:
+      self.log.warn( 'Failed to get the SEs in country', '%s: %s' % ( countryCode, res['Message'] ) )
+      return siteSEs, []
+    siteCountrySEs = ( siteSEs, list( res['Value'] ) )
+    _siteSEsCache[siteName] = ( time.time(), siteCountrySEs )
+    return siteCountrySEs
+
   def _getSEProximity( self, replicas ):
-    """ get SE proximity """
+    """ get SE proximity
+
+    SEs at the site come first, then SEs in the same country, then the others.
+    Within each group the SEs are randomized, or ranked by observed transfer
+    rate if DataManagement/SEProximityRanking is set.
+    """
     siteName = DIRAC.siteName()
     self.__filterTapeSEs( replicas )
-    localSEs = [se for se in self.dmsHelper.getSEsAtSite( siteName ).get( 'Value', [] ) if se in replicas]
-    countrySEs = []
-    countryCode = str( siteName ).split( '.' )[-1]
-    res = self.dmsHelper.getSEsAtCountry( countryCode )
-    if res['OK']:
-      countrySEs = [se for se in res['Value'] if se in replicas and se not in localSEs]
-    sortedSEs = randomize( localSEs ) + randomize( countrySEs )
-    sortedSEs += randomize( se for se in replicas if se not in sortedSEs )
+    siteSEs, siteCountrySEs = self.__getSiteSEs( siteName )
+    localSEs = [se for se in siteSEs if se in replicas]
+    countrySEs = [se for se in siteCountrySEs if se in replicas and se not in localSEs]
+    if self.rankSEProximity:
+      sortSEs = lambda seList: self.seTransferStats.rankSEs( randomize( seList ) )
+    else:
+      sortSEs = randomize
+    sortedSEs = sortSEs( localSEs ) + sortSEs( countrySEs )
+    sortedSEs += sortSEs( [se for se in replicas if se not in sortedSEs] )
 
     return sortedSEs
 
@@ -605,6 +890,209 @@ class DataManager( object ):
         failed[lfn] = { 'Registration' : { 'LFN' : lfn, 'TargetSE' : destSE, 'PFN' : destPfn } }
     return S_OK( {'Successful': successful, 'Failed': failed} )
 
+  def replicateAndRegisterMany( self, lfns, destSE, sourceSE = '', destPath = '', localCache = '', catalog = '',
+                                nbThreads = None ):
+    """ Replicate a list of LFNs to a destination SE and register the replicas.
+
+        The access rights, replicas and sizes are obtained from the catalog in bulk,
+        the destination SE is validated once and the replication protocols are
+        negotiated once per source SE. The transfers run over :nbThreads: threads
+        (default DataManagement/ReplicationThreads), with at most
+        DataManagement/ReplicationThreadsPerPair transfers between the same source
+        and destination SEs, and the replicas are registered in one catalog call.
+        Files for which no third party transfer is possible go through replicate.
+
+        'lfns' is the list of LFNs to be replicated
+        'destSE' is the Storage Element the files should be replicated to
+        'sourceSE' is the source for the file replication (where not specified all replicas will be attempted)
+        'destPath' is the path on the destination storage element, if to be different from LHCb convention
+        'localCache' is the local file system location to be used as a temporary cache
+    """
+    log = self.log.getSubLogger( 'replicateAndRegisterMany' )
+    if isinstance( lfns, basestring ):
+      lfns = [ lfns ]
+    lfns = list( set( lfns ) )
+    successful = {}
+    failed = {}
+    if not lfns:
+      return S_OK( {'Successful': successful, 'Failed': failed} )
+    log.debug( "Attempting to replicate %d files to %s." % ( len( lfns ), destSE ) )
+
+    ###########################################################
+    # Check that we have write permissions for all files at once
+    res = self.__hasAccess( 'addReplica', lfns )
+    if not res['OK']:
+      return res
+    failed.update( dict.fromkeys( res['Value']['Failed'], "Write access not permitted for this credential." ) )
+    lfns = res['Value']['Successful']
+    if not lfns:
+      return S_OK( {'Successful': successful, 'Failed': failed} )
+
+    ###########################################################
+    # Check the destination storage element once
+    destStorageElement = self.__getStorageElement( destSE )
+    res = destStorageElement.isValid()
+    if not res['OK']:
+      errStr = "The storage element is not currently valid."
+      log.debug( errStr, "%s %s" % ( destSE, res['Message'] ) )
+      return S_ERROR( "%s %s" % ( errStr, res['Message'] ) )
+    destSEName = destStorageElement.getStorageElementName()['Value']
+    if not self.__checkSEStatus( destSEName, status = 'Write' ):
+      infoStr = "Supplied destination Storage Element is not currently allowed for Write."
+      log.debug( infoStr, destSEName )
+      return S_ERROR( infoStr )
+
+    ###########################################################
+    # Get the replicas and sizes in bulk
+    res = self.getReplicas( lfns, getUrl = False )
+    if not res['OK']:
+      return res
+    failed.update( res['Value']['Failed'] )
+    lfnReplicas = res['Value']['Successful']
+    res = self.fc.getFileSize( list( lfnReplicas ) )
+    if not res['OK']:
+      return res
+    failed.update( res['Value']['Failed'] )
+    catalogSizes = res['Value']['Successful']
+
+    # Resolve the SE aliases once per SE
+    realNames = {}
+    for se in set( se for replicas in lfnReplicas.itervalues() for se in replicas ):
+      realNames[se] = self.__getSERealName( se ).get( 'Value', se )
+    destRealName = self.__getSERealName( destSEName ).get( 'Value', destSEName )
+
+    toReplicate = []
+    for lfn, catalogSize in catalogSizes.iteritems():
+      replicas = lfnReplicas[lfn]
+      if catalogSize == 0:
+        failed[lfn] = "Registered file size is 0."
+      elif destRealName in set( realNames[se] for se in replicas ):
+        # The file was already present at the destination SE
+        successful[lfn] = { 'replicate' : 0, 'register' : 0 }
+      elif sourceSE and sourceSE not in replicas:
+        failed[lfn] = "LFN does not exist at supplied source SE."
+      else:
+        toReplicate.append( lfn )
+    log.debug( "%d files to be replicated to %s" % ( len( toReplicate ), destSEName ) )
+
+    ###########################################################
+    # Validate the source SEs and negotiate the protocols once per source SE
+    sourceInfo = {}
+    candidateSEs = [ sourceSE ] if sourceSE else set( se for lfn in toReplicate for se in lfnReplicas[lfn] )
+    for candidateSEName in candidateSEs:
+      if not self.__checkSEStatus( candidateSEName, status = 'Read' ):
+        log.debug( "%s is currently not allowed as a source." % candidateSEName )
+        continue
+      candidateSE = self.__getStorageElement( candidateSEName )
+      res = candidateSE.isValid()
+      if not res['OK']:
+        log.debug( "The storage element is not currently valid.", "%s %s" % ( candidateSEName, res['Message'] ) )
+        continue
+      res = destStorageElement.negociateProtocolWithOtherSE( candidateSE, protocols = self.thirdPartyProtocols )
+      if not res['OK']:
+        log.debug( "Error negotiating replication protocol", res['Message'] )
+        continue
+      log.debug( 'Protocols found between %s and %s' % ( candidateSEName, destSEName ), res['Value'] )
+      sourceInfo[candidateSEName] = { 'Protocols' : res['Value'],
+                                      'SameSite' : self.dmsHelper.isSameSiteSE( candidateSEName, destSEName ).get( 'Value', False ) }
+
+    ###########################################################
+    # Run the transfers
+    def replicateOne( lfn ):
+      startReplication = time.time()
+      res = self.__replicateFromSources( lfn, catalogSizes[lfn], lfnReplicas[lfn], sourceSE, sourceInfo,
+                                         destSEName, destPath, localCache )
+      return lfn, res, time.time() - startReplication
+
+    if nbThreads is None:
+      nbThreads = self.replicationThreads
+    results = []
+    if toReplicate:
+      pool = ThreadPool( max( 1, min( nbThreads, len( toReplicate ) ) ) )
+      try:
+        results = pool.map( replicateOne, toReplicate )
+      finally:
+        pool.terminate()
+
+    replicaTuples = []
+    for lfn, res, replicationTime in results:
+      if not res['OK']:
+        errStr = "Completely failed to replicate file."
+        log.debug( errStr, "%s %s" % ( lfn, res['Message'] ) )
+        failed[lfn] = "%s %s" % ( errStr, res['Message'] )
+      elif not res['Value']:
+        successful[lfn] = { 'replicate' : 0, 'register' : 0 }
+      else:
+        successful[lfn] = { 'replicate' : replicationTime }
+        replicaTuples.append( ( lfn, res['Value']['DestPfn'], res['Value']['DestSE'] ) )
+
+    ###########################################################
+    # Register all the new replicas at once
+    if replicaTuples:
+      log.debug( "Attempting to register %d replicas at %s." % ( len( replicaTuples ), destSEName ) )
+      startRegistration = time.time()
+      res = self.registerReplica( replicaTuples, catalog = catalog )
+      registrationTime = time.time() - startRegistration
+      for lfn, destPfn, replicaSE in replicaTuples:
+        if res['OK'] and lfn in res['Value']['Successful']:
+          successful[lfn]['register'] = registrationTime
+        else:
+          errStr = res['Message'] if not res['OK'] else res['Value']['Failed'].get( lfn )
+          log.debug( "Failed to register replica.", "%s %s" % ( lfn, errStr ) )
+          successful.pop( lfn )
+          failed[lfn] = { 'Registration' : { 'LFN' : lfn, 'TargetSE' : replicaSE, 'PFN' : destPfn } }
+    return S_OK( {'Successful': successful, 'Failed': failed} )
+
+  def __replicateFromSources( self, lfn, catalogSize, replicas, sourceSEName, sourceInfo,
+                              destSEName, destPath, localCache ):
+    """ Replicate one LFN of replicateAndRegisterMany with third party transfer
+
+        'sourceInfo' holds for each usable source SE the negotiated protocols
+        and whether it is at the same site as the destination.
+        This runs in the replication threads, hence the StorageElement objects
+        are those of the current thread.
+    """
+    log = self.log.getSubLogger( '__replicateFromSources', True )
+    possibleSourceSEs = [ sourceSEName ] if sourceSEName else list( replicas )
+    # Same site SEs first, reverse = True because True > False
+    possibleSourceSEs = sorted( ( se for se in possibleSourceSEs if se in sourceInfo ),
+                                key = lambda x : sourceInfo[x]['SameSite'],
+                                reverse = True )
+    lfnDestPath = '%s/%s' % ( destPath, os.path.basename( lfn ) ) if destPath else lfn
+    destStorageElement = self.__getStorageElement( destSEName )
+
+    needIntermediate = False
+    for candidateSEName in possibleSourceSEs:
+      candidateSE = self.__getStorageElement( candidateSEName )
+      replicationProtocols = sourceInfo[candidateSEName]['Protocols']
+      if not replicationProtocols:
+        needIntermediate = True
+        continue
+
+      # Check that the file size corresponds to the one in the FC
+      res = returnSingleResult( candidateSE.getFileSize( lfn ) )
+      if not res['OK']:
+        log.debug( "could not get fileSize on %s" % candidateSEName, res['Message'] )
+        continue
+      if res['Value'] != catalogSize:
+        log.debug( "Catalog size and physical file size mismatch.", "%s %s" % ( catalogSize, res['Value'] ) )
+        continue
+
+      with self.__getSESemaphore( ( candidateSEName, destSEName ), limit = self.replicationThreadsPerPair ):
+        res = self.__thirdPartyReplicate( lfn, candidateSE, destStorageElement, lfnDestPath,
+                                          replicationProtocols, catalogSize )
+      if res['OK']:
+        return S_OK( {'DestSE':destSEName, 'DestPfn':res['Value']} )
+
+    if needIntermediate:
+      # No third party transfer possible, let replicate do a get and put
+      log.debug( "Will try intermediate transfer", lfn )
+      return self.__replicate( lfn, destSEName, sourceSEName, destPath, localCache )
+
+    errStr = "Failed to replicate with all sources."
+    log.debug( errStr, lfn )
+    return S_ERROR( errStr )
+
   def replicate( self, lfn, destSE, sourceSE = '', destPath = '', localCache = '' ):
     """ Replicate a LFN to a destination SE and register the replica.
 
@@ -684,7 +1172,7 @@ class DataManager( object ):
     # Check that the destination storage element is sane and resolve its name
     log.debug( "Verifying destination StorageElement validity (%s)." % ( destSEName ) )
 
-    destStorageElement = StorageElement( destSEName, vo = self.vo )
+    destStorageElement = self.__getStorageElement( destSEName )
     res = destStorageElement.isValid()
     if not res['OK']:
       errStr = "The storage element is not currently valid."
@@ -698,7 +1186,7 @@ class DataManager( object ):
     # Check whether the destination storage element is banned
     log.verbose( "Determining whether %s ( destination ) is Write-banned." % destSEName )
 
-    if not destStorageElement.getStatus().get( 'Value', {} ).get( 'Write', False ):
+    if not self.__checkSEStatus( destSEName, status = 'Write' ):
       infoStr = "Supplied destination Storage Element is not currently allowed for Write."
       log.debug( infoStr, destSEName )
       return S_ERROR( infoStr )
@@ -788,7 +1276,7 @@ class DataManager( object ):
         log.debug( "%s is available for use." % candidateSEName )
 
 
-      candidateSE = StorageElement( candidateSEName, vo = self.vo )
+      candidateSE = self.__getStorageElement( candidateSEName )
 
       # Check that the SE is valid
       res = candidateSE.isValid()
@@ -828,66 +1316,10 @@ class DataManager( object ):
 
       log.debug( 'Found common protocols', replicationProtocols )
 
-      # THIS WOULD NOT WORK IF PROTO == file !!
-      # Why did I write that comment ?!
-
-      # We try the protocols one by one
-      # That obviously assumes that there is an overlap and not only
-      # a compatibility between the  output protocols of the source
-      # and the input protocols of the destination.
-      # But that is the only way to make sure we are not replicating
-      # over ourselves.
-      for compatibleProtocol in replicationProtocols:
-
-        # Compare the urls to make sure we are not overwriting
-        res = returnSingleResult( candidateSE.getURL( lfn, protocol = compatibleProtocol ) )
-        if not res['OK']:
-          log.debug( "Cannot get sourceURL", res['Message'] )
-          continue
-
-        sourceURL = res['Value']
-
-        destURL = ''
-        res = returnSingleResult( destStorageElement.getURL( destPath, protocol = compatibleProtocol ) )
-        if not res['OK']:
-
-          # for some protocols, in particular srm
-          # you might get an error because the file does not exist
-          # which is exactly what we want
-          # in that case, we just keep going with the comparison
-          # since destURL will be an empty string
-          if not DErrno.cmpError( res, errno.ENOENT ):
-            log.debug( "Cannot get destURL", res['Message'] )
-            continue
-        else:
-          log.debug( "File does not exist: Expected error for TargetSE !!" )
-          destURL = res['Value']
-
-        if sourceURL == destURL:
-          log.debug( "Same source and destination, give up" )
-          continue
-
-        # Attempt the transfer
-        res = returnSingleResult( destStorageElement.replicateFile( {destPath:sourceURL},
-                                                                     sourceSize = catalogSize,
-                                                                     inputProtocol = compatibleProtocol ) )
-
-        if not res['OK']:
-          log.debug( "Replication failed", "%s from %s to %s." % ( lfn, candidateSEName, destSEName ) )
-          continue
-
-
-        log.debug( "Replication successful.", res['Value'] )
-
-        res = returnSingleResult( destStorageElement.getURL( destPath, protocol = self.registrationProtocol ) )
-        if not res['OK']:
-          log.debug( 'Error getting the registration URL', res['Message'] )
-          # it's maybe pointless to try the other candidateSEs...
-          continue
-
-        registrationURL = res['Value']
-
-        return S_OK( {'DestSE':destSEName, 'DestPfn':registrationURL} )
+      res = self.__thirdPartyReplicate( lfn, candidateSE, destStorageElement, destPath,
+                                        replicationProtocols, catalogSize )
+      if res['OK']:
+        return S_OK( {'DestSE':destSEName, 'DestPfn':res['Value']} )
 
 
 
@@ -938,6 +1370,79 @@ class DataManager( object ):
 
 
 
+  def __thirdPartyReplicate( self, lfn, candidateSE, destStorageElement, destPath, replicationProtocols, catalogSize ):
+    """ Replicate a LFN from a source SE with third party transfer, trying the protocols in turn
+
+        'candidateSE' and 'destStorageElement' are the source and destination StorageElement objects
+        'replicationProtocols' are the negotiated protocols between the two SEs
+        Returns the registration URL at the destination
+    """
+    log = self.log.getSubLogger( '__thirdPartyReplicate', True )
+    candidateSEName = candidateSE.name
+    destSEName = destStorageElement.name
+
+    # THIS WOULD NOT WORK IF PROTO == file !!
+    # Why did I write that comment ?!
+
+    # We try the protocols one by one
+    # That obviously assumes that there is an overlap and not only
+    # a compatibility between the  output protocols of the source
+    # and the input protocols of the destination.
+    # But that is the only way to make sure we are not replicating
+    # over ourselves.
+    for compatibleProtocol in replicationProtocols:
+
+      # Compare the urls to make sure we are not overwriting
+      res = returnSingleResult( candidateSE.getURL( lfn, protocol = compatibleProtocol ) )
+      if not res['OK']:
+        log.debug( "Cannot get sourceURL", res['Message'] )
+        continue
+
+      sourceURL = res['Value']
+
+      destURL = ''
+      res = returnSingleResult( destStorageElement.getURL( destPath, protocol = compatibleProtocol ) )
+      if not res['OK']:
+
+        # for some protocols, in particular srm
+        # you might get an error because the file does not exist
+        # which is exactly what we want
+        # in that case, we just keep going with the comparison
+        # since destURL will be an empty string
+        if not DErrno.cmpError( res, errno.ENOENT ):
+          log.debug( "Cannot get destURL", res['Message'] )
+          continue
+      else:
+        log.debug( "File does not exist: Expected error for TargetSE !!" )
+        destURL = res['Value']
+
+      if sourceURL == destURL:
+        log.debug( "Same source and destination, give up" )
+        continue
+
+      # Attempt the transfer
+      res = returnSingleResult( destStorageElement.replicateFile( {destPath:sourceURL},
+                                                                   sourceSize = catalogSize,
+                                                                   inputProtocol = compatibleProtocol ) )
+
+      if not res['OK']:
+        log.debug( "Replication failed", "%s from %s to %s." % ( lfn, candidateSEName, destSEName ) )
+        continue
+
+
+      log.debug( "Replication successful.", res['Value'] )
+
+      res = returnSingleResult( destStorageElement.getURL( destPath, protocol = self.registrationProtocol ) )
+      if not res['OK']:
+        log.debug( 'Error getting the registration URL', res['Message'] )
+        # it's maybe pointless to try the other candidateSEs...
+        continue
+
+      return S_OK( res['Value'] )
+
+    return S_ERROR( "Third party replication failed from %s to %s" % ( candidateSEName, destSEName ) )
+
+
   ###################################################################
   #
   # These are the file catalog write methods
@@ -1530,7 +2035,7 @@ class DataManager( object ):
     """
     seList = set( se for ses in replicaDict['Successful'].itervalues() for se in ses )
     # Get a cache of SE statuses for long list of replicas
-    seStatus = dict( ( se, ( self.dmsHelper.isSEForJobs( se ), self.dmsHelper.isSEArchive( se ) ) ) for se in seList )
+    seStatus = dict( ( se, self.__getSEFlags( se ) ) for se in seList )
     for lfn, replicas in replicaDict['Successful'].items():  # Beware, there is a del below
       otherThanArchive = set( se for se in replicas if not seStatus[se][1] )
       for se in replicas.keys():
@@ -1601,39 +2106,108 @@ class DataManager( object ):
 
   def __checkSEStatus( self, se, status = 'Read' ):
     """ returns the value of a certain SE status flag (access or other) """
-    return StorageElement( se, vo = self.vo ).getStatus().get( 'Value', {} ).get( status, False )
+    return self.__getCachedSEValue( self.__seStatusCache, se,
+                                    lambda: self.__getStorageElement( se ).getStatus(), {} ).get( status, False )
+
+  def __getSEFlags( self, se ):
+    """ returns the tuple ( isSEForJobs, isSEArchive ) of an SE """
+    return self.__getCachedSEValue( self.__seFlagsCache, se,
+                                    lambda: S_OK( ( self.dmsHelper.isSEForJobs( se ), self.dmsHelper.isSEArchive( se ) ) ) )
+
+  def __getStorageElement( self, se ):
+    """ get the StorageElement object of the current thread from the pool, creating it if needed
+
+        StorageElement objects keep the name of the method being called in
+        their state, hence they must not be shared between threads
+    """
+    seObjects = getattr( self.__seObjects, 'objects', None )
+    if seObjects is None:
+      seObjects = self.__seObjects.objects = {}
+    if se not in seObjects:
+      seObjects[se] = StorageElement( se, vo = self.vo )
+    return seObjects[se]
+
+  def __getCachedSEValue( self, cache, se, getter, default = None ):
+    """ get an SE value from a cache, calling getter if missing or older than seCacheTTL
+
+    :param self: self reference
+    :param dict cache: cache { se : ( time, value ) }
+    :param str se: DIRAC SE name
+    :param callable getter: function returning S_OK( value ) / S_ERROR, errors are not cached
+    :param default: value returned if getter fails
+    """
+    now = time.time()
+    with self.__seCacheLock:
+      cached = cache.get( se )
+      if cached and now - cached[0] < self.seCacheTTL:
+        self.seCacheCounters['Hits'] += 1
+        return cached[1]
+      self.seCacheCounters['Misses'] += 1
+    res = getter()
+    if not res['OK']:
+      self.log.warn( 'Failed to get SE information', '%s: %s' % ( se, res['Message'] ) )
+      return default
+    with self.__seCacheLock:
+      cache[se] = ( now, res['Value'] )
+    return res['Value']
+
+  def getSECacheCounters( self ):
+    """ get the hit and miss counters of the SE status and flag cache """
+    with self.__seCacheLock:
+      return S_OK( dict( self.seCacheCounters ) )
+
+  def resetSECache( self ):
+    """ drop the cached SE objects, status and flags """
+    with self.__seCacheLock:
+      self.__seObjects = threading.local()
+      self.__seStatusCache.clear()
+      self.__seFlagsCache.clear()
+    return S_OK()
 
   def getReplicas( self, lfns, allStatus = True, getUrl = True, diskOnly = False, preferDisk = False, active = False ):
     """ get replicas from catalogue and filter if requested
     Warning: all filters are independent, hence active and preferDisk should be set if using forJobs
+
+    When the URLs have to be resolved at the SEs, the getURL calls of a catalog
+    chunk are dispatched per SE and per chunk of 1000 LFNs over getURLThreads
+    threads, while the catalog is queried for the next chunk.
     """
     catalogReplicas = {}
     failed = {}
-    for lfnChunk in breakListIntoChunks( lfns, 1000 ):
-      res = self.fc.getReplicas( lfnChunk, allStatus = allStatus )
-      if res['OK']:
-        catalogReplicas.update( res['Value']['Successful'] )
+    resolveUrl = getUrl and not self.useCatalogPFN
+    pool = ThreadPool( max( 1, self.getURLThreads ) ) if resolveUrl else None
+    pendingUrls = []
+    try:
+      for lfnChunk in breakListIntoChunks( lfns, 1000 ):
+        res = self.fc.getReplicas( lfnChunk, allStatus = allStatus )
+        if not res['OK']:
+          return res
+        chunkReplicas = res['Value']['Successful']
+        catalogReplicas.update( chunkReplicas )
         failed.update( res['Value']['Failed'] )
-      else:
-        return res
+        if resolveUrl:
+          se_lfn = {}
+
+          # We group the query to getURL by storage element to gain in speed
+          for lfn in chunkReplicas:
+            for se in chunkReplicas[lfn]:
+              se_lfn.setdefault( se, [] ).append( lfn )
+
+          for se in se_lfn:
+            for urlChunk in breakListIntoChunks( se_lfn[se], 1000 ):
+              pendingUrls.append( pool.apply_async( self.__getURLChunk, ( se, urlChunk ) ) )
+
+      for pendingUrl in pendingUrls:
+        se, succPfn = pendingUrl.get()
+        for lfn in succPfn:
+          catalogReplicas[lfn][se] = succPfn[lfn]
+    finally:
+      if pool:
+        pool.terminate()
+
     if not getUrl:
       for lfn in catalogReplicas:
         catalogReplicas[lfn] = dict.fromkeys( catalogReplicas[lfn], True )
-    elif not self.useCatalogPFN:
-      if res['OK']:
-        se_lfn = {}
-
-        # We group the query to getURL by storage element to gain in speed
-        for lfn in catalogReplicas:
-          for se in catalogReplicas[lfn]:
-            se_lfn.setdefault( se, [] ).append( lfn )
-
-        for se in se_lfn:
-          seObj = StorageElement( se, vo = self.vo )
-          succPfn = seObj.getURL( se_lfn[se], protocol = self.registrationProtocol ).get( 'Value', {} ).get( 'Successful', {} )
-          for lfn in succPfn:
-            # catalogReplicas still points res["value"]["Successful"] so res will be updated
-            catalogReplicas[lfn][se] = succPfn[lfn]
 
     result = {'Successful':catalogReplicas, 'Failed':failed}
     if active:
@@ -1642,6 +2216,14 @@ class DataManager( object ):
       self.__filterTapeReplicas( result, diskOnly = diskOnly )
     return S_OK( result )
 
+  def __getURLChunk( self, se, lfns ):
+    """ resolve the registration URLs of a chunk of LFNs at an SE
+
+        This runs in the getURL threads, the StorageElement object is the one of the current thread
+    """
+    seObj = self.__getStorageElement( se )
+    return se, seObj.getURL( lfns, protocol = self.registrationProtocol ).get( 'Value', {} ).get( 'Successful', {} )
+
   def getReplicasForJobs( self, lfns, allStatus = False, getUrl = True, diskOnly = False ):
     """ get replicas useful for jobs
     """
@@ -2,8 +2,11 @@
 
 __RCSID__ = "$Id$"
 
+import json
 # # from DIRAC
 from DIRAC.Core.Base.Client import Client
+# from CTADIRAC
+from CTADIRAC.DataManagementSystem.private.JSONUtils import DMSEncoder
 
 class ProvClient(Client):
 
@@ -161,6 +164,23 @@ class ProvClient(Client):
     print rowJSON
     return rpcClient.addConfigFileDescription(rowJSON)
 
+  def addProvenanceGraph(self, graph):
+    """ Add a whole provenance graph with a single call
+
+    :param graph: ordered list of {'type': row type, 'tmp_id': temporary id, 'row': ProvBase row},
+                  a *_key attribute of a row can be the tmp_id of a previous row
+    :return: S_OK({tmp_id: internal_key})
+    """
+
+    graphJSON = json.dumps(graph, cls=DMSEncoder)
+    rpcClient = self._getRPC()
+    return rpcClient.addProvenanceGraph(graphJSON)
+
+  def getPoolStatus(self):
+
+    rpcClient = self._getRPC()
+    return rpcClient.getPoolStatus()
+
   def getAgents(self):
 
     rpcClient = self._getRPC()
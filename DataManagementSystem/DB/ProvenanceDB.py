@@ -1,8 +1,10 @@
 # imports
 import json
+import threading
+from contextlib import contextmanager
 from types import StringTypes
 # Import sqlachemy modules to create objects mapped with tables
-from sqlalchemy import Table, Column, ForeignKey
+from sqlalchemy import Table, Column, ForeignKey, Index
 from sqlalchemy import Integer, String
 from sqlalchemy import exists
 from sqlalchemy.orm import sessionmaker, class_mapper, relationship
@@ -10,6 +12,8 @@ from sqlalchemy.orm.exc import NoResultFound
 from sqlalchemy.engine.reflection import Inspector
 from sqlalchemy import create_engine, func, MetaData, \
 Integer, String, DateTime, Enum, BLOB, exc, BigInteger, distinct
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
 
 # Declare a declarative_base to map objets and tables
 from sqlalchemy.ext.declarative import declarative_base
@@ -17,14 +21,19 @@ from sqlalchemy.ext.declarative import declarative_base
 # from DIRAC
 from DIRAC import S_OK, S_ERROR, gLogger, gConfig
 from DIRAC.ConfigurationSystem.Client.Utilities import getDBParameters
+from DIRAC.ConfigurationSystem.Client.PathFinder import getDatabaseSection
 
 
 provBase = declarative_base()
 
+# Type of the internal keys: SQLite, used as a stand-in by the tests,
+# only autoincrements the INTEGER PRIMARY KEY columns
+provKeyType = BigInteger().with_variant(Integer, 'sqlite')
+
 ################################################################################
 # wasInformedBy association table (n-n relation)
 wasInformedBy_association_table = Table('wasInformedBy', provBase.metadata,
-    Column('internal_key', BigInteger, primary_key=True, autoincrement=True),
+    Column('internal_key', provKeyType, primary_key=True, autoincrement=True),
     Column('informant', BigInteger, ForeignKey("activities.internal_key")),
     Column('informed', BigInteger, ForeignKey("activities.internal_key")))
 
@@ -37,7 +46,7 @@ class Activity(provBase):
     other_display_attributes = ['name','comment']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     id        = Column(String)
@@ -75,7 +84,7 @@ class Activity(provBase):
 ################################################################################
 # wasDerivedFrom association table (n-n relation)
 wasDerivedFrom_association_table = Table('wasDerivedFrom', provBase.metadata,
-    Column('internal_key', BigInteger, primary_key=True),
+    Column('internal_key', provKeyType, primary_key=True),
     Column('generatedEntity', BigInteger, ForeignKey("entities.internal_key")),
     Column('usedEntity', BigInteger, ForeignKey("entities.internal_key")))
 
@@ -89,7 +98,7 @@ class Entity(provBase):
                                 'invalidatedAtTime','comment']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     id                  = Column(String)
@@ -99,6 +108,9 @@ class Entity(provBase):
     invalidatedAtTime   = Column(DateTime)
     comment             = Column(String)
 
+    # Index for the lookup of the valid entity of a given id
+    __table_args__ = (Index('ix_entities_id_invalidatedattime', 'id', 'invalidatedAtTime'),)
+
     # Heritage
     classType           = Column(String)
     __mapper_args__ = {
@@ -204,7 +216,7 @@ class Used(provBase):
     other_display_attributes = ['role', 'time']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     role = Column(String, nullable=True)
@@ -243,7 +255,7 @@ class WasGeneratedBy(provBase):
     other_display_attributes = ['role']
 
     # Internal Key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     role = Column(String, nullable=True)
@@ -280,7 +292,7 @@ class Agent(provBase):
                               'affiliation', 'phone', 'address','url']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     id   = Column(String)
@@ -293,6 +305,9 @@ class Agent(provBase):
     address = Column(String)
     url = Column(String)
 
+    # Unique index for the agent lookups
+    __table_args__ = (Index('ix_agents_id', 'id', unique=True),)
+
     # Print method
     def __repr__(self):
         response = ""
@@ -308,7 +323,7 @@ class WasAssociatedWith(provBase):
     other_display_attributes = ['role']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     role     = Column(String, nullable=True)
@@ -342,7 +357,7 @@ class WasAttributedTo(provBase):
     other_display_attributes = ['role']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     role     = Column(String, nullable=True)
@@ -376,7 +391,7 @@ class ActivityDescription(provBase):
     other_display_attributes = ['name', 'version', 'description', 'type', 'subtype', 'doculink']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     name = Column(String)
@@ -386,6 +401,9 @@ class ActivityDescription(provBase):
     subtype = Column(String)
     doculink = Column(String)
 
+    # Unique index for the description lookups
+    __table_args__ = (Index('ix_activitydescriptions_name_version', 'name', 'version', unique=True),)
+
     # 1-n relation with ConfigFileDescription
     configFiles = relationship("ConfigFileDescription")
     # 1-n relation with ParameterDescription
@@ -413,7 +431,7 @@ class EntityDescription(provBase):
     other_display_attributes = ['name', 'type', 'description', 'doculink', 'classType']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     name = Column(String)
@@ -422,6 +440,9 @@ class EntityDescription(provBase):
     doculink = Column(String)
     classType = Column(String)
 
+    # Unique index for the description lookups
+    __table_args__ = (Index('ix_entitydescriptions_name', 'name', unique=True),)
+
     # Heritage
     __mapper_args__ = {
         'polymorphic_identity': 'entityDescription',
@@ -514,7 +535,7 @@ class UsageDescription(provBase):
     ordered_attribute_list = ['role', 'description', 'type', 'multiplicity', \
                               'activityDescription_key', 'entityDescription_key']
     # Key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     role = Column(String, nullable=True)
@@ -529,6 +550,10 @@ class UsageDescription(provBase):
     entityDescription_key = Column(BigInteger, ForeignKey('entityDescriptions.internal_key'))
     entityDescription = relationship("EntityDescription")
 
+    # Unique index for the description lookups
+    __table_args__ = (Index('ix_usagedescriptions_activity_entity_role', 'activityDescription_key',
+                            'entityDescription_key', 'role', unique=True),)
+
     # Print method
     def __repr__(self):
         response = ""
@@ -552,7 +577,7 @@ class GenerationDescription(provBase):
     other_display_attributes = ['role', 'description', 'type', 'multiplicity']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     role = Column(String, nullable=True)
@@ -567,6 +592,10 @@ class GenerationDescription(provBase):
     entityDescription_key = Column(BigInteger, ForeignKey('entityDescriptions.internal_key'))
     entityDescription = relationship("EntityDescription")
 
+    # Unique index for the description lookups
+    __table_args__ = (Index('ix_generationdescriptions_activity_entity_role', 'activityDescription_key',
+                            'entityDescription_key', 'role', unique=True),)
+
     # Print method
     def __repr__(self):
         response = ""
@@ -589,7 +618,7 @@ class WasConfiguredBy(provBase):
     other_display_attributes = ['artefactType']
 
     # Internal keya
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     artefactType = Column(String, nullable=True)
@@ -627,7 +656,7 @@ class Parameter(provBase):
     other_display_attributes = ['name', 'value']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     name = Column(String)
@@ -660,7 +689,7 @@ class ConfigFile(provBase):
     other_display_attributes = ['name', 'location', 'comment']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     name = Column(String)
@@ -696,7 +725,7 @@ class ParameterDescription(provBase):
                                 'unit', 'ucd', 'utype', 'min', 'max', 'default', 'options']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     name = Column(String)
@@ -737,7 +766,7 @@ class ConfigFileDescription(provBase):
     other_display_attributes = ['name', 'contentType', 'description']
 
     # Internal key
-    internal_key = Column(BigInteger, primary_key=True, autoincrement=True)
+    internal_key = Column(provKeyType, primary_key=True, autoincrement=True)
 
     # Model attributes
     name = Column(String)
@@ -763,6 +792,71 @@ class ConfigFileDescription(provBase):
 
 
 ################################################################################
+################################################################################
+# Row types accepted in a provenance graph, see ProvenanceDB.addProvenanceGraph:
+# type name: ( mapped class, class and attributes identifying an existing row )
+# Rows with identifying attributes are only inserted if they do not exist yet
+provGraphRowTypes = {
+    'Agent': (Agent, Agent, ['id']),
+    'ActivityDescription': (ActivityDescription, ActivityDescription, ['name', 'version']),
+    'DatasetDescription': (DatasetDescription, EntityDescription, ['name']),
+    'ValueDescription': (ValueDescription, EntityDescription, ['name']),
+    'UsageDescription': (UsageDescription, UsageDescription,
+                         ['activityDescription_key', 'entityDescription_key', 'role']),
+    'GenerationDescription': (GenerationDescription, GenerationDescription,
+                              ['activityDescription_key', 'entityDescription_key', 'role']),
+    'ParameterDescription': (ParameterDescription, None, []),
+    'ConfigFileDescription': (ConfigFileDescription, None, []),
+    'Activity': (Activity, None, []),
+    'DatasetEntity': (DatasetEntity, DatasetEntity, ['id']),
+    'ValueEntity': (ValueEntity, None, []),
+    'Parameter': (Parameter, None, []),
+    'ConfigFile': (ConfigFile, None, []),
+    'Used': (Used, None, []),
+    'WasGeneratedBy': (WasGeneratedBy, None, []),
+    'WasAssociatedWith': (WasAssociatedWith, None, []),
+    'WasAttributedTo': (WasAttributedTo, None, []),
+    'WasConfiguredBy': (WasConfiguredBy, None, [])}
+
+class DescriptionCache( object ):
+  '''
+    Thread safe cache of the keys of the description rows, which are nearly static.
+    Only the rows found are cached, the entries of a description class are
+    invalidated when a row of this class is added.
+  '''
+
+  cachedClasses = [ Agent, ActivityDescription, EntityDescription, UsageDescription,
+                    GenerationDescription, ParameterDescription, ConfigFileDescription ]
+
+  def __init__( self ):
+    self.lock = threading.Lock()
+    self.cache = dict( ( cachedClass, {} ) for cachedClass in self.cachedClasses )
+
+  def getCachedClass( self, rowClass ):
+    ''' the cached class of a row class, None if it is not cached '''
+    for cachedClass in self.cachedClasses:
+      if issubclass( rowClass, cachedClass ):
+        return cachedClass
+    return None
+
+  def get( self, cachedClass, key ):
+    ''' cached value of a lookup, None if not cached '''
+    with self.lock:
+      value = self.cache[cachedClass].get( key )
+    return dict( value ) if isinstance( value, dict ) else value
+
+  def set( self, cachedClass, key, value ):
+    ''' cache the value of a lookup '''
+    with self.lock:
+      self.cache[cachedClass][key] = value
+
+  def invalidate( self, rowClass = None ):
+    ''' invalidate the entries of the class of a row class, or all entries '''
+    with self.lock:
+      for cachedClass in self.cache:
+        if rowClass is None or issubclass( rowClass, cachedClass ):
+          self.cache[cachedClass] = {}
+
 class ProvenanceDB( object ):
   '''
     Class that defines the interactions with the tables of the ProvenanceDB.
@@ -784,29 +878,64 @@ class ProvenanceDB( object ):
     self.dbPass = dbParameters[ 'Password' ]
     self.dbName = dbParameters[ 'DBName' ]
 
-  def __init__( self ):
+  def __getPoolOptions( self, fullname ):
+    """ Collect from the CS the options of the connection pool
+    """
+
+    dbSection = getDatabaseSection( fullname )
+    self.poolSize = gConfig.getValue( '%s/PoolSize' % dbSection, 5 )
+    self.maxOverflow = gConfig.getValue( '%s/MaxOverflow' % dbSection, 10 )
+    self.poolRecycle = gConfig.getValue( '%s/PoolRecycle' % dbSection, 3600 )
+
+  def __init__( self, url = None ):
     """c'tor
     :param self: self reference
+    :param str url: SQLAlchemy URL of the database, by default the PostgreSQL
+                    database of the CS, e.g. sqlite:///file for the tests
     """
 
     self.log = gLogger.getSubLogger( 'ProvenanceDB' )
-    # Initialize the connection info
-    self.__getDBConnectionInfo( 'DataManagement/ProvenanceDB' )
+    self.__getPoolOptions( 'DataManagement/ProvenanceDB' )
+    if url is None:
+      # Initialize the connection info
+      self.__getDBConnectionInfo( 'DataManagement/ProvenanceDB' )
+      url = 'postgresql://%s:%s@%s:%s/%s' % ( self.dbUser, self.dbPass, self.dbHost, self.dbPort, self.dbName )
 
     runDebug = ( gLogger.getLevel() == 'DEBUG' )
-    self.engine = create_engine( 'postgresql://%s:%s@%s:%s/%s' % ( self.dbUser,
-                                                              self.dbPass,
-                                                              self.dbHost,
-                                                              self.dbPort,
-                                                              self.dbName ),
-                                 echo = runDebug )
+    connectArgs = { 'check_same_thread' : False } if url.startswith( 'sqlite' ) else {}
+    self.engine = create_engine( url,
+                                 echo = runDebug,
+                                 poolclass = QueuePool,
+                                 pool_size = self.poolSize,
+                                 max_overflow = self.maxOverflow,
+                                 pool_recycle = self.poolRecycle,
+                                 connect_args = connectArgs )
+    if url.startswith( 'sqlite' ):
+      self.__setupSQLite()
 
     self.sessionMaker_o = sessionmaker(bind=self.engine)
+    # Session of the unit of work of each thread, see unitOfWork
+    self.threadSessions = threading.local()
     self.inspector = Inspector.from_engine(self.engine)
+    self.descriptionCache = DescriptionCache()
 
     #These are the list of tables that will be created.
     self.__initializeDB()
 
+  def __setupSQLite( self ):
+    """ Let SQLAlchemy handle the SQLite transactions, so that the SAVEPOINTs
+        of the units of work work, and serialize the writers with BEGIN IMMEDIATE
+    """
+
+    @event.listens_for( self.engine, 'connect' )
+    def onConnect( dbapiConnection, _connectionRecord ):
+      dbapiConnection.isolation_level = None
+      dbapiConnection.execute( 'PRAGMA busy_timeout = 30000' )
+
+    @event.listens_for( self.engine, 'begin' )
+    def onBegin( connection ):
+      connection.execute( 'BEGIN IMMEDIATE' )
+
   def __initializeDB(self):
     """
     Create the tables, if they are not there yet
@@ -815,25 +944,178 @@ class ProvenanceDB( object ):
     # sqlalchemy creates the database for me
     provBase.metadata.create_all(self.engine)
 
-  def _sessionAdd(self, provInstance):
+    # Migration of existing databases: create_all does not add
+    # the indexes declared after the creation of the tables
+    for table in provBase.metadata.sorted_tables:
+      existingIndexes = [ index['name'] for index in self.inspector.get_indexes( table.name ) ]
+      for index in table.indexes:
+        if index.name in existingIndexes:
+          continue
+        try:
+          index.create( self.engine )
+          self.log.info( 'Created index', index.name )
+        except exc.SQLAlchemyError as e:
+          # e.g. a unique index on a table with duplicated rows
+          self.log.warn( 'Could not create index %s, remove the duplicated rows?' % index.name, str( e ) )
+
+  @contextmanager
+  def unitOfWork(self):
+    '''
+      Use a single session for all the calls made in the block by the current thread,
+      committed at the end of the block, or rolled back if an exception is raised.
+      The description cache is only updated once the block is committed.
+    '''
+
+    if getattr(self.threadSessions, 'session', None) is not None:
+      # Nested unit of work: part of the enclosing one
+      yield self.threadSessions.session
+      return
 
     session = self.sessionMaker_o()
+    self.threadSessions.session = session
+    self.threadSessions.cacheUpdates = []
     try:
-      session.add(provInstance)
+      yield session
       session.commit()
-      res = session.query(func.max(provInstance.internal_key).label('internal_key')).one()
+    except:
+      session.rollback()
+      raise
+    else:
+      # The rows are committed, their keys can be shared with the other threads
+      for update, args in self.threadSessions.cacheUpdates:
+        update(*args)
+    finally:
+      self.threadSessions.session = None
+      self.threadSessions.cacheUpdates = []
+      session.close()
+
+  def _cacheUpdate(self, update, *args):
+    '''
+      Update the description cache, at the end of the current unit of work if there is one,
+      so that the other threads never get the keys of rows which are not committed
+    '''
+
+    if getattr(self.threadSessions, 'session', None) is not None:
+      self.threadSessions.cacheUpdates.append((update, args))
+    else:
+      update(*args)
+
+  def _cacheSet(self, cachedClass, cacheKey, value):
+    '''
+      Cache the value of a lookup, see _cacheUpdate
+    '''
+
+    self._cacheUpdate(self.descriptionCache.set, cachedClass, cacheKey, value)
+
+  def _cacheInvalidate(self, rowClass):
+    '''
+      Invalidate the cache entries of a row class, now and at the end of the
+      current unit of work, see _cacheUpdate
+    '''
+
+    self.descriptionCache.invalidate(rowClass)
+    if getattr(self.threadSessions, 'session', None) is not None:
+      self._cacheUpdate(self.descriptionCache.invalidate, rowClass)
+
+  def _getSession(self):
+    '''
+      Get the session of the current unit of work, or a new session
+    '''
+
+    session = getattr(self.threadSessions, 'session', None)
+    return session if session is not None else self.sessionMaker_o()
+
+  def _inUnitOfWork(self, session):
+    '''
+      Whether a session is the one of the current unit of work
+    '''
+
+    return session is getattr(self.threadSessions, 'session', None)
+
+  def _closeSession(self, session):
+    '''
+      Close a session, unless it belongs to the current unit of work
+    '''
+
+    if not self._inUnitOfWork(session):
+      session.close()
+
+  def _beginWrite(self, session):
+    '''
+      Begin a write: inside a unit of work, a SAVEPOINT which only rolls back
+      this write and leaves the commit to the unit of work, otherwise the
+      transaction of the session itself
+      :return: the transaction, with commit and rollback methods
+    '''
+
+    return session.begin_nested() if self._inUnitOfWork(session) else session
+
+  def _commitRead(self, session):
+    '''
+      End the transaction of a read, unless it is part of the current unit of work
+    '''
+
+    if not self._inUnitOfWork(session):
       session.commit()
-      return S_OK({'internal_key': res.internal_key})
+
+  def getPoolStatus(self):
+    '''
+      Get the connection pool configuration and usage
+      :return: S_OK(dict)
+    '''
+
+    pool = self.engine.pool
+    return S_OK({'PoolSize': self.poolSize,
+                 'MaxOverflow': self.maxOverflow,
+                 'PoolRecycle': self.poolRecycle,
+                 'CheckedIn': pool.checkedin(),
+                 'CheckedOut': pool.checkedout(),
+                 'Overflow': pool.overflow(),
+                 'Status': pool.status()})
+
+  def _sessionAdd(self, provInstance):
+
+    session = self._getSession()
+    transaction = self._beginWrite(session)
+    try:
+      session.add(provInstance)
+      # The key is assigned by the database when the row is flushed
+      session.flush()
+      internal_key = provInstance.internal_key
+      transaction.commit()
+      self._cacheInvalidate(provInstance.__class__)
+      return S_OK({'internal_key': internal_key})
     except exc.IntegrityError as err:
       self.log.warn("insert: trying to insert a duplicate key? %s" % err)
-      session.rollback()
+      transaction.rollback()
       return S_ERROR("Key already exists")
     except exc.SQLAlchemyError as e:
-      session.rollback()
+      transaction.rollback()
       self.log.exception("insert: unexpected exception", lException=e)
       return S_ERROR("insert: unexpected exception %s" % e)
     finally:
-      session.close()
+      self._closeSession(session)
+
+  def _getOrAddKey(self, row, getKey):
+    '''
+      Get the key of an existing row, or add the row. The unique indexes reject
+      the concurrent inserts of the same row, whose key is then looked up again
+      :param row: row to add
+      :param getKey: function returning the key of the existing row, raising if there is none
+      :return: S_OK({'internal_key': key})
+    '''
+
+    try:
+      return S_OK({'internal_key': getKey()})
+    except Exception:
+      pass
+    res = self._sessionAdd(row)
+    if not res['OK']:
+      try:
+        return S_OK({'internal_key': getKey()})
+      except Exception:
+        pass
+    return res
 
   def _dictToObject(self, table, fromDict):
     '''
@@ -869,11 +1151,7 @@ class ProvenanceDB( object ):
     agent = Agent()
     row = self._dictToObject(agent, rowDict)
 
-    try:
-        res = self.getAgentKey(agent.id)['Value']['internal_key']
-        return S_OK({"internal_key":res})
-    except:
-        return self._sessionAdd(row)
+    return self._getOrAddKey(row, lambda: self.getAgentKey(agent.id)['Value']['internal_key'])
 
   def addActivity(self, rowDict):
     '''
@@ -908,11 +1186,8 @@ class ProvenanceDB( object ):
 
     activityDesc = ActivityDescription()
     row = self._dictToObject(activityDesc, rowDict)
-    try:
-        res = self.getActivityDescriptionKey(activityDesc.name, activityDesc.version)['Value']['internal_key']
-        return S_OK({"internal_key":res})
-    except:
-        return self._sessionAdd(row)
+    return self._getOrAddKey(row, lambda: self.getActivityDescriptionKey(activityDesc.name,
+                                                                          activityDesc.version)['Value']['internal_key'])
 
   def addDatasetDescription(self, rowDict):
     '''
@@ -923,11 +1198,7 @@ class ProvenanceDB( object ):
 
     datasetDesc = DatasetDescription()
     row = self._dictToObject(datasetDesc, rowDict)
-    try:
-        res = self.getEntityDescriptionKey(datasetDesc.name)['Value']['internal_key']
-        return S_OK({"internal_key":res})
-    except:
-        return self._sessionAdd(row)
+    return self._getOrAddKey(row, lambda: self.getEntityDescriptionKey(datasetDesc.name)['Value']['internal_key'])
 
   def addUsageDescription(self, rowDict):
     '''
@@ -938,13 +1209,9 @@ class ProvenanceDB( object ):
 
     usageDesc = UsageDescription()
     row = self._dictToObject(usageDesc, rowDict)
-    try:
-        res = self.getUsageDescriptionKey(usageDesc.activityDescription_key, \
-                                          usageDesc.entityDescription_key, \
-                                          usageDesc.role)['Value']['internal_key']
-        return S_OK({"internal_key":res})
-    except:
-        return self._sessionAdd(row)
+    return self._getOrAddKey(row, lambda: self.getUsageDescriptionKey(usageDesc.activityDescription_key, \
+                                                                       usageDesc.entityDescription_key, \
+                                                                       usageDesc.role)['Value']['internal_key'])
 
   def addGenerationDescription(self, rowDict):
     '''
@@ -955,13 +1222,9 @@ class ProvenanceDB( object ):
 
     generationDesc = GenerationDescription()
     row = self._dictToObject(generationDesc, rowDict)
-    try:
-        res = self.getGenerationDescriptionKey(generationDesc.activityDescription_key, \
-                                          generationDesc.entityDescription_key, \
-                                          generationDesc.role)['Value']['internal_key']
-        return S_OK({"internal_key":res})
-    except:
-        return self._sessionAdd(row)
+    return self._getOrAddKey(row, lambda: self.getGenerationDescriptionKey(generationDesc.activityDescription_key, \
+                                                                            generationDesc.entityDescription_key, \
+                                                                            generationDesc.role)['Value']['internal_key'])
 
   def addDatasetEntity(self, rowDict):
     '''
@@ -1028,11 +1291,7 @@ class ProvenanceDB( object ):
 
     valueDesc = ValueDescription()
     row = self._dictToObject(valueDesc, rowDict)
-    try:
-        res = self.getEntityDescriptionKey(valueDesc.name)['Value']['internal_key']
-        return S_OK({"internal_key":res})
-    except:
-        return self._sessionAdd(row)
+    return self._getOrAddKey(row, lambda: self.getEntityDescriptionKey(valueDesc.name)['Value']['internal_key'])
 
 
   def addWasConfiguredBy(self, rowDict):
@@ -1090,23 +1349,123 @@ class ProvenanceDB( object ):
     row = self._dictToObject(configFileDescription, rowDict)
     return self._sessionAdd(row)
 
+  def addProvenanceGraph(self, graph):
+    '''
+      Add all the rows of a provenance graph in a single transaction
+      :param graph: ordered list of {'type': row type, 'tmp_id': temporary id, 'row': row dict},
+                    in a row, a *_key attribute given as a string is the tmp_id of a
+                    previous row of the graph
+      :return: S_OK({tmp_id: internal_key})
+    '''
+
+    graph = graph if isinstance( graph, list ) else json.loads( graph )
+
+    keyMap = {}
+    cachedKeys = []
+    addedClasses = set()
+    session = self._getSession()
+    transaction = self._beginWrite(session)
+    try:
+      for node in graph:
+        if node.get('type') not in provGraphRowTypes:
+          transaction.rollback()
+          return S_ERROR("Unknown provenance row type %s" % node.get('type'))
+        rowClass, lookupClass, lookupAttributes = provGraphRowTypes[node['type']]
+
+        rowDict = dict(node.get('row', {}))
+        for key, value in rowDict.items():
+          if key.endswith('_key') and isinstance( value, StringTypes ):
+            if value not in keyMap:
+              transaction.rollback()
+              return S_ERROR("Unknown temporary id %s for %s.%s" % (value, node['type'], key))
+            rowDict[key] = keyMap[value]
+        row = self._dictToObject(rowClass(), rowDict)
+
+        # Reuse the existing row for the descriptions, agents and datasets
+        internal_key = None
+        if lookupClass is not None:
+          cachedClass = self.descriptionCache.getCachedClass(lookupClass)
+          cacheKey = ('addProvenanceGraph',) + tuple(getattr(row, attribute) for attribute in lookupAttributes)
+          if cachedClass:
+            internal_key = self.descriptionCache.get(cachedClass, cacheKey)
+          if internal_key is None:
+            internal_key = self._lookupGraphRow(session, row, lookupClass, lookupAttributes)
+            if internal_key is not None and cachedClass:
+              cachedKeys.append((cachedClass, cacheKey, internal_key))
+
+        if internal_key is None and lookupClass is not None:
+          # A concurrent writer may insert the same row: its savepoint is rolled back
+          # and the row inserted by the other writer is used
+          rowTransaction = session.begin_nested()
+          try:
+            session.add(row)
+            session.flush()
+            rowTransaction.commit()
+          except exc.IntegrityError as err:
+            rowTransaction.rollback()
+            internal_key = self._lookupGraphRow(session, row, lookupClass, lookupAttributes)
+            if internal_key is None:
+              raise err
+          if internal_key is None:
+            internal_key = row.internal_key
+            addedClasses.add(row.__class__)
+        elif internal_key is None:
+          session.add(row)
+          session.flush()
+          internal_key = row.internal_key
+          addedClasses.add(row.__class__)
+        if node.get('tmp_id') is not None:
+          keyMap[node['tmp_id']] = internal_key
+      transaction.commit()
+
+      # Update the description cache once the rows are committed
+      for rowClass in addedClasses:
+        self._cacheInvalidate(rowClass)
+      for cachedClass, cacheKey, internal_key in cachedKeys:
+        self._cacheSet(cachedClass, cacheKey, internal_key)
+      return S_OK(keyMap)
+    except exc.IntegrityError as err:
+      self.log.warn("insert graph: trying to insert a duplicate key? %s" % err)
+      transaction.rollback()
+      return S_ERROR("Key already exists")
+    except exc.SQLAlchemyError as e:
+      transaction.rollback()
+      self.log.exception("insert graph: unexpected exception", lException=e)
+      return S_ERROR("insert graph: unexpected exception %s" % e)
+    finally:
+      self._closeSession(session)
+
+  def _lookupGraphRow(self, session, row, lookupClass, lookupAttributes):
+    '''
+      Get the key of the existing row of lookupClass with the lookup attributes of row
+      :return: internal_key or None
+    '''
+
+    query = session.query(lookupClass.internal_key)
+    for attribute in lookupAttributes:
+      query = query.filter(getattr(lookupClass, attribute) == getattr(row, attribute))
+    if lookupClass is DatasetEntity:
+      query = query.filter(DatasetEntity.invalidatedAtTime == None)
+    existing = query.order_by(lookupClass.internal_key.desc()).first()
+    return existing.internal_key if existing is not None else None
+
   def getAgents(self):
     '''
       Get Agents
       :return:
     '''
 
-    session = self.sessionMaker_o()
+    session = self._getSession()
     agentIDs = []
     try:
       for instance in session.query(Agent):
         agentIDs.append(instance.internal_key)
-      session.commit()
+      self._commitRead(session)
       return S_OK(agentIDs)
     except NoResultFound, e:
       return S_OK()
     finally:
-      session.close()
+      self._closeSession(session)
 
   def getDatasetEntity(self, guid):
     '''
@@ -1115,7 +1474,7 @@ class ProvenanceDB( object ):
       :return:
     '''
 
-    session = self.sessionMaker_o()
+    session = self._getSession()
     try:
       datasetEntity = session.query( DatasetEntity )\
                           .filter( DatasetEntity.id == guid ) \
@@ -1125,7 +1484,7 @@ class ProvenanceDB( object ):
     except NoResultFound, e:
       return S_OK()
     finally:
-      session.close()
+      self._closeSession(session)
 
   def updateDatasetEntity(self, internal_key, invalidatedAtTime):
     '''
@@ -1134,17 +1493,21 @@ class ProvenanceDB( object ):
       :return:
     '''
 
-    session = self.sessionMaker_o()
+    session = self._getSession()
+    transaction = self._beginWrite(session)
     try:
-      datasetEntity = session.update( DatasetEntity )\
-                          .where ( DatasetEntity.internal_key == internal_key )\
-                          .values ( invalidatedAtTime = invalidatedAtTime )
-      session.commit()
-      return S_OK()
-    except e:
+      # invalidatedAtTime is a column of the entities table of the DatasetEntity
+      session.query( Entity )\
+             .filter( Entity.internal_key == internal_key )\
+             .update( {'invalidatedAtTime': invalidatedAtTime}, synchronize_session=False )
+      transaction.commit()
       return S_OK()
+    except exc.SQLAlchemyError as e:
+      transaction.rollback()
+      self.log.exception("update: unexpected exception", lException=e)
+      return S_ERROR("update: unexpected exception %s" % e)
     finally:
-      session.close()
+      self._closeSession(session)
 
   def getUsageDescription(self, activityDescription_key, role):
     '''
@@ -1153,17 +1516,24 @@ class ProvenanceDB( object ):
       :return: usageDescription.internal_key
     '''
 
-    session = self.sessionMaker_o()
+    cacheKey = ('getUsageDescription', activityDescription_key, role)
+    cachedValue = self.descriptionCache.get(UsageDescription, cacheKey)
+    if cachedValue is not None:
+      return S_OK(cachedValue)
+
+    session = self._getSession()
     try:
       usageDescription = session.query( UsageDescription )\
                           .filter(UsageDescription.activityDescription_key == activityDescription_key, UsageDescription.role == role)\
                           .one()
-      session.commit()
-      return S_OK({'internal_key':usageDescription.internal_key, 'entityDescription_key':usageDescription.entityDescription_key})
+      self._commitRead(session)
+      value = {'internal_key':usageDescription.internal_key, 'entityDescription_key':usageDescription.entityDescription_key}
+      self._cacheSet(UsageDescription, cacheKey, value)
+      return S_OK(value)
     except NoResultFound, e:
       return S_OK()
     finally:
-      session.close()
+      self._closeSession(session)
 
   def getGenerationDescription(self, activityDescription_key, role):
     '''
@@ -1172,18 +1542,25 @@ class ProvenanceDB( object ):
       :return: generationDescription.internal_key
     '''
 
-    session = self.sessionMaker_o()
+    cacheKey = ('getGenerationDescription', activityDescription_key, role)
+    cachedValue = self.descriptionCache.get(GenerationDescription, cacheKey)
+    if cachedValue is not None:
+      return S_OK(cachedValue)
+
+    session = self._getSession()
     try:
       generationDescription = session.query( GenerationDescription )\
                           .filter(GenerationDescription.activityDescription_key == activityDescription_key)\
                           .filter(GenerationDescription.role == role)\
                           .one()
-      session.commit()
-      return S_OK({'internal_key':generationDescription.internal_key, 'entityDescription_key':generationDescription.entityDescription_key})
+      self._commitRead(session)
+      value = {'internal_key':generationDescription.internal_key, 'entityDescription_key':generationDescription.entityDescription_key}
+      self._cacheSet(GenerationDescription, cacheKey, value)
+      return S_OK(value)
     except NoResultFound, e:
       return S_OK()
     finally:
-      session.close()
+      self._closeSession(session)
 
   def getParameterDescription(self, activityDescription_key, parameter_name):
     '''
@@ -1192,18 +1569,25 @@ class ProvenanceDB( object ):
       :return: parameterDescription.internal_key
     '''
 
-    session = self.sessionMaker_o()
+    cacheKey = ('getParameterDescription', activityDescription_key, parameter_name)
+    cachedValue = self.descriptionCache.get(ParameterDescription, cacheKey)
+    if cachedValue is not None:
+      return S_OK(cachedValue)
+
+    session = self._getSession()
     try:
       parameterDescription = session.query( ParameterDescription )\
                           .filter(ParameterDescription.activityDescription_key == activityDescription_key, \
                                   ParameterDescription.name == parameter_name)\
                           .one()
-      session.commit()
-      return S_OK({'internal_key':parameterDescription.internal_key})
+      self._commitRead(session)
+      value = {'internal_key':parameterDescription.internal_key}
+      self._cacheSet(ParameterDescription, cacheKey, value)
+      return S_OK(value)
     except NoResultFound, e:
       return S_OK()
     finally:
-      session.close()
+      self._closeSession(session)
 
   def getConfigFileDescription(self, activityDescription_key, configFile_name):
     '''
@@ -1212,18 +1596,25 @@ class ProvenanceDB( object ):
       :return: configFileDescription.internal_key
     '''
 
-    session = self.sessionMaker_o()
+    cacheKey = ('getConfigFileDescription', activityDescription_key, configFile_name)
+    cachedValue = self.descriptionCache.get(ConfigFileDescription, cacheKey)
+    if cachedValue is not None:
+      return S_OK(cachedValue)
+
+    session = self._getSession()
     try:
       configFileDescription = session.query( ConfigFileDescription )\
                           .filter(ConfigFileDescription.activityDescription_key == activityDescription_key, \
                                   ConfigFileDescription.name == configFile_name)\
                           .one()
-      session.commit()
-      return S_OK({'internal_key':configFileDescription.s})
+      self._commitRead(session)
+      value = {'internal_key':configFileDescription.internal_key}
+      self._cacheSet(ConfigFileDescription, cacheKey, value)
+      return S_OK(value)
     except NoResultFound, e:
       return S_OK()
     finally:
-      session.close()
+      self._closeSession(session)
 
   def getActivityDescriptionKey(self, activityDescription_name, activityDescription_version):
       """
@@ -1231,21 +1622,28 @@ class ProvenanceDB( object ):
         :param activityDescription_name, activityDescription_version
         :return: ActivityDescription.internal_key
       """
-      session = self.sessionMaker_o()
+      cacheKey = ('getActivityDescriptionKey', activityDescription_name, activityDescription_version)
+      cachedValue = self.descriptionCache.get(ActivityDescription, cacheKey)
+      if cachedValue is not None:
+          return S_OK(cachedValue)
+
+      session = self._getSession()
       try:
           activityDescription_list = session.query(ActivityDescription) \
               .filter(ActivityDescription.name == activityDescription_name) \
               .filter(ActivityDescription.version == activityDescription_version) \
               .all()
           activityDescription_last = activityDescription_list[-1]
-          return S_OK({'internal_key': activityDescription_last.internal_key})
+          value = {'internal_key': activityDescription_last.internal_key}
+          self._cacheSet(ActivityDescription, cacheKey, value)
+          return S_OK(value)
 
       except NoResultFound, e:
           return S_OK()
       except :
           return S_OK()
       finally:
-          session.close()
+          self._closeSession(session)
 
   def getEntityDescriptionKey(self, entityDescription_name):
       """
@@ -1253,18 +1651,25 @@ class ProvenanceDB( object ):
         :param entityDescription_name
         :return: EntityDescription.internal_key
       """
-      session = self.sessionMaker_o()
+      cacheKey = ('getEntityDescriptionKey', entityDescription_name)
+      cachedValue = self.descriptionCache.get(EntityDescription, cacheKey)
+      if cachedValue is not None:
+          return S_OK(cachedValue)
+
+      session = self._getSession()
       try:
           entityDescription_list = session.query(EntityDescription)\
                               .filter(EntityDescription.name == entityDescription_name)\
                               .all()
 
           entityDescription_last = entityDescription_list[-1]
-          return S_OK({'internal_key': entityDescription_last.internal_key})
+          value = {'internal_key': entityDescription_last.internal_key}
+          self._cacheSet(EntityDescription, cacheKey, value)
+          return S_OK(value)
       except NoResultFound, e:
           return S_OK()
       finally:
-          session.close()
+          self._closeSession(session)
 
   def getUsageDescriptionKey(self, usageDescription_activity, usageDescription_entity, usageDescription_role):
       """
@@ -1272,7 +1677,12 @@ class ProvenanceDB( object ):
         :param usageDescription_activity, usageDescription_entity, usageDescription_role
         :return: UsageDescription.internal_key
       """
-      session = self.sessionMaker_o()
+      cacheKey = ('getUsageDescriptionKey', usageDescription_activity, usageDescription_entity, usageDescription_role)
+      cachedValue = self.descriptionCache.get(UsageDescription, cacheKey)
+      if cachedValue is not None:
+          return S_OK(cachedValue)
+
+      session = self._getSession()
       try:
           usageDescription_list = session.query(UsageDescription) \
               .filter(UsageDescription.activityDescription_key == usageDescription_activity) \
@@ -1281,11 +1691,13 @@ class ProvenanceDB( object ):
               .all()
 
           usageDescription_last = usageDescription_list[-1]
-          return S_OK({'internal_key': usageDescription_last.internal_key})
+          value = {'internal_key': usageDescription_last.internal_key}
+          self._cacheSet(UsageDescription, cacheKey, value)
+          return S_OK(value)
       except NoResultFound, e:
           return S_OK()
       finally:
-          session.close()
+          self._closeSession(session)
 
   def getGenerationDescriptionKey(self, generationDescription_activity, generationDescription_entity, generationDescription_role):
       """
@@ -1293,7 +1705,12 @@ class ProvenanceDB( object ):
         :param generationDescription_activity, generationDescription_entity, generationDescription_role
         :return: GenerationDescription.internal_key
       """
-      session = self.sessionMaker_o()
+      cacheKey = ('getGenerationDescriptionKey', generationDescription_activity, generationDescription_entity, generationDescription_role)
+      cachedValue = self.descriptionCache.get(GenerationDescription, cacheKey)
+      if cachedValue is not None:
+          return S_OK(cachedValue)
+
+      session = self._getSession()
       try:
           generationDescription_list = session.query(GenerationDescription) \
               .filter(GenerationDescription.activityDescription_key == generationDescription_activity) \
@@ -1302,11 +1719,13 @@ class ProvenanceDB( object ):
               .all()
 
           generationDescription_last = generationDescription_list[-1]
-          return S_OK({'internal_key': generationDescription_last.internal_key})
+          value = {'internal_key': generationDescription_last.internal_key}
+          self._cacheSet(GenerationDescription, cacheKey, value)
+          return S_OK(value)
       except NoResultFound, e:
           return S_OK()
       finally:
-          session.close()
+          self._closeSession(session)
 
   def getAgentKey(self, agent_id):
       """
@@ -1314,14 +1733,21 @@ class ProvenanceDB( object ):
         :param agent_id
         :return: Agent.internal_key
       """
-      session = self.sessionMaker_o()
+      cacheKey = ('getAgentKey', agent_id)
+      cachedValue = self.descriptionCache.get(Agent, cacheKey)
+      if cachedValue is not None:
+          return S_OK(cachedValue)
+
+      session = self._getSession()
       try:
           agent_list = session.query(Agent) \
               .filter(Agent.id == agent_id) \
               .all()
           agent_last = agent_list[-1]
-          return S_OK({'internal_key': agent_last.internal_key})
+          value = {'internal_key': agent_last.internal_key}
+          self._cacheSet(Agent, cacheKey, value)
+          return S_OK(value)
       except NoResultFound, e:
           return S_OK()
       finally:
-          session.close()
+          self._closeSession(session)
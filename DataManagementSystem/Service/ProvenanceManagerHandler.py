@@ -48,7 +48,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addActivityDescription(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addActivityDescription(rowDict)
     return cls._parseRes(res)
 
   types_addActivity= [basestring]
@@ -61,7 +62,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addActivity(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addActivity(rowDict)
     return cls._parseRes(res)
 
   types_addWasAssociatedWith= [basestring]
@@ -74,7 +76,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addWasAssociatedWith(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addWasAssociatedWith(rowDict)
     return cls._parseRes(res)
 
   types_addAgent = [basestring]
@@ -87,7 +90,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addAgent(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addAgent(rowDict)
     return cls._parseRes(res)
 
   types_addDatasetDescription = [basestring]
@@ -100,7 +104,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addDatasetDescription(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addDatasetDescription(rowDict)
     return cls._parseRes(res)
 
   types_addUsageDescription = [basestring]
@@ -113,7 +118,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addUsageDescription(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addUsageDescription(rowDict)
     return cls._parseRes(res)
 
   types_addGenerationDescription = [basestring]
@@ -126,7 +132,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addGenerationDescription(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addGenerationDescription(rowDict)
     return cls._parseRes(res)
 
   types_addValueDescription = [basestring]
@@ -139,7 +146,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addValueDescription(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addValueDescription(rowDict)
     return cls._parseRes(res)
 
   types_addDatasetEntity = [basestring]
@@ -152,7 +160,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addDatasetEntity(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addDatasetEntity(rowDict)
     return cls._parseRes(res)
 
   types_addWasAttributedTo = [basestring]
@@ -165,7 +174,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addWasAttributedTo(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addWasAttributedTo(rowDict)
     return cls._parseRes(res)
 
   types_addUsed = [basestring]
@@ -178,7 +188,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addUsed(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addUsed(rowDict)
     return cls._parseRes(res)
 
   types_addWasGeneratedBy = [basestring]
@@ -191,7 +202,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addWasGeneratedBy(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addWasGeneratedBy(rowDict)
     return cls._parseRes(res)
 
   types_addValueEntity = [basestring]
@@ -204,7 +216,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addValueEntity(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addValueEntity(rowDict)
     return cls._parseRes(res)
 
   types_addWasConfiguredBy= [basestring]
@@ -217,7 +230,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addWasConfiguredBy(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addWasConfiguredBy(rowDict)
     return cls._parseRes(res)
 
   types_addParameter = [basestring]
@@ -230,7 +244,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addParameter(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addParameter(rowDict)
     return cls._parseRes(res)
 
   types_addConfigFile = [basestring]
@@ -243,7 +258,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addConfigFile(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addConfigFile(rowDict)
     return cls._parseRes(res)
 
   types_addParameterDescription = [basestring]
@@ -256,7 +272,8 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addParameterDescription(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addParameterDescription(rowDict)
     return cls._parseRes(res)
 
   types_addConfigFileDescription = [basestring]
@@ -269,7 +286,33 @@ class ProvenanceManagerHandler(RequestHandler):
     '''
 
     rowDict = json.loads(rowJSON)
-    res = cls.__provenanceDB.addConfigFileDescription(rowDict)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addConfigFileDescription(rowDict)
+    return cls._parseRes(res)
+
+  types_addProvenanceGraph = [basestring]
+
+  def export_addProvenanceGraph(cls, graphJSON):
+    '''
+    Insert all the rows of a provenance graph in one transaction
+    :param graphJSON: list of {'type', 'tmp_id', 'row'}, see ProvenanceDB.addProvenanceGraph
+    :return: {tmp_id: internal_key}
+    '''
+
+    graph = json.loads(graphJSON)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.addProvenanceGraph(graph)
+    return cls._parseRes(res)
+
+  types_getPoolStatus = []
+
+  def export_getPoolStatus(cls):
+    '''
+    Get the ProvenanceDB connection pool status, for monitoring
+    :return: {'PoolSize', 'MaxOverflow', 'PoolRecycle', 'CheckedIn', 'CheckedOut', 'Overflow', 'Status'}
+    '''
+
+    res = cls.__provenanceDB.getPoolStatus()
     return cls._parseRes(res)
 
   types_getAgents = []
@@ -315,7 +358,8 @@ class ProvenanceManagerHandler(RequestHandler):
     :return:
     '''
 
-    res = cls.__provenanceDB.updateDatasetEntity(guid, invalidatedAtTime)
+    with cls.__provenanceDB.unitOfWork():
+      res = cls.__provenanceDB.updateDatasetEntity(guid, invalidatedAtTime)
     return cls._parseRes(res)
 
   types_getUsageDescription = []
@@ -0,0 +1,262 @@
+""" Local SQLite snapshot of the DFC file metadata, for repeated offline queries
+
+    The index keeps the user metadata (file and inherited directory metadata) of
+    the files matching some scope queries. A query contained in an indexed scope,
+    i.e. having all the conditions of the scope, is evaluated locally with the
+    MetaQuery semantics. The metadata of the directories, where most metadata are
+    set, are kept apart from the ones set on the files themselves. Refreshing a
+    scope fetches again the metadata of its directories, one request each, the
+    metadata of the new files only, and forgets the removed files.
+"""
+
+__RCSID__ = "$Id$"
+
+import json
+import os
+import sqlite3
+import time
+from multiprocessing.pool import ThreadPool
+
+from DIRAC import S_OK, S_ERROR, gLogger
+from DIRAC.Resources.Catalog.FileCatalogClient import FileCatalogClient
+
+from CTADIRAC.DataManagementSystem.Utilities.MetaQuery import MetaQuery
+
+_SCHEMA = [ "CREATE TABLE IF NOT EXISTS Fields ( Name TEXT PRIMARY KEY, Type TEXT )",
+            "CREATE TABLE IF NOT EXISTS Files ( LFN TEXT PRIMARY KEY, Metadata TEXT )",
+            "CREATE TABLE IF NOT EXISTS FileMeta ( LFN TEXT PRIMARY KEY, Metadata TEXT )",
+            "CREATE TABLE IF NOT EXISTS Directories ( Path TEXT PRIMARY KEY, Metadata TEXT )",
+            "CREATE TABLE IF NOT EXISTS Meta ( LFN TEXT, Name TEXT, Value TEXT )",
+            "CREATE INDEX IF NOT EXISTS MetaNameValue ON Meta ( Name, Value )",
+            "CREATE INDEX IF NOT EXISTS MetaLFN ON Meta ( LFN )",
+            "CREATE TABLE IF NOT EXISTS Scopes ( Scope TEXT PRIMARY KEY, Path TEXT, Refreshed REAL )",
+            "CREATE TABLE IF NOT EXISTS ScopeFiles ( Scope TEXT, LFN TEXT, PRIMARY KEY ( Scope, LFN ) )" ]
+
+class LocalMetadataIndex( object ):
+  """ SQLite index of the user metadata of catalog files
+  """
+
+  def __init__( self, indexFile, nbThreads = 8, timeout = 300 ):
+    """ c'tor
+
+    :param self: self reference
+    :param str indexFile: path of the SQLite file
+    :param int nbThreads: number of concurrent metadata requests when refreshing
+    :param int timeout: timeout of the catalog queries
+    """
+    self.log = gLogger.getSubLogger( self.__class__.__name__, True )
+    self.indexFile = os.path.expanduser( indexFile )
+    self.nbThreads = nbThreads
+    self.timeout = timeout
+    self.fc = FileCatalogClient()
+    self.db = sqlite3.connect( self.indexFile )
+    for statement in _SCHEMA:
+      self.db.execute( statement )
+    self.db.commit()
+
+  def close( self ):
+    """ close the index """
+    self.db.close()
+
+  @staticmethod
+  def _scopeKey( metaDict ):
+    """ canonical form of a scope query """
+    return json.dumps( metaDict, sort_keys = True )
+
+  def getCoveringScope( self, metaDict, path = '/' ):
+    """ get the indexed scope containing a query, i.e. whose conditions are all
+        in the query, for the same path or a parent path
+
+    :return: ( scope, scope path ), or None if there is none
+    """
+    for scope, scopePath in self.db.execute( "SELECT Scope, Path FROM Scopes" ):
+      if not ( path + '/' ).startswith( scopePath.rstrip( '/' ) + '/' ):
+        continue
+      scopeDict = json.loads( scope )
+      if all( key in metaDict and metaDict[key] == value for key, value in scopeDict.iteritems() ):
+        return scope, scopePath
+    return None
+
+  def _refreshFields( self ):
+    """ store the types of the metadata fields
+
+    :return: S_OK( names of the file metadata fields ) / S_ERROR
+    """
+    res = self.fc.getMetadataFields()
+    if not res['OK']:
+      return res
+    fields = dict( res['Value'].get( 'DirectoryMetaFields', res['Value'] ) )
+    fileFields = res['Value'].get( 'FileMetaFields', {} )
+    fields.update( fileFields )
+    self.db.executemany( "INSERT OR REPLACE INTO Fields ( Name, Type ) VALUES ( ?, ? )", fields.items() )
+    return S_OK( set( fileFields ) )
+
+  def _getFileMetadata( self, lfn, fileFields ):
+    """ get the metadata set on a file itself, without the directory metadata """
+    if not fileFields:
+      return S_OK( {} )
+    res = self.fc.getFileUserMetadata( lfn )
+    if not res['OK']:
+      return res
+    return S_OK( dict( ( name, value ) for name, value in res['Value'].iteritems() if name in fileFields ) )
+
+  def refresh( self, metaDict, path = '/' ):
+    """ index or incrementally refresh the files matching a scope query
+
+        The metadata of the directories of the scope are fetched with one request
+        per directory, the metadata set on the files themselves only for the new files.
+        The metadata of a file are rebuilt when it is new or when the metadata of its
+        directory changed.
+
+    :param self: self reference
+    :param dict metaDict: scope metadata query
+    :param str path: catalog path where to look for the files
+    :return: S_OK( { 'Added' : n, 'Removed' : n, 'Refreshed' : n } ) / S_ERROR
+    """
+    res = self._refreshFields()
+    if not res['OK']:
+      return res
+    fileFields = res['Value']
+
+    res = self.fc.findFilesByMetadata( metaDict, path = path, timeout = self.timeout )
+    if not res['OK']:
+      return res
+    lfns = set( res['Value'] )
+
+    scope = self._scopeKey( metaDict )
+    indexed = set( row[0] for row in self.db.execute( "SELECT LFN FROM ScopeFiles WHERE Scope = ?", ( scope, ) ) )
+    removedLFNs = indexed - lfns
+    fileMetadata = dict( ( lfn, json.loads( metadata ) )
+                         for lfn, metadata in self.db.execute( "SELECT LFN, Metadata FROM FileMeta" ) )
+    dirMetadata = dict( self.db.execute( "SELECT Path, Metadata FROM Directories" ) )
+    newLFNs = sorted( lfn for lfn in lfns if lfn not in fileMetadata )
+    directories = sorted( set( os.path.dirname( lfn ) for lfn in lfns ) )
+
+    # Fetch the metadata of the directories and of the new files
+    tasks = [ ( self.fc.getDirectoryUserMetadata, directory ) for directory in directories ] + \
+            [ ( lambda lfn: self._getFileMetadata( lfn, fileFields ), lfn ) for lfn in newLFNs ]
+    results = []
+    if tasks:
+      pool = ThreadPool( max( 1, min( self.nbThreads, len( tasks ) ) ) )
+      try:
+        results = pool.map( lambda task: task[0]( task[1] ), tasks )
+      finally:
+        pool.terminate()
+
+    changedDirs = set()
+    for directory, res in zip( directories, results ):
+      if not res['OK']:
+        # The files of the directory keep their previous metadata, if any
+        self.log.warn( 'Could not get the directory metadata', '%s: %s' % ( directory, res['Message'] ) )
+        continue
+      metadata = json.dumps( res['Value'], sort_keys = True )
+      if dirMetadata.get( directory ) != metadata:
+        dirMetadata[directory] = metadata
+        changedDirs.add( directory )
+        self.db.execute( "INSERT OR REPLACE INTO Directories ( Path, Metadata ) VALUES ( ?, ? )",
+                         ( directory, metadata ) )
+    for lfn, res in zip( newLFNs, results[len( directories ):] ):
+      if not res['OK']:
+        self.log.warn( 'Could not get the metadata', '%s: %s' % ( lfn, res['Message'] ) )
+        continue
+      fileMetadata[lfn] = res['Value']
+      self.db.execute( "INSERT OR REPLACE INTO FileMeta ( LFN, Metadata ) VALUES ( ?, ? )",
+                       ( lfn, json.dumps( res['Value'] ) ) )
+
+    # The files without metadata are only indexed once their metadata are known
+    lfns = set( lfn for lfn in lfns if lfn in fileMetadata and os.path.dirname( lfn ) in dirMetadata )
+    addedLFNs = lfns - indexed
+
+    # Rebuild the metadata of the new files and of the files of the changed directories
+    newLFNs = set( newLFNs )
+    refreshedLFNs = [ lfn for lfn in lfns if lfn in newLFNs or os.path.dirname( lfn ) in changedDirs ]
+    for lfn in refreshedLFNs:
+      metadata = json.loads( dirMetadata[os.path.dirname( lfn )] )
+      metadata.update( fileMetadata[lfn] )
+      self.db.execute( "INSERT OR REPLACE INTO Files ( LFN, Metadata ) VALUES ( ?, ? )",
+                       ( lfn, json.dumps( metadata ) ) )
+      self.db.execute( "DELETE FROM Meta WHERE LFN = ?", ( lfn, ) )
+      self.db.executemany( "INSERT INTO Meta ( LFN, Name, Value ) VALUES ( ?, ?, ? )",
+                           [ ( lfn, name, str( value ) ) for name, value in metadata.iteritems() ] )
+
+    self.db.executemany( "INSERT OR IGNORE INTO ScopeFiles ( Scope, LFN ) VALUES ( ?, ? )",
+                         [ ( scope, lfn ) for lfn in addedLFNs ] )
+    self.db.executemany( "DELETE FROM ScopeFiles WHERE Scope = ? AND LFN = ?",
+                         [ ( scope, lfn ) for lfn in removedLFNs ] )
+    self.db.execute( "INSERT OR REPLACE INTO Scopes ( Scope, Path, Refreshed ) VALUES ( ?, ?, ? )",
+                     ( scope, path, time.time() ) )
+    # Forget the files which are not in any scope anymore, and their directories
+    orphans = "SELECT LFN FROM Files WHERE LFN NOT IN ( SELECT LFN FROM ScopeFiles )"
+    self.db.execute( "DELETE FROM Meta WHERE LFN IN ( %s )" % orphans )
+    self.db.execute( "DELETE FROM FileMeta WHERE LFN NOT IN ( SELECT LFN FROM ScopeFiles )" )
+    self.db.execute( "DELETE FROM Files WHERE LFN IN ( %s )" % orphans )
+    usedDirs = set( os.path.dirname( row[0] ) for row in self.db.execute( "SELECT LFN FROM Files" ) )
+    self.db.executemany( "DELETE FROM Directories WHERE Path = ?",
+                         [ ( directory, ) for directory in dirMetadata if directory not in usedDirs ] )
+    self.db.commit()
+
+    self.log.info( 'Refreshed index scope', '%s: %d new files, %d removed files, %d files refreshed' %
+                   ( scope, len( addedLFNs ), len( removedLFNs ), len( refreshedLFNs ) ) )
+    return S_OK( { 'Added' : len( addedLFNs ), 'Removed' : len( removedLFNs ), 'Refreshed' : len( refreshedLFNs ) } )
+
+  def find( self, metaDict, path = '/' ):
+    """ find the indexed files matching a metadata query, with the MetaQuery semantics
+
+    :param self: self reference
+    :param dict metaDict: metadata query, contained in an indexed scope
+    :param str path: catalog path where to look for the files
+    :return: S_OK( list of LFNs ) / S_ERROR
+    """
+    covering = self.getCoveringScope( metaDict, path )
+    if covering is None:
+      return S_ERROR( 'Query not covered by the local index: %s' % self._scopeKey( metaDict ) )
+    scope = covering[0]
+
+    metaTypeDict = dict( self.db.execute( "SELECT Name, Type FROM Fields" ) )
+    unknown = [ meta for meta in metaDict if meta not in metaTypeDict ]
+    if unknown:
+      return S_ERROR( 'Metadata field %s not defined' % ', '.join( unknown ) )
+
+    # Pre-select the files with the string equality conditions, using the index
+    query = "SELECT Files.LFN, Files.Metadata FROM Files JOIN ScopeFiles ON Files.LFN = ScopeFiles.LFN " \
+            "WHERE ScopeFiles.Scope = ? AND substr( Files.LFN, 1, ? ) = ?"
+    prefix = path.rstrip( '/' ) + '/'
+    args = [ scope, len( prefix ), prefix ]
+    for meta, value in metaDict.iteritems():
+      if isinstance( value, basestring ) and value.lower() not in [ 'any', 'missing' ] and \
+         metaTypeDict[meta][0:7].lower() == 'varchar':
+        query += " AND Files.LFN IN ( SELECT LFN FROM Meta WHERE Name = ? AND Value = ? )"
+        args += [ meta, value ]
+
+    fileMetadata = dict( ( lfn, json.loads( metadata ) ) for lfn, metadata in self.db.execute( query, args ) )
+    return MetaQuery( metaDict, metaTypeDict ).filter( fileMetadata )
+
+def findFilesByMetadata( metaDict, path = '/', indexFile = None, refresh = False, timeout = 300 ):
+  """ find files by metadata in the local index if given, or in the catalog
+
+      The query is added to the index as a new scope when no indexed scope
+      contains it, and its scope is refreshed on demand.
+
+  :param dict metaDict: metadata query
+  :param str path: catalog path where to look for the files
+  :param str indexFile: path of the local index, None to query the catalog
+  :param bool refresh: refresh the indexed scope containing the query
+  :return: S_OK( list of LFNs ) / S_ERROR
+  """
+  if not indexFile:
+    return FileCatalogClient().findFilesByMetadata( metaDict, path = path, timeout = timeout )
+
+  index = LocalMetadataIndex( indexFile, timeout = timeout )
+  try:
+    covering = index.getCoveringScope( metaDict, path )
+    if covering is None:
+      res = index.refresh( metaDict, path )
+    elif refresh:
+      res = index.refresh( json.loads( covering[0] ), covering[1] )
+    else:
+      res = S_OK()
+    if not res['OK']:
+      return res
+    return index.find( metaDict, path )
+  finally:
+    index.close()
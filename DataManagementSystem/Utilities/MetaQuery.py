@@ -16,11 +16,82 @@ import DIRAC.Core.Utilities.Time as Time
 from types import ListType, DictType, StringTypes, IntType, LongType, FloatType
 import json
 
+def getTypeConverter( mtype ):
+  """ Get the function converting a value to the python type of a metadata type
+  """
+  if mtype[0:3].lower() == 'int':
+    return int
+  elif mtype[0:5].lower() == 'float':
+    return float
+  elif mtype[0:4].lower() == 'date':
+    return Time.fromString
+  return None
+
+def getOperands( value ):
+  """ Get the list of ( operation, operand ) of the query of one metadata
+  """
+  if type( value ) == ListType:
+    return [ ('in', value) ]
+  elif type( value ) == DictType:
+    return value.items()
+  else:
+    return [ ("=", value) ]
+
+def _makeCheck( operation, typedValue ):
+  """ Make the function checking a typed user value against a typed operand
+  """
+  if operation in ['>', '<', '>=', '<=']:
+    if type( typedValue ) == ListType:
+      raise TypeError( 'Illegal query: list of values for comparison operation' )
+    if operation == '>':
+      return lambda userValue: userValue > typedValue
+    elif operation == '<':
+      return lambda userValue: userValue < typedValue
+    elif operation == '>=':
+      return lambda userValue: userValue >= typedValue
+    return lambda userValue: userValue <= typedValue
+  elif operation in ['in', '=']:
+    if type( typedValue ) == ListType:
+      valueSet = frozenset( typedValue )
+      return lambda userValue: userValue in valueSet
+    return lambda userValue: userValue == typedValue
+  elif operation in ['nin', '!=']:
+    if type( typedValue ) == ListType:
+      valueSet = frozenset( typedValue )
+      return lambda userValue: userValue not in valueSet
+    return lambda userValue: userValue != typedValue
+  # Unknown operations do not filter anything, as in applyQuery
+  return None
+
+# Number of metadata dictionaries fully evaluated by filter to collect
+# the statistics used to order the query
+PLANNER_SAMPLE_SIZE = 1000
+# Maximum number of distinct values counted per metadata
+MAX_TRACKED_VALUES = 1000
+
+def _getColumnMissing( numpy, column ):
+  """ Split a column of metadata values into its values and the mask of the
+      undefined values: masked (numpy.ma), None or NaN
+  """
+  if isinstance( column, numpy.ma.MaskedArray ):
+    missing = numpy.ma.getmaskarray( column ).copy()
+    column = column.data
+  else:
+    column = numpy.asarray( column )
+    missing = numpy.zeros( len( column ), dtype = bool )
+  if column.dtype.kind == 'f':
+    missing |= numpy.isnan( column )
+  elif column.dtype.kind == 'O':
+    missing |= numpy.array( [ x is None for x in column ], dtype = bool )
+  return column, missing
+
 class MetaQuery( object ):
 
   def __init__( self, queryDict = None, metaTypeDict = None ):
     self.__metaQueryDict = queryDict
     self.__metaTypeDict = metaTypeDict
+    self.__compiledQuery = None
+    self.__queryStats = {}
 
   def setMetaQuery( self, queryList, metaTypeDict ):
     """ Create the metadata query out of the command line arguments
@@ -119,6 +190,8 @@ class MetaQuery( object ):
         metaDict[name] = mvalue
 
     self.__metaQueryDict = metaDict
+    self.__compiledQuery = None
+    self.__queryStats = {}
     return S_OK( metaDict )
 
   def getMetaQuery( self ):
@@ -129,80 +202,269 @@ class MetaQuery( object ):
 
     return json.dumps( self.__metaQueryDict )
 
-  def applyQuery( self, userMetaDict ):
-    """  Return a list of tuples with tables and conditions to locate files for a given user Metadata
+  def compileQuery( self ):
+    """ Compile the meta query into a list of ( meta, mode, converter, checks ) where
+        the operands are converted once to the metadata type, the in/nin values are
+        turned into sets and each operation is a precomputed check function.
+        mode is 'missing' or 'any' for such queries, None otherwise.
+        A metadata queried as Missing only matches when it is not defined.
     """
-    def getOperands( value ):
-      if type( value ) == ListType:
-        return [ ('in', value) ]
-      elif type( value ) == DictType:
-        resultList = []
-        for operation, operand in value.items():
-          resultList.append( ( operation, operand ) )
-        return resultList
-      else:
-        return [ ("=", value) ]
-
-    def getTypedValue( value, mtype ):
-      if mtype[0:3].lower() == 'int':
-        return int( value )
-      elif mtype[0:5].lower() == 'float':
-        return float( value )
-      elif mtype[0:4].lower() == 'date':
-        return Time.fromString( value )
-      else:
-        return value
-
+    if self.__compiledQuery is not None:
+      return S_OK( self.__compiledQuery )
 
+    compiledQuery = []
     for meta, value in self.__metaQueryDict.items():
+      mode = str( value ).lower()
+      if mode in ['missing', 'any']:
+        compiledQuery.append( ( meta, mode, None, [] ) )
+        continue
 
-      # Check if user dict contains all the requested meta data
+      converter = getTypeConverter( self.__metaTypeDict[meta] )
+      checks = []
+      for operation, operand in getOperands( value ):
+        try:
+          if converter is None:
+            typedValue = operand
+          elif type( operand ) == ListType:
+            typedValue = [ converter( x ) for x in operand ]
+          else:
+            typedValue = converter( operand )
+          check = _makeCheck( operation, typedValue )
+        except ValueError:
+          return S_ERROR( 'Illegal type for metadata %s: %s in filter' % ( meta, str( operand ) ) )
+        except TypeError as e:
+          return S_ERROR( str( e ) )
+        if check is not None:
+          checks.append( check )
+      compiledQuery.append( ( meta, None, converter, checks ) )
+
+    self.__compiledQuery = compiledQuery
+    return S_OK( compiledQuery )
+
+  @staticmethod
+  def _evaluate( compiledQuery, userMetaDict ):
+    """ Evaluate a compiled query on a user metadata dictionary,
+        raise ValueError if a user value has not the metadata type
+    """
+    for meta, mode, converter, checks in compiledQuery:
       userValue = userMetaDict.get( meta, None )
       if userValue is None:
-        if str( value ).lower() == 'missing':
+        if mode == 'missing':
           continue
+        return False
+      elif mode == 'any':
+        continue
+      elif mode == 'missing':
+        return False
+
+      if converter is not None:
+        try:
+          userValue = converter( userValue )
+        except ValueError:
+          raise ValueError( 'Illegal type for metadata %s: %s in user data' % ( meta, str( userValue ) ) )
+      for check in checks:
+        if not check( userValue ):
+          return False
+    return True
+
+  def __evaluateWithStats( self, compiledQuery, userMetaDict ):
+    """ Evaluate all the conditions of a compiled query, without short-circuit,
+        counting how often each metadata condition passes and its distinct values
+    """
+    result = True
+    for entry in compiledQuery:
+      meta = entry[0]
+      passed = self._evaluate( [ entry ], userMetaDict )
+      stats = self.__queryStats.setdefault( meta, { 'Evaluated' : 0, 'Passed' : 0, 'Values' : set() } )
+      stats['Evaluated'] += 1
+      if passed:
+        stats['Passed'] += 1
+      if len( stats['Values'] ) < MAX_TRACKED_VALUES:
+        try:
+          stats['Values'].add( userMetaDict.get( meta, None ) )
+        except TypeError:
+          pass
+      result = result and passed
+    return result
+
+  def __getPassRate( self, meta ):
+    """ Estimated probability that a metadata condition passes, 0.5 when unknown
+    """
+    stats = self.__queryStats.get( meta )
+    if not stats or not stats['Evaluated']:
+      return 0.5
+    # Laplace smoothing so that small samples do not give definitive rates
+    return ( stats['Passed'] + 1. ) / ( stats['Evaluated'] + 2. )
+
+  def planQuery( self ):
+    """ Order the compiled query so that the most selective conditions are
+        evaluated first: by increasing pass rate observed by filter, then by
+        decreasing number of distinct values, Any conditions being last
+    """
+    result = self.compileQuery()
+    if not result['OK']:
+      return result
+    def selectivity( entry ):
+      meta, mode = entry[0], entry[1]
+      if mode == 'any':
+        return ( 2., 0 )
+      stats = self.__queryStats.get( meta, {} )
+      return ( self.__getPassRate( meta ), -len( stats.get( 'Values', () ) ) )
+    self.__compiledQuery.sort( key = selectivity )
+    return S_OK( [ entry[0] for entry in self.__compiledQuery ] )
+
+  def getQueryStats( self ):
+    """ Get the statistics collected on the query conditions, and the
+        evaluation order of the conditions
+
+        :return: { meta : { 'Evaluated', 'Passed', 'PassRate', 'Cardinality', 'Rank' } }
+    """
+    order = [ entry[0] for entry in ( self.__compiledQuery or [] ) ]
+    queryStats = {}
+    for meta in self.__metaQueryDict or {}:
+      stats = self.__queryStats.get( meta, {} )
+      queryStats[meta] = { 'Evaluated' : stats.get( 'Evaluated', 0 ),
+                           'Passed' : stats.get( 'Passed', 0 ),
+                           'PassRate' : self.__getPassRate( meta ),
+                           'Cardinality' : len( stats.get( 'Values', () ) ),
+                           'Rank' : order.index( meta ) if meta in order else None }
+    return queryStats
+
+  def filter( self, userMetaDicts ):
+    """ Filter in bulk a list of user metadata dictionaries with the compiled query
+
+        The first PLANNER_SAMPLE_SIZE dictionaries are fully evaluated to collect
+        the selectivity of the conditions, then the query is reordered with
+        planQuery so that the non-matching dictionaries are rejected early.
+
+        :param userMetaDicts: iterable of user metadata dictionaries, or dictionary of
+                              user metadata dictionaries, e.g. { lfn : metadata }
+        :return: S_OK( list of matching dictionaries, or of matching keys ) / S_ERROR
+    """
+    result = self.compileQuery()
+    if not result['OK']:
+      return result
+    compiledQuery = result['Value']
+    evaluate = self._evaluate
+
+    if type( userMetaDicts ) == DictType:
+      items = userMetaDicts.iteritems()
+    else:
+      items = ( ( userMetaDict, userMetaDict ) for userMetaDict in userMetaDicts )
+
+    matching = []
+    nSampled = 0
+    try:
+      for key, userMetaDict in items:
+        if nSampled < PLANNER_SAMPLE_SIZE:
+          passed = self.__evaluateWithStats( compiledQuery, userMetaDict )
+          nSampled += 1
+          if nSampled == PLANNER_SAMPLE_SIZE:
+            self.planQuery()
         else:
-          return S_OK( False )
-      elif str( value ).lower() == 'any':
+          passed = evaluate( compiledQuery, userMetaDict )
+        if passed:
+          matching.append( key )
+    except ValueError as e:
+      return S_ERROR( str( e ) )
+    if 0 < nSampled < PLANNER_SAMPLE_SIZE:
+      self.planQuery()
+    return S_OK( matching )
+
+  def applyQueryColumns( self, columns ):
+    """ Evaluate the query on columns of metadata values, e.g. DFC file metadata
+        exported to tables, rather than on one user metadata dictionary at a time
+
+        :param dict columns: { meta : numpy array }, all arrays of the same length, the
+                             undefined values being masked (numpy.ma), None or NaN,
+                             the date values being strings as in the user metadata
+                             or datetime64
+        :return: S_OK( numpy boolean array of the matching rows ) / S_ERROR
+    """
+    # numpy is only needed for this columnar evaluation
+    import numpy
+
+    if not columns:
+      return S_ERROR( 'No metadata column to apply the query to' )
+    nRows = len( columns.values()[0] )
+    mask = numpy.ones( nRows, dtype = bool )
+    for meta, value in self.__metaQueryDict.items():
+      mode = str( value ).lower()
+      column = columns.get( meta )
+      if column is None:
+        missing = numpy.ones( nRows, dtype = bool )
+      else:
+        column, missing = _getColumnMissing( numpy, column )
+      if mode == 'missing':
+        mask &= missing
+        continue
+      # Any only requires the metadata to be defined
+      mask &= ~missing
+      if column is None or mode == 'any':
         continue
 
-      mtype = self.__metaTypeDict[meta]
-      try:
-        userValue = getTypedValue( userValue, mtype )
-      except ValueError:
-        return S_ERROR( 'Illegal type for metadata %s: %s in user data' % ( meta, str( userValue ) ) )
+      converter = getTypeConverter( self.__metaTypeDict[meta] )
+      toColumnType = lambda typedValue: typedValue
+      dtype = { int : numpy.int64, float : numpy.float64 }.get( converter )
+      if converter is Time.fromString:
+        # Dates are converted as in applyQuery, then compared as datetime64
+        toColumnType = lambda typedValue: numpy.datetime64( typedValue, 'us' )
+        if column.dtype.kind != 'M':
+          dates = [ None if isMissing else converter( userValue ) for userValue, isMissing in zip( column, missing ) ]
+          if any( date is None for date, isMissing in zip( dates, missing ) if not isMissing ):
+            return S_ERROR( 'Illegal type for metadata %s in user data' % meta )
+          column = numpy.array( dates, dtype = 'datetime64[us]' )
+      elif dtype is not None and column.dtype != dtype:
+        if column.dtype.kind == 'O' and missing.any():
+          column = column.copy()
+          column[missing] = 0
+        try:
+          column = column.astype( dtype )
+        except ( ValueError, TypeError ):
+          return S_ERROR( 'Illegal type for metadata %s in user data' % meta )
 
-      # Check operations
       for operation, operand in getOperands( value ):
         try:
-          if type( operand ) == ListType:
-            typedValue = [ getTypedValue( x, mtype ) for x in operand ]
+          if converter is None:
+            typedValue = operand
+          elif type( operand ) == ListType:
+            typedValue = [ toColumnType( converter( x ) ) for x in operand ]
           else:
-            typedValue = getTypedValue( operand, mtype )
+            typedValue = toColumnType( converter( operand ) )
         except ValueError:
           return S_ERROR( 'Illegal type for metadata %s: %s in filter' % ( meta, str( operand ) ) )
 
-        # Apply query operation
         if operation in ['>', '<', '>=', '<=']:
           if type( typedValue ) == ListType:
             return S_ERROR( 'Illegal query: list of values for comparison operation' )
-          elif operation == '>' and typedValue >= userValue:
-            return S_OK( False )
-          elif operation == '<' and typedValue <= userValue:
-            return S_OK( False )
-          elif operation == '>=' and typedValue > userValue:
-            return S_OK( False )
-          elif operation == '<=' and typedValue < userValue:
-            return S_OK( False )
-        elif operation == 'in' or operation == "=":
-          if type( typedValue ) == ListType and not userValue in typedValue:
-            return S_OK( False )
-          elif type( typedValue ) != ListType and userValue != typedValue:
-            return S_OK( False )
-        elif operation == 'nin' or operation == "!=":
-          if type( typedValue ) == ListType and userValue in typedValue:
-            return S_OK( False )
-          elif type( typedValue ) != ListType and userValue == typedValue:
-            return S_OK( False )
-
-    return S_OK( True )
+          if operation == '>':
+            mask &= column > typedValue
+          elif operation == '<':
+            mask &= column < typedValue
+          elif operation == '>=':
+            mask &= column >= typedValue
+          else:
+            mask &= column <= typedValue
+        elif operation in ['in', '=']:
+          if type( typedValue ) == ListType:
+            mask &= numpy.isin( column, typedValue )
+          else:
+            mask &= column == typedValue
+        elif operation in ['nin', '!=']:
+          if type( typedValue ) == ListType:
+            mask &= ~numpy.isin( column, typedValue )
+          else:
+            mask &= column != typedValue
+
+    return S_OK( mask )
+
+  def applyQuery( self, userMetaDict ):
+    """  Return a list of tuples with tables and conditions to locate files for a given user Metadata
+    """
+    result = self.compileQuery()
+    if not result['OK']:
+      return result
+    try:
+      return S_OK( self._evaluate( result['Value'], userMetaDict ) )
+    except ValueError as e:
+      return S_ERROR( str( e ) )
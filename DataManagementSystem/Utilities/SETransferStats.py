@@ -0,0 +1,171 @@
+""" Rolling transfer statistics per Storage Element
+
+    The observed transfer rates and failure rates of the SEs are kept as
+    exponential moving averages, and persisted in a small JSON file so that
+    they survive the process and can be shared by the jobs running on a node.
+    The jobs merge their statistics in the file under a lock, keeping per SE
+    the most recently updated entry.
+"""
+
+__RCSID__ = "$Id$"
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+from DIRAC import gLogger
+
+class SETransferStats( object ):
+  """ Keep track of the recent transfer rate and failure rate of SEs
+  """
+
+  def __init__( self, statsFile = None, alpha = 0.3 ):
+    """ c'tor
+
+    :param self: self reference
+    :param str statsFile: path to the JSON file where the statistics are persisted, None to keep them in memory
+    :param float alpha: weight of the last transfer in the moving averages
+    """
+    self.log = gLogger.getSubLogger( self.__class__.__name__, True )
+    self.statsFile = statsFile
+    self.alpha = alpha
+    self.__lock = threading.Lock()
+    self.__stats = {}
+    self.load()
+
+  def __readStatsFile( self ):
+    """ read the statistics of the stats file, {} if there are none """
+    if not os.path.exists( self.statsFile ):
+      return {}
+    try:
+      with open( self.statsFile ) as statsFile:
+        return json.load( statsFile )
+    except ( IOError, ValueError ) as e:
+      self.log.debug( 'Could not read SE statistics', '%s %s' % ( self.statsFile, e ) )
+      return {}
+
+  def __merge( self, stats ):
+    """ merge statistics read from the stats file, keeping per SE the most recently updated entry
+        must be called with the lock held
+    """
+    for seName, seStats in stats.iteritems():
+      ownStats = self.__stats.get( seName )
+      if ownStats is None or seStats.get( 'LastUpdate', 0. ) > ownStats.get( 'LastUpdate', 0. ):
+        self.__stats[seName] = seStats
+
+  def load( self ):
+    """ read the statistics from the stats file, if any """
+    if not self.statsFile:
+      return
+    stats = self.__readStatsFile()
+    with self.__lock:
+      self.__merge( stats )
+
+  def save( self ):
+    """ merge the statistics with the ones saved meanwhile by other processes
+        and write them to the stats file, atomically
+    """
+    if not self.statsFile:
+      return
+    tmpFile = '%s.%d.tmp' % ( self.statsFile, os.getpid() )
+    try:
+      # The stats file itself is replaced by the rename, hence the separate lock file
+      with open( '%s.lock' % self.statsFile, 'a' ) as lockFile:
+        fcntl.flock( lockFile, fcntl.LOCK_EX )
+        try:
+          stats = self.__readStatsFile()
+          with self.__lock:
+            self.__merge( stats )
+            with open( tmpFile, 'w' ) as statsFile:
+              json.dump( self.__stats, statsFile )
+          os.rename( tmpFile, self.statsFile )
+        finally:
+          fcntl.flock( lockFile, fcntl.LOCK_UN )
+    except ( IOError, OSError ) as e:
+      self.log.debug( 'Could not write SE statistics', '%s %s' % ( self.statsFile, e ) )
+
+  def addTransfer( self, seName, ok, size = 0, elapsed = 0. ):
+    """ record the outcome of a transfer
+
+    :param self: self reference
+    :param str seName: DIRAC SE name
+    :param bool ok: whether the transfer succeeded
+    :param int size: number of bytes transferred
+    :param float elapsed: duration of the transfer in seconds
+    """
+    with self.__lock:
+      seStats = self.__stats.setdefault( seName, { 'Transfers' : 0, 'Failures' : 0,
+                                                   'Rate' : None, 'FailureRate' : 0.,
+                                                   'Latency' : None, 'LastFailure' : 0. } )
+      seStats['LastUpdate'] = time.time()
+      seStats['Transfers'] += 1
+      seStats['FailureRate'] = ( 1. - self.alpha ) * seStats['FailureRate'] + self.alpha * ( 0. if ok else 1. )
+      if not ok:
+        seStats['Failures'] += 1
+        seStats['LastFailure'] = time.time()
+        return
+      if seStats['Latency'] is None:
+        seStats['Latency'] = elapsed
+      else:
+        seStats['Latency'] = ( 1. - self.alpha ) * seStats['Latency'] + self.alpha * elapsed
+      if size and elapsed > 0:
+        rate = size / elapsed
+        if seStats['Rate'] is None:
+          seStats['Rate'] = rate
+        else:
+          seStats['Rate'] = ( 1. - self.alpha ) * seStats['Rate'] + self.alpha * rate
+
+  def getStats( self, seName = None ):
+    """ get a copy of the statistics of one or all SEs """
+    with self.__lock:
+      if seName is not None:
+        return dict( self.__stats.get( seName, {} ) )
+      return dict( ( se, dict( seStats ) ) for se, seStats in self.__stats.iteritems() )
+
+  def rankSEs( self, seList ):
+    """ sort SEs by decreasing effective transfer rate, rate * ( 1 - failure rate )
+
+    SEs without measured rate are put first so that they get measured.
+    The sort is stable, hence SEs with the same score keep their input order.
+
+    :param self: self reference
+    :param list seList: SE names
+    """
+    def score( seName ):
+      seStats = self.__stats.get( seName )
+      if not seStats or seStats['Rate'] is None:
+        return float( 'inf' ) if not seStats or not seStats['FailureRate'] else 0.
+      return seStats['Rate'] * ( 1. - seStats['FailureRate'] )
+    with self.__lock:
+      return sorted( seList, key = score, reverse = True )
+
+  def isDemoted( self, seName, maxFailureRate = 0.5, demotionTime = 600 ):
+    """ tell whether an SE is temporarily demoted: its failure rate is above
+        maxFailureRate and it failed less than demotionTime seconds ago
+
+    :param self: self reference
+    :param str seName: DIRAC SE name
+    :param float maxFailureRate: failure rate above which the SE is demoted
+    :param int demotionTime: duration of the demotion after the last failure, in seconds
+    """
+    with self.__lock:
+      seStats = self.__stats.get( seName )
+      if not seStats:
+        return False
+      return seStats['FailureRate'] > maxFailureRate and time.time() - seStats['LastFailure'] < demotionTime
+
+  def demoteSEs( self, seList, maxFailureRate = 0.5, demotionTime = 600 ):
+    """ move the demoted SEs at the end of the list, keeping the order otherwise,
+        so that they are only tried as a last resort
+
+    :param self: self reference
+    :param list seList: SE names
+    :param float maxFailureRate: failure rate above which the SE is demoted
+    :param int demotionTime: duration of the demotion after the last failure, in seconds
+    """
+    demoted = [se for se in seList if self.isDemoted( se, maxFailureRate, demotionTime )]
+    if demoted:
+      self.log.info( 'Demoted SEs', ', '.join( demoted ) )
+    return [se for se in seList if se not in demoted] + demoted
@@ -50,6 +50,7 @@ class EvnDispProd5Job(Job):
         self.file_meta_data = dict()
         self.catalogs = json.dumps(['DIRACFileCatalog', 'TSCatalog'])
         self.ts_task_id = 0
+        self.md_fields_fingerprint = None
 
     def set_meta_data(self, tel_sim_md):
         """ Set EventDisplay meta data
@@ -85,6 +86,18 @@ class EvnDispProd5Job(Job):
         # Set evndisp file meta data
         self.file_meta_data['nsb'] = nsb
 
+    def get_meta_data_field(self):
+        """ Get the definition of the directory meta data fields,
+        to be registered once with the transformation,
+        see tool_box.register_metadata_fields
+        """
+        return {'array_layout': 'VARCHAR(128)', 'site': 'VARCHAR(128)',
+                'particle': 'VARCHAR(128)',
+                'phiP': 'float', 'thetaP': 'float',
+                self.program_category + '_prog': 'VARCHAR(128)',
+                self.program_category + '_prog_version': 'VARCHAR(128)',
+                'data_level': 'int', 'configuration_id': 'int'}
+
     def setupWorkflow(self, debug=False):
         """ Setup job workflow by defining the sequence of all executables
             All parameters shall have been defined before that method is called.
@@ -138,23 +151,21 @@ class EvnDispProd5Job(Job):
         meta_data_json = json.dumps(self.metadata)
         file_meta_data_json = json.dumps(self.file_meta_data)
 
-        meta_data_field = {'array_layout':'VARCHAR(128)', 'site':'VARCHAR(128)',
-                           'particle':'VARCHAR(128)',
-                           'phiP':'float', 'thetaP': 'float',
-                           self.program_category+'_prog':'VARCHAR(128)',
-		                   self.program_category+'_prog_version':'VARCHAR(128)',
-                           'data_level': 'int', 'configuration_id': 'int'}
-        meta_data_field_json = json.dumps(meta_data_field)
+        meta_data_field_json = json.dumps(self.get_meta_data_field())
+        # fields registered with the transformation are not added again by the jobs
+        fingerprint = ''
+        if self.md_fields_fingerprint:
+            fingerprint = ' %s' % self.md_fields_fingerprint
 
         # register Data
         data_output_pattern = './*evndisp-DL%01d.tar.gz'%self.output_data_level
         scripts = '../CTADIRAC/Core/scripts/'
         dm_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                     arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Data" %
+                                     arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Data%s" %
                                      (meta_data_json, meta_data_field_json,
                                       file_meta_data_json,
                                       self.base_path, data_output_pattern, self.package,
-                                      self.program_category, self.catalogs),
+                                      self.program_category, self.catalogs, fingerprint),
                                      logFile='DataManagement_Log.txt')
         dm_step['Value']['name'] = 'Step%s_DataManagement' % i_step
         dm_step['Value']['descr_short'] = 'Save data files to SE and register them in DFC'
@@ -166,11 +177,11 @@ class EvnDispProd5Job(Job):
         file_meta_data_json = json.dumps(file_meta_data)
         scripts = '../CTADIRAC/Core/scripts/'
         log_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                      arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Log" %
+                                      arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Log%s" %
                                       (meta_data_json, meta_data_field_json,
                                        file_meta_data_json,
                                        self.base_path, log_file_pattern, self.package,
-                                       self.program_category, self.catalogs),
+                                       self.program_category, self.catalogs, fingerprint),
                                       logFile='LogManagement_Log.txt')
         log_step['Value']['name'] = 'Step%s_LogManagement' % i_step
         log_step['Value']['descr_short'] = 'Save log to SE and register them in DFC'
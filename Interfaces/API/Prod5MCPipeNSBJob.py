@@ -13,6 +13,7 @@ import collections
 import DIRAC
 from DIRAC.Interfaces.API.Job import Job
 from CTADIRAC.Core.Utilities.tool_box import DATA_LEVEL_METADATA_ID
+from CTADIRAC.Core.Utilities.tool_box import add_managedata_manifest_step
 
 
 class Prod5MCPipeNSBJob(Job):
@@ -201,97 +202,27 @@ class Prod5MCPipeNSBJob(Job):
                            'data_level': 'int', 'configuration_id': 'int'}
         md_field_json = json.dumps(meta_data_field)
 
-        # Upload and register data - NSB=1 dark
-        file_meta_data = {'runNumber': self.run_number, 'nsb':1}
-        file_md_json = json.dumps(file_meta_data)
-        data_output_pattern = 'Data/sim_telarray/cta-prod5-%s/0.0deg/Data/*dark*.simtel.zst' %\
-                               self.cta_site.lower()
-
-        scripts = '../CTADIRAC/Core/scripts/'
-        dm_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                     arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Data" %
-                                     (md_json, md_field_json, file_md_json,
-                                      self.base_path, data_output_pattern, self.package,
-                                      self.program_category, self.catalogs),
-                                     logFile='DataManagement_dark_Log.txt')
+        # Upload and register data, log and histogram files for both NSB levels
+        # in a single data management step
+        sim_dir = 'Data/sim_telarray/cta-prod5-%s/0.0deg' % self.cta_site.lower()
+        manifest = []
+        for nsb_name, nsb in [('dark', 1), ('moon', 5)]:
+            manifest.append({'pattern': '%s/Data/*%s*.simtel.zst' % (sim_dir, nsb_name),
+                             'output_type': 'Data',
+                             'file_metadata': {'runNumber': self.run_number, 'nsb': nsb}})
+            manifest.append({'pattern': '%s/Log/*%s*.log.gz' % (sim_dir, nsb_name),
+                             'output_type': 'Log',
+                             'file_metadata': {}})
+            manifest.append({'pattern': '%s/Histograms/*%s*.hdata.zst' % (sim_dir, nsb_name),
+                             'output_type': 'Histograms',
+                             'file_metadata': {}})
+
+        dm_step = add_managedata_manifest_step(self, manifest, md_json, md_field_json,
+                                               self.base_path, self.package,
+                                               self.program_category, self.catalogs,
+                                               log_file='DataManagement_Log.txt')
         dm_step['Value']['name'] = 'Step%s_DataManagement' % i_step
-        dm_step['Value']['descr_short'] = 'Save data files to SE and register them in DFC'
-        i_step += 1
-
-        # Upload and register log file - NSB=1
-        file_meta_data = {}
-        file_md_json = json.dumps(file_meta_data)
-        log_file_pattern = 'Data/sim_telarray/cta-prod5-%s/0.0deg/Log/*dark*.log.gz' %\
-                            self.cta_site.lower()
-        scripts = '../CTADIRAC/Core/scripts/'
-        log_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                      arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Log" %
-                                      (md_json, md_field_json, file_md_json,
-                                       self.base_path, log_file_pattern, self.package,
-                                       self.program_category, self.catalogs),
-                                      logFile='LogManagement_dark_Log.txt')
-        log_step['Value']['name'] = 'Step%s_LogManagement' % i_step
-        log_step['Value']['descr_short'] = 'Save log to SE and register them in DFC'
-        i_step += 1
-
-        ## Upload and register histogram file - NSB=1
-        histo_file_pattern = 'Data/sim_telarray/cta-prod5-%s/0.0deg/Histograms/*dark*.hdata.zst' %\
-                            self.cta_site.lower()
-        dm_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                  arguments = "'%s' '%s' '%s' %s '%s' %s %s '%s' Histograms" % \
-                                  (md_json, md_field_json, file_md_json,
-                                  self.base_path, histo_file_pattern, self.package,
-                                  self.program_category, self.catalogs),
-                                  logFile = 'Histo_DataManagement_dark_Log.txt')
-        dm_step['Value']['name'] = 'Step%i_Histo_DataManagement' % i_step
-        dm_step['Value']['descr_short'] = 'Save hitograms files to SE and register them in DFC'
-        i_step += 1
-
-        # Now switching to moonlight NSB
-        # Upload and register data - NSB=1 dark
-        file_meta_data = {'runNumber': self.run_number, 'nsb':5}
-        file_md_json = json.dumps(file_meta_data)
-        data_output_pattern = 'Data/sim_telarray/cta-prod5-%s/0.0deg/Data/*moon*.simtel.zst' %\
-                               self.cta_site.lower()
-
-        scripts = '../CTADIRAC/Core/scripts/'
-        dm_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                     arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Data" %
-                                     (md_json, md_field_json, file_md_json,
-                                      self.base_path, data_output_pattern, self.package,
-                                      self.program_category, self.catalogs),
-                                     logFile='DataManagement_moon_Log.txt')
-        dm_step['Value']['name'] = 'Step%s_DataManagement' % i_step
-        dm_step['Value']['descr_short'] = 'Save data files to SE and register them in DFC'
-        i_step += 1
-
-        # Upload and register log file - NSB=5
-        file_meta_data = {}
-        file_md_json = json.dumps(file_meta_data)
-        log_file_pattern = 'Data/sim_telarray/cta-prod5-%s/0.0deg/Log/*moon*.log.gz' %\
-                            self.cta_site.lower()
-        scripts = '../CTADIRAC/Core/scripts/'
-        log_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                      arguments="'%s' '%s' '%s' %s '%s' %s %s '%s' Log" %
-                                      (md_json, md_field_json, file_md_json,
-                                       self.base_path, log_file_pattern, self.package,
-                                       self.program_category, self.catalogs),
-                                      logFile='LogManagement_moon_Log.txt')
-        log_step['Value']['name'] = 'Step%s_LogManagement' % i_step
-        log_step['Value']['descr_short'] = 'Save log to SE and register them in DFC'
-        i_step += 1
-
-        ## Upload and register histogram file - NSB=5
-        histo_file_pattern = 'Data/sim_telarray/cta-prod5-%s/0.0deg/Histograms/*moon*.hdata.zst' %\
-                            self.cta_site.lower()
-        dm_step = self.setExecutable(scripts + 'cta-prod-managedata.py',
-                                  arguments = "'%s' '%s' '%s' %s '%s' %s %s '%s' Histograms" % \
-                                  (md_json, md_field_json, file_md_json,
-                                  self.base_path, histo_file_pattern, self.package,
-                                  self.program_category, self.catalogs),
-                                  logFile = 'Histo_DataManagement_moon_Log.txt')
-        dm_step['Value']['name'] = 'Step%i_Histo_DataManagement' % i_step
-        dm_step['Value']['descr_short'] = 'Save hitograms files to SE and register them in DFC'
+        dm_step['Value']['descr_short'] = 'Save data, log and histogram files to SE and register them in DFC'
         i_step += 1
 
         # Step 6 - debug only
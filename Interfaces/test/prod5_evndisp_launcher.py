@@ -29,7 +29,7 @@ from DIRAC.TransformationSystem.Client.Transformation import Transformation
 from CTADIRAC.Interfaces.API.EvnDispProd5Job import EvnDispProd5Job
 from DIRAC.Core.Workflow.Parameter import Parameter
 from DIRAC.Interfaces.API.Dirac import Dirac
-from CTADIRAC.Core.Utilities.tool_box import get_dataset_MQ
+from CTADIRAC.Core.Utilities.tool_box import get_dataset_MQ, register_metadata_fields
 
 
 def submit_trans(job, trans_name, input_meta_query, group_size):
@@ -135,6 +135,11 @@ def launch_job(args):
         if output_meta_data['nsb']['='] == 5:
             job.calibration_file = 'prod5/prod5-halfmoon-IPR.root'
         job.ts_task_id = '@{JOB_ID}'  # dynamic
+        # register the meta data fields once for all the jobs
+        result = register_metadata_fields(job.get_meta_data_field())
+        if not result['OK']:
+            return result
+        job.md_fields_fingerprint = result['Value']
         job.setupWorkflow(debug=False)
         job.setType('EvnDisp3')  # mandatory *here*
         result = submit_trans(job, trans_name, input_meta_query, group_size)
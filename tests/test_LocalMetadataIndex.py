@@ -0,0 +1,71 @@
+""" Test the incremental refresh of the local metadata index
+"""
+
+from DIRAC import S_OK
+
+from CTADIRAC.DataManagementSystem.Utilities.LocalMetadataIndex import LocalMetadataIndex
+from CTADIRAC.DataManagementSystem.Utilities.MetaQuery import MetaQuery
+
+DIRECTORY_FIELDS = { 'particle' : 'VARCHAR(128)' }
+FILE_FIELDS = { 'runNumber' : 'int' }
+
+class FakeCatalog( object ):
+  """ In memory catalog with the directory and file metadata, counting the requests
+  """
+
+  def __init__( self ):
+    self.directories = { '/vo/gamma' : { 'particle' : 'gamma' }, '/vo/proton' : { 'particle' : 'proton' } }
+    self.files = { '/vo/gamma/a' : { 'runNumber' : 1 }, '/vo/gamma/b' : { 'runNumber' : 2 },
+                   '/vo/proton/c' : { 'runNumber' : 3 } }
+    self.requests = { 'directory' : 0, 'file' : 0 }
+
+  def getUserMetadata( self, lfn ):
+    metadata = dict( self.directories[lfn.rsplit( '/', 1 )[0]] )
+    metadata.update( self.files[lfn] )
+    return metadata
+
+  def getMetadataFields( self ):
+    return S_OK( { 'DirectoryMetaFields' : DIRECTORY_FIELDS, 'FileMetaFields' : FILE_FIELDS } )
+
+  def findFilesByMetadata( self, metaDict, path = '/', timeout = 0 ):
+    metaTypeDict = dict( DIRECTORY_FIELDS, **FILE_FIELDS )
+    userMetaDicts = dict( ( lfn, self.getUserMetadata( lfn ) ) for lfn in self.files )
+    return MetaQuery( metaDict, metaTypeDict ).filter( userMetaDicts )
+
+  def getDirectoryUserMetadata( self, path ):
+    self.requests['directory'] += 1
+    return S_OK( dict( self.directories[path] ) )
+
+  def getFileUserMetadata( self, lfn ):
+    # the file and directory metadata, as FileCatalogClient
+    self.requests['file'] += 1
+    return S_OK( self.getUserMetadata( lfn ) )
+
+def test_refresh( tmpdir ):
+  catalog = FakeCatalog()
+  index = LocalMetadataIndex( str( tmpdir.join( 'index.db' ) ), nbThreads = 2 )
+  index.fc = catalog
+  scope = {}
+  try:
+    res = index.refresh( scope )
+    assert res['OK'], res
+    assert res['Value'] == { 'Added' : 3, 'Removed' : 0, 'Refreshed' : 3 }
+    assert catalog.requests == { 'directory' : 2, 'file' : 3 }
+    assert sorted( index.find( { 'runNumber' : { '>' : 1 }, 'particle' : 'gamma' } )['Value'] ) == [ '/vo/gamma/b' ]
+
+    # Unchanged catalog: only the directory metadata are fetched again
+    res = index.refresh( scope )
+    assert res['Value'] == { 'Added' : 0, 'Removed' : 0, 'Refreshed' : 0 }
+    assert catalog.requests == { 'directory' : 4, 'file' : 3 }
+
+    # New, removed and files of a modified directory
+    catalog.directories['/vo/proton']['particle'] = 'gamma'
+    del catalog.files['/vo/gamma/a']
+    catalog.files['/vo/gamma/d'] = { 'runNumber' : 4 }
+    res = index.refresh( scope )
+    assert res['Value'] == { 'Added' : 1, 'Removed' : 1, 'Refreshed' : 2 }
+    assert catalog.requests == { 'directory' : 6, 'file' : 4 }
+    query = { 'runNumber' : { '>' : 1 }, 'particle' : 'gamma' }
+    assert sorted( index.find( query )['Value'] ) == [ '/vo/gamma/b', '/vo/gamma/d', '/vo/proton/c' ]
+  finally:
+    index.close()
@@ -0,0 +1,67 @@
+""" Test that the columnar evaluation of MetaQuery gives the same results
+    as applyQuery, for all the operators, Any and Missing
+"""
+
+import random
+
+import numpy
+
+from CTADIRAC.DataManagementSystem.Utilities.MetaQuery import MetaQuery
+
+META_TYPES = { 'run' : 'int', 'energy' : 'float', 'part' : 'VARCHAR(128)', 'date' : 'DATETIME' }
+PARTICLES = [ 'gamma', 'proton', 'electron', 'helium' ]
+DATES = [ '2020-01-0%d 12:00:00' % day for day in range( 1, 10 ) ]
+
+QUERIES = [ { 'run' : 5 }, { 'run' : { '=' : 5 } }, { 'run' : { '!=' : 5 } },
+            { 'run' : { '>' : 5 } }, { 'run' : { '<' : 5 } }, { 'run' : { '>=' : 5 } },
+            { 'run' : { '<=' : 5 } }, { 'run' : { '>' : 2, '<=' : 7 } },
+            { 'run' : [ 1, 3, 5 ] }, { 'run' : { 'in' : [ 1, 3, 5 ] } }, { 'run' : { 'nin' : [ 1, 3, 5 ] } },
+            { 'energy' : { '>' : 0.5 } }, { 'energy' : { '<=' : 0.25 } },
+            { 'part' : 'gamma' }, { 'part' : { '!=' : 'gamma' } },
+            { 'part' : [ 'gamma', 'proton' ] }, { 'part' : { 'nin' : [ 'gamma', 'proton' ] } },
+            { 'date' : DATES[4] }, { 'date' : { '>' : DATES[4] } }, { 'date' : { '<=' : DATES[2] } },
+            { 'date' : [ DATES[1], DATES[6] ] }, { 'date' : { 'in' : [ DATES[1], DATES[6] ] } },
+            { 'date' : { 'nin' : [ DATES[1], DATES[6] ] } },
+            { 'run' : 'Any' }, { 'energy' : 'Any' }, { 'part' : 'Any' }, { 'date' : 'Any' },
+            { 'run' : 'Missing' }, { 'energy' : 'Missing' }, { 'part' : 'Missing' },
+            { 'run' : { '>' : 3 }, 'part' : 'Any' },
+            { 'energy' : 'Missing', 'part' : [ 'gamma', 'helium' ] } ]
+
+# Random user metadata, 20% of each metadata being undefined
+rng = random.Random( 1234 )
+ROWS = []
+for _ in range( 500 ):
+  row = {}
+  for meta, value in [ ( 'run', rng.randint( 0, 10 ) ), ( 'energy', rng.random() ),
+                       ( 'part', rng.choice( PARTICLES ) ), ( 'date', rng.choice( DATES ) ) ]:
+    if rng.random() > 0.2:
+      row[meta] = value
+  ROWS.append( row )
+
+# The same metadata in columns, the undefined values being masked, NaN or None
+COLUMNS = { 'run' : numpy.ma.masked_array( [ row.get( 'run', 0 ) for row in ROWS ],
+                                           mask = [ 'run' not in row for row in ROWS ] ),
+            'energy' : numpy.array( [ row.get( 'energy', numpy.nan ) for row in ROWS ] ),
+            'part' : numpy.array( [ row.get( 'part' ) for row in ROWS ], dtype = object ),
+            'date' : numpy.array( [ row.get( 'date' ) for row in ROWS ], dtype = object ) }
+
+def test_applyQueryColumns():
+  for query in QUERIES:
+    metaQuery = MetaQuery( query, META_TYPES )
+    res = metaQuery.applyQueryColumns( COLUMNS )
+    assert res['OK'], res
+    expected = [ metaQuery.applyQuery( row )['Value'] for row in ROWS ]
+    assert list( res['Value'] ) == expected, query
+
+def test_applyQueryColumns_undefined():
+  metaQuery = MetaQuery( { 'part' : 'Any' }, META_TYPES )
+  assert not metaQuery.applyQuery( { 'run' : 1 } )['Value']
+  res = metaQuery.applyQueryColumns( { 'part' : numpy.array( [ None, 'gamma' ], dtype = object ) } )
+  assert list( res['Value'] ) == [ False, True ]
+  # Metadata without column
+  metaQuery = MetaQuery( { 'part' : 'Any', 'run' : { '>' : 1 } }, META_TYPES )
+  res = metaQuery.applyQueryColumns( { 'run' : numpy.array( [ 1, 2, 3 ] ) } )
+  assert list( res['Value'] ) == [ False, False, False ]
+  metaQuery = MetaQuery( { 'part' : 'Missing', 'run' : { '>' : 1 } }, META_TYPES )
+  res = metaQuery.applyQueryColumns( { 'run' : numpy.array( [ 1, 2, 3 ] ) } )
+  assert list( res['Value'] ) == [ False, True, True ]
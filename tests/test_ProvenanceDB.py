@@ -0,0 +1,171 @@
+""" Test the units of work of the ProvenanceDB and its parallel writers,
+    with a SQLite database as stand-in for PostgreSQL
+"""
+
+import datetime
+import threading
+
+import pytest
+
+from CTADIRAC.DataManagementSystem.DB.ProvenanceDB import ProvenanceDB, Agent, Entity
+
+@pytest.fixture
+def provDB( tmpdir ):
+  return ProvenanceDB( 'sqlite:///%s' % tmpdir.join( 'prov.db' ) )
+
+def getAgentIDs( provDB ):
+  """ ids of the committed agents, read outside of any transaction
+      since the SQLite transactions of the ProvenanceDB lock the database
+  """
+  return sorted( row.id for row in provDB.engine.execute( Agent.__table__.select() ) )
+
+class Abort( Exception ):
+  pass
+
+def test_unitOfWork( provDB ):
+  assert provDB.addAgent( { 'id' : 'agent1' } )['OK']
+  assert getAgentIDs( provDB ) == [ 'agent1' ]
+  with provDB.unitOfWork() as session:
+    with provDB.unitOfWork() as nestedSession:
+      assert nestedSession is session
+      assert provDB.addAgent( { 'id' : 'agent2' } )['OK']
+    # The nested unit of work is part of the enclosing one
+    assert getAgentIDs( provDB ) == [ 'agent1' ]
+    assert provDB.addAgent( { 'id' : 'agent3' } )['OK']
+  assert getAgentIDs( provDB ) == [ 'agent1', 'agent2', 'agent3' ]
+
+def test_unitOfWork_rollback( provDB ):
+  with pytest.raises( Abort ):
+    with provDB.unitOfWork():
+      assert provDB.addAgent( { 'id' : 'agent1' } )['OK']
+      with provDB.unitOfWork():
+        assert provDB.addAgent( { 'id' : 'agent2' } )['OK']
+      assert provDB.getAgentKey( 'agent1' )['OK']
+      raise Abort()
+  assert getAgentIDs( provDB ) == []
+  # The key looked up in the rolled back unit of work is not cached
+  assert provDB.addAgent( { 'id' : 'agent1' } )['OK']
+  assert getAgentIDs( provDB ) == [ 'agent1' ]
+
+def test_unitOfWork_savepoint( provDB ):
+  assert provDB.addAgent( { 'id' : 'agent1' } )['OK']
+  with provDB.unitOfWork():
+    assert provDB.addAgent( { 'id' : 'agent2' } )['OK']
+    # A failed write only rolls back its savepoint
+    assert not provDB._sessionAdd( Agent( id = 'agent1' ) )['OK']
+    res = provDB.addProvenanceGraph( [ { 'type' : 'Agent', 'tmp_id' : 'Agent_0', 'row' : { 'id' : 'agent3' } },
+                                       { 'type' : 'WasAssociatedWith', 'tmp_id' : 'WasAssociatedWith_1',
+                                         'row' : { 'agent_key' : 'Agent_0', 'activity_key' : 'Activity_9' } } ] )
+    assert not res['OK']
+    assert provDB.addAgent( { 'id' : 'agent4' } )['OK']
+  assert getAgentIDs( provDB ) == [ 'agent1', 'agent2', 'agent4' ]
+
+def test_unitOfWork_descriptionCache( provDB ):
+  cacheKey = ( 'getAgentKey', 'agent1' )
+  for commit in [ False, True ]:
+    try:
+      with provDB.unitOfWork():
+        assert provDB.addAgent( { 'id' : 'agent1' } )['OK']
+        assert provDB.getAgentKey( 'agent1' )['OK']
+        # The other threads do not get the key of the uncommitted row
+        assert provDB.descriptionCache.get( Agent, cacheKey ) is None
+        if not commit:
+          raise Abort()
+    except Abort:
+      pass
+    assert ( provDB.descriptionCache.get( Agent, cacheKey ) is not None ) == commit
+  assert provDB.descriptionCache.get( Agent, cacheKey ) == provDB.getAgentKey( 'agent1' )['Value']
+
+def test_getPoolStatus( provDB ):
+  res = provDB.getPoolStatus()
+  assert res['OK'], res
+  for key in [ 'PoolSize', 'MaxOverflow', 'PoolRecycle', 'CheckedIn', 'CheckedOut', 'Overflow', 'Status' ]:
+    assert key in res['Value']
+  assert res['Value']['CheckedOut'] == 0
+  with provDB.unitOfWork():
+    assert provDB.addAgent( { 'id' : 'agent1' } )['OK']
+    # The connection of the unit of work is held until the end of the block
+    assert provDB.getPoolStatus()['Value']['CheckedOut'] == 1
+  assert provDB.getPoolStatus()['Value']['CheckedOut'] == 0
+
+def runWriters( nbWriters, write ):
+  """ run write( writer ) in nbWriters threads, return the exceptions raised """
+  errors = []
+  def run( writer ):
+    try:
+      write( writer )
+    except Exception as e:
+      errors.append( repr( e ) )
+  threads = [ threading.Thread( target = run, args = ( writer, ) ) for writer in range( nbWriters ) ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return errors
+
+@pytest.mark.parametrize( 'unitOfWork', [ False, True ] )
+def test_parallelWriters( provDB, unitOfWork ):
+  keys = {}
+  def write( writer ):
+    for i in range( 25 ):
+      agentID = 'agent%d_%d' % ( writer, i )
+      if unitOfWork:
+        with provDB.unitOfWork():
+          res = provDB.addAgent( { 'id' : agentID } )
+      else:
+        res = provDB.addAgent( { 'id' : agentID } )
+      assert res['OK'], res
+      keys[agentID] = res['Value']['internal_key']
+  assert runWriters( 8, write ) == []
+  # Each writer got the key of the row it inserted
+  assert len( keys ) == 200
+  assert len( set( keys.values() ) ) == len( keys )
+  rows = dict( ( row.internal_key, row.id ) for row in provDB.engine.execute( Agent.__table__.select() ) )
+  assert all( rows[key] == agentID for agentID, key in keys.items() )
+
+def test_parallelWriters_sameRows( provDB ):
+  keys = []
+  def write( writer ):
+    for i in range( 10 ):
+      res = provDB.addAgent( { 'id' : 'agent%d' % i } )
+      assert res['OK'], res
+      keys.append( ( 'agent%d' % i, res['Value']['internal_key'] ) )
+      res = provDB.addActivityDescription( { 'name' : 'activity%d' % i, 'version' : 'v1' } )
+      assert res['OK'], res
+      keys.append( ( 'activity%d' % i, res['Value']['internal_key'] ) )
+  # The writers insert the same rows: all of them get the key of the single inserted row
+  assert runWriters( 8, write ) == []
+  assert len( keys ) == 160
+  assert len( set( keys ) ) == 20
+  assert getAgentIDs( provDB ) == sorted( 'agent%d' % i for i in range( 10 ) )
+
+def test_addProvenanceGraph_conflict( provDB, monkeypatch ):
+  key = provDB.addAgent( { 'id' : 'agent1' } )['Value']['internal_key']
+  # The agent is inserted by a concurrent writer after the graph looked it up
+  lookups = []
+  lookupGraphRow = provDB._lookupGraphRow
+  def missFirstLookup( *args ):
+    lookups.append( args )
+    return lookupGraphRow( *args ) if len( lookups ) > 1 else None
+  monkeypatch.setattr( provDB, '_lookupGraphRow', missFirstLookup )
+  graph = [ { 'type' : 'Agent', 'tmp_id' : 'Agent_0', 'row' : { 'id' : 'agent1' } },
+            { 'type' : 'Agent', 'tmp_id' : 'Agent_1', 'row' : { 'id' : 'agent2' } } ]
+  res = provDB.addProvenanceGraph( graph )
+  assert res['OK'], res
+  assert res['Value']['Agent_0'] == key
+  assert getAgentIDs( provDB ) == [ 'agent1', 'agent2' ]
+
+def test_updateDatasetEntity( provDB ):
+  key = provDB.addDatasetEntity( { 'id' : 'dataset1' } )['Value']['internal_key']
+  def getInvalidatedAtTime():
+    return [ row.invalidatedAtTime for row in provDB.engine.execute( Entity.__table__.select() ) ]
+  now = datetime.datetime( 2020, 1, 1 )
+  with pytest.raises( Abort ):
+    with provDB.unitOfWork():
+      assert provDB.updateDatasetEntity( key, now )['OK']
+      raise Abort()
+  # The update is part of the rolled back unit of work
+  assert getInvalidatedAtTime() == [ None ]
+  with provDB.unitOfWork():
+    assert provDB.updateDatasetEntity( key, now )['OK']
+  assert getInvalidatedAtTime() == [ now ]
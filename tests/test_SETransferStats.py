@@ -0,0 +1,20 @@
+""" Test the merge of the SE statistics saved by several processes
+"""
+
+from CTADIRAC.DataManagementSystem.Utilities.SETransferStats import SETransferStats
+
+def test_save( tmpdir ):
+  statsFile = str( tmpdir.join( 'se_stats.json' ) )
+  first = SETransferStats( statsFile )
+  second = SETransferStats( statsFile )
+  first.addTransfer( 'SE-A', True, 1000, 1. )
+  second.addTransfer( 'SE-B', False )
+  second.addTransfer( 'SE-A', False )
+  first.save()
+  # The entries of the other process are kept, the most recent one for SE-A
+  second.save()
+  saved = SETransferStats( statsFile )
+  assert saved.getStats( 'SE-A' )['Failures'] == 1
+  assert saved.getStats( 'SE-B' )['Failures'] == 1
+  first.save()
+  assert SETransferStats( statsFile ).getStats( 'SE-A' ) == saved.getStats( 'SE-A' )